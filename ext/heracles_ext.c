@@ -0,0 +1,286 @@
+/*
+ * heracles_ext.c: companion helpers of libheracles for the Heracles
+ * Python package.
+ *
+ * They move whole trees between libheracles and Python in a single call
+ * instead of accessing every node field through ctypes.
+ *
+ * Copyright 2013 Jorge Monforte. Distributed under the LGPL license.
+ */
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* Replicas of struct span and struct tree from libheracles src/info.h
+   and src/internal.h */
+struct span {
+    void        *filename;
+    unsigned int label_start;
+    unsigned int label_end;
+    unsigned int value_start;
+    unsigned int value_end;
+    unsigned int span_start;
+    unsigned int span_end;
+};
+
+struct tree {
+    struct tree *next;
+    struct tree *parent;
+    char        *label;
+    struct tree *children;
+    char        *value;
+    int          dirty;
+    struct span *span;
+};
+
+/*
+ * A flattened tree is a sequence of records, one for each node in
+ * preorder, and a table of strings the records point to:
+ *
+ *     int32_t depth;
+ *     int32_t label_offset, label_length;
+ *     int32_t value_offset, value_length;
+ *
+ * NULL labels and values are stored as empty strings.
+ */
+#define RECORD_FIELDS 5
+
+/*
+ * The spans of a flattened tree are stored apart, one record for each
+ * node in the same order:
+ *
+ *     int32_t label_start, label_end;
+ *     int32_t value_start, value_end;
+ *     int32_t span_start, span_end;
+ *
+ * Nodes without span have all the fields set to -1.
+ */
+#define SPAN_FIELDS 6
+
+struct buffer {
+    char   *data;
+    size_t  len;
+    size_t  size;
+};
+
+static int buffer_append(struct buffer *buf, const void *data, size_t len) {
+    if (buf->len + len > buf->size) {
+        size_t size = buf->size == 0 ? 4096 : buf->size;
+        char *new_data;
+        while (buf->len + len > size)
+            size *= 2;
+        new_data = realloc(buf->data, size);
+        if (new_data == NULL)
+            return -1;
+        buf->data = new_data;
+        buf->size = size;
+    }
+    memcpy(buf->data + buf->len, data, len);
+    buf->len += len;
+    return 0;
+}
+
+static int export_string(struct buffer *strings, const char *str,
+                         int32_t *offset, int32_t *length) {
+    size_t len = str == NULL ? 0 : strlen(str);
+
+    *offset = (int32_t) strings->len;
+    *length = (int32_t) len;
+    if (len == 0)
+        return 0;
+    return buffer_append(strings, str, len);
+}
+
+static int export_level(struct tree *tree, int32_t depth,
+                        struct buffer *records, struct buffer *strings,
+                        size_t *nrecords) {
+    for (struct tree *t = tree; t != NULL; t = t->next) {
+        int32_t record[RECORD_FIELDS];
+
+        record[0] = depth;
+        if (export_string(strings, t->label, &record[1], &record[2]) < 0)
+            return -1;
+        if (export_string(strings, t->value, &record[3], &record[4]) < 0)
+            return -1;
+        if (buffer_append(records, record, sizeof(record)) < 0)
+            return -1;
+        *nrecords += 1;
+        if (t->children != NULL &&
+            export_level(t->children, depth + 1, records, strings,
+                         nrecords) < 0)
+            return -1;
+    }
+    return 0;
+}
+
+/*
+ * hera_ext_export: flattens TREE and its siblings. On success returns 0
+ * and RECORDS and STRINGS point to buffers that must be released with
+ * hera_ext_free.
+ */
+int hera_ext_export(struct tree *tree, char **records, size_t *nrecords,
+                    char **strings, size_t *strings_len) {
+    struct buffer rec_buf = { NULL, 0, 0 };
+    struct buffer str_buf = { NULL, 0, 0 };
+
+    *nrecords = 0;
+    if (export_level(tree, 0, &rec_buf, &str_buf, nrecords) < 0) {
+        free(rec_buf.data);
+        free(str_buf.data);
+        return -1;
+    }
+    *records = rec_buf.data;
+    *strings = str_buf.data;
+    *strings_len = str_buf.len;
+    return 0;
+}
+
+/*
+ * hera_ext_free_tree: releases a tree built by hera_ext_import.
+ */
+void hera_ext_free_tree(struct tree *tree) {
+    while (tree != NULL) {
+        struct tree *next = tree->next;
+        hera_ext_free_tree(tree->children);
+        free(tree->label);
+        free(tree->value);
+        free(tree);
+        tree = next;
+    }
+}
+
+static int import_string(const char *strings, int32_t offset, int32_t length,
+                         char **str) {
+    if (length < 0) {
+        *str = NULL;
+        return 0;
+    }
+    *str = malloc(length + 1);
+    if (*str == NULL)
+        return -1;
+    memcpy(*str, strings + offset, length);
+    (*str)[length] = '\0';
+    return 0;
+}
+
+/*
+ * hera_ext_import: builds a tree from NRECORDS records in the format
+ * produced by hera_ext_export, where a negative length stands for a NULL
+ * label or value. On success returns 0 and TREE points to the first node,
+ * that must be released with hera_ext_free_tree.
+ */
+int hera_ext_import(const int32_t *records, size_t nrecords,
+                    const char *strings, struct tree **tree) {
+    /* tails[d] is the last node added at depth d under the current
+       parent, tails[d - 1] */
+    struct tree **tails = NULL;
+    size_t ntails = 0;
+
+    *tree = NULL;
+    for (size_t i = 0; i < nrecords; i++) {
+        const int32_t *record = records + i * RECORD_FIELDS;
+        int32_t depth = record[0];
+        struct tree *node;
+
+        if (depth < 0 || (size_t) depth > ntails ||
+            (depth > 0 && tails[depth - 1] == NULL))
+            goto error;
+        if ((size_t) depth + 2 > ntails) {
+            size_t n = ntails == 0 ? 16 : ntails * 2;
+            struct tree **new_tails = realloc(tails, n * sizeof(*tails));
+            if (new_tails == NULL)
+                goto error;
+            for (size_t j = ntails; j < n; j++)
+                new_tails[j] = NULL;
+            tails = new_tails;
+            ntails = n;
+        }
+
+        node = calloc(1, sizeof(*node));
+        if (node == NULL)
+            goto error;
+        if (tails[depth] != NULL)
+            tails[depth]->next = node;
+        else if (depth == 0)
+            *tree = node;
+        else
+            tails[depth - 1]->children = node;
+        node->parent = depth == 0 ? NULL : tails[depth - 1];
+        tails[depth] = node;
+        tails[depth + 1] = NULL;
+
+        if (import_string(strings, record[1], record[2], &node->label) < 0)
+            goto error;
+        if (import_string(strings, record[3], record[4], &node->value) < 0)
+            goto error;
+    }
+    free(tails);
+    return 0;
+
+ error:
+    free(tails);
+    hera_ext_free_tree(*tree);
+    *tree = NULL;
+    return -1;
+}
+
+static int export_level_spans(struct tree *tree, struct buffer *spans,
+                              size_t *nspans) {
+    for (struct tree *t = tree; t != NULL; t = t->next) {
+        int32_t record[SPAN_FIELDS];
+        struct span *span = t->span;
+
+        if (span == NULL || span->span_start == UINT32_MAX) {
+            for (int i = 0; i < SPAN_FIELDS; i++)
+                record[i] = -1;
+        } else {
+            record[0] = (int32_t) span->label_start;
+            record[1] = (int32_t) span->label_end;
+            record[2] = (int32_t) span->value_start;
+            record[3] = (int32_t) span->value_end;
+            record[4] = (int32_t) span->span_start;
+            record[5] = (int32_t) span->span_end;
+        }
+        if (buffer_append(spans, record, sizeof(record)) < 0)
+            return -1;
+        *nspans += 1;
+        if (t->children != NULL &&
+            export_level_spans(t->children, spans, nspans) < 0)
+            return -1;
+    }
+    return 0;
+}
+
+/*
+ * hera_ext_export_spans: flattens the spans of TREE and its siblings in
+ * the order of hera_ext_export. On success returns 0 and SPANS points to
+ * a buffer that must be released with hera_ext_free.
+ */
+int hera_ext_export_spans(struct tree *tree, char **spans, size_t *nspans) {
+    struct buffer span_buf = { NULL, 0, 0 };
+
+    *nspans = 0;
+    if (export_level_spans(tree, &span_buf, nspans) < 0) {
+        free(span_buf.data);
+        return -1;
+    }
+    *spans = span_buf.data;
+    return 0;
+}
+
+/*
+ * hera_ext_free: releases the memory returned by the hera_ext functions.
+ */
+void hera_ext_free(void *ptr) {
+    free(ptr);
+}
+
+/*
+ * Local variables:
+ *  indent-tabs-mode: nil
+ *  c-indent-level: 4
+ *  c-basic-offset: 4
+ *  tab-width: 4
+ * End:
+ */
@@ -1,6 +1,9 @@
-from heracles.base import Heracles
+from heracles.base import Heracles, preload
 from heracles.tree import Tree, TreeNode, ListTree, ListTreeNode
+from heracles.batch import save_all
+from heracles.instrument import stats
 
-__all__ = Heracles, Tree, TreeNode, ListTree, ListTreeNode
+__all__ = (Heracles, preload, save_all, stats, Tree, TreeNode, ListTree, 
+        ListTreeNode)
 
 __version__ = "0.0.6"
@@ -4,13 +4,21 @@ This module includes the core of the Heracles package
 
 """
 import os
+import mmap
+import threading
 import ctypes as c
 from fnmatch import fnmatch
-from heracles.structs import struct_heracles, struct_tree, struct_lns_error
-from heracles.exceptions import exception_list, HeraclesError, HeraclesLensError
-from heracles.libs import libheracles, disabled_lib
-from heracles.raw import UnmanagedRawTree, ManagedRawTree
-from heracles.util import get_heracles_path
+from heracles.structs import (struct_heracles, struct_tree_p, struct_lens,
+        struct_info, struct_error, struct_lns_error, struct_memstream, 
+        struct_regexp, REF_MAX, L_DEL, L_STORE, L_KEY, L_CONCAT, L_UNION, 
+        L_SUBTREE, L_STAR, L_MAYBE, L_REC, L_SQUARE)
+from heracles.exceptions import (exception_list, HeraclesError, 
+        HeraclesLensError, HeraclesNoLensError)
+from heracles.libs import libheracles, libc, disabled_lib
+from heracles.raw import UnmanagedRawTree, get_raw_tree_from_tree
+from heracles.resolver import LensResolver
+from heracles import batch, instrument
+from heracles.util import get_heracles_path, check_int
 
 # TODO : 
 # - Finish documentation
@@ -18,13 +26,181 @@ from heracles.util import get_heracles_path
 
 
 LENS_PATH = "lenses"
+LENS_EXT = ".aug"
 PATH_SEP = ":"
 
+# hera_init flag that skips the loading of the modules in the load path
+HERA_NO_MODL_AUTOLOAD = 1 << 6
+# lns_get flag that stores the span of the nodes in the text
+HERA_ENABLE_SPAN = 1 << 7
+# Approximate size of the pieces of text parsed by Lens.iter_records
+RECORDS_CHUNK_SIZE = 64 * 1024
+
+struct_lns_error_p = c.POINTER(struct_lns_error)
+
+if not disabled_lib:
+    hera_init = libheracles.hera_init
+    hera_init.restype = c.POINTER(struct_heracles)
+    hera_init.argtypes = [c.c_char_p, c.c_uint]
+    # The lenses are applied with the internal libheracles functions instead
+    # of hera_get and hera_put, as these lose the errors and leave the
+    # release of the returned memory to the caller.
+    lns_get = libheracles.lns_get
+    lns_get.restype = struct_tree_p
+    lns_get.argtypes = [c.POINTER(struct_info), c.POINTER(struct_lens),
+            c.c_char_p, c.POINTER(struct_lns_error_p)]
+    lns_put = libheracles.lns_put
+    lns_put.restype = None
+    lns_put.argtypes = [c.c_void_p, c.POINTER(struct_lens), struct_tree_p,
+            c.c_char_p, c.POINTER(struct_lns_error_p)]
+    free_lns_error = libheracles.free_lns_error
+    free_lns_error.restype = None
+    free_lns_error.argtypes = [struct_lns_error_p]
+    load_module_file = libheracles.load_module_file
+    load_module_file.argtypes = [c.POINTER(struct_heracles), c.c_char_p]
+    reset_error = libheracles.reset_error
+    reset_error.restype = None
+    reset_error.argtypes = [c.POINTER(struct_error)]
+    regexp_compile = libheracles.regexp_compile
+    regexp_compile.restype = c.c_int
+    regexp_compile.argtypes = [c.POINTER(struct_regexp)]
+    init_memstream = libheracles.__hera_init_memstream
+    init_memstream.argtypes = [c.POINTER(struct_memstream)]
+    close_memstream = libheracles.__hera_close_memstream
+    close_memstream.argtypes = [c.POINTER(struct_memstream)]
+    free = libc.free
+    free.restype = None
+    free.argtypes = [c.c_void_p]
+
+def iter_lenses(lens_p):
+    """
+    Yields the pointers to the lens ``lens_p`` and all the lenses it is 
+    made of, once each.
+
+    """
+    visited = set()
+    pending = [lens_p]
+    while pending:
+        lens_p = pending.pop()
+        if not lens_p or c.addressof(lens_p.contents) in visited:
+            continue
+        lens = lens_p.contents
+        visited.add(c.addressof(lens))
+        yield lens_p
+        if lens.tag in (L_SUBTREE, L_STAR, L_MAYBE, L_SQUARE):
+            pending.append(lens.child)
+        elif lens.tag in (L_CONCAT, L_UNION):
+            pending.extend(lens.children[i] for i in xrange(lens.nchildren))
+        elif lens.tag == L_REC:
+            pending.append(lens.body)
+            pending.append(lens.alias)
+
+def compile_lens(lens_p, pinned=None):
+    """
+    Compiles the regular expressions of the lens ``lens_p`` and all the 
+    lenses it is made of, that libheracles otherwise compiles the first time
+    they are matched, and pins their reference counts. Returns true if any 
+    of the lenses is recursive, their automatons are still built by 
+    libheracles when they are first used.
+
+    The errors of the get and put calls take a reference to the failing 
+    lens, and the reference counts are not atomic, so the lenses are pinned
+    with :data:`REF_MAX` to make those references no-ops. The original 
+    counts of the lenses pinned are appended to ``pinned`` as ``(lens_p, 
+    ref)`` tuples if it is given.
+
+    It must be called holding ``_modules_lock``, as the regular expressions
+    are compiled with global options.
+
+    """
+    recursive = False
+    for lens_p in iter_lenses(lens_p):
+        lens = lens_p.contents
+        recursive = recursive or lens.recursive
+        regexps = [lens.ctype, lens.atype, lens.ktype, lens.vtype]
+        if lens.tag in (L_DEL, L_STORE, L_KEY):
+            regexps.append(lens.regexp)
+        for regexp in regexps:
+            if regexp and not regexp.contents.re:
+                regexp_compile(regexp)
+        if lens.ref != REF_MAX:
+            if pinned is not None:
+                pinned.append((lens_p, lens.ref))
+            lens.ref = REF_MAX
+    return bool(recursive)
+
+def catch_call_error(error):
+    """
+    Raises the exception of the per call libheracles ``error`` if there is 
+    one, clearing it.
+
+    """
+    if error.code:
+        exception = exception_list[error.code] or HeraclesError
+        details = error.details or "libheracles error %d" % error.code
+        reset_error(c.byref(error))
+        raise exception(details)
+
+class NoLock(object):
+    """
+    Context manager that does nothing, used in place of the lock of the 
+    lenses that don't need it.
+
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NO_LOCK = NoLock()
+
+def read_buffer(buf, size):
+    """
+    Returns a string with ``size`` bytes from the address ``buf``.
+
+    """
+    return c.string_at(buf, size) if buf else ""
+
+def write_buffer(fd, buf, size):
+    """
+    Writes ``size`` bytes from the address ``buf`` to the file descriptor 
+    ``fd`` and returns ``size``.
+
+    """
+    if not buf or not size:
+        return 0
+    data = memoryview((c.c_char * size).from_address(buf))
+    written = 0
+    while written < size:
+        written += os.write(fd, data[written:])
+    return size
+
 class HeraclesLensesDescriptor(object):
     """
     A descriptor object to access loaded lenses by the :class:`Heracles`
     instance. 
 
+    It returns the :class:`HeraclesLenses` registry of the instance, that is
+    built the first time it is accessed. The descriptor has no state, and 
+    if several threads access it at once all of them get the same registry.
+
+    """
+    def __get__(self, obj, obj_type=None):
+        if obj is None:
+            return self
+        lenses = obj.__dict__.get('_lenses')
+        if lenses is None:
+            lenses = obj.__dict__.setdefault('_lenses', HeraclesLenses(obj))
+        return lenses
+
+    def __repr__(self):
+        return "<%s>" % self.__class__.__name__
+
+class HeraclesLenses(object):
+    """
+    Registry of the lenses loaded by an :class:`Heracles` instance. 
+
     It allows straight access to the lens by its name using standard ``dict``
     syntax. So if you want to load the lens to parse the sources file of 
     the Debian/Ubuntu package management system APT you would do::
@@ -35,41 +211,221 @@ class HeraclesLensesDescriptor(object):
     The names of the lenses can be found `at augeas.net 
     <http://augeas.net/stock_lenses.html>`_
 
+    The libheracles modules are walked only once, the first time the registry
+    is used, and the same :class:`Lens` instances are returned afterwards.
+
+    If the :class:`Heracles` instance was created with a list of ``modules``
+    the lenses not loaded yet are loaded the first time they are looked up
+    by name.
+
+    The registry can be used from several threads. The lenses found are 
+    added to copies of the lookup tables that then replace the old ones, so
+    the readers never see them half updated.
+
     """
-    def __get__(self, obj, obj_type=None):
-        if obj:
-            self.heracles = obj
-            self._handle = obj._handle
-        return self
+    def __init__(self, heracles):
+        self.heracles = heracles
+        self._lenses = None
+        self._names = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            lenses = dict(self._lenses or {})
+            names = list(self._names or [])
+            added = False
+            module = self.heracles._get_handle().contents.module
+            while module:
+                name = module.contents.name
+                if name not in lenses:
+                    lens = Lens(self.heracles, module)
+                    if lens.lens:
+                        lenses[name] = lens
+                        names.append(name)
+                        added = True
+                module = module.contents.next
+            # The names are replaced first and read last, see __iter__
+            self._names = names
+            self._lenses = lenses
+        if added:
+            self.heracles._resolver = None
+
+    def _lookup(self, name):
+        lens = self._get_lenses().get(name)
+        if lens is None and self.heracles._selective:
+            if self.heracles._load_module(name):
+                self._load()
+                lens = self._lenses.get(name)
+        return lens
+
+    def _get_lenses(self):
+        if self._lenses is None:
+            self._load()
+        return self._lenses
 
     def __iter__(self):
         """
         Iterates over all the loaded lenses of :attr:`self.heracles`.
 
         """
-        module = self._handle.contents.module
-        while True:
-            if not module:
-                break
-            lens = Lens(self.heracles, module)
-            if lens.lens:
-                yield lens
-            module = module.contents.next
+        lenses = self._get_lenses()
+        for name in self._names[:len(lenses)]:
+            yield lenses[name]
 
     def __getitem__(self, name):
         """
-        Search the lenses loaded by the heracles object for a lens with
-        name *name*.
+        Returns the lens loaded by the heracles object with name *name*.
+
+        """
+        lens = self._lookup(name)
+        if lens is None:
+            raise KeyError("Unable to find module %s" % name)
+        return lens
+
+    def __contains__(self, name):
+        return self._lookup(name) is not None
+
+    def __len__(self):
+        return len(self._get_lenses())
+
+    def keys(self):
+        """
+        Returns the names of the loaded lenses.
 
         """
-        for module in self:
-            if module.name == name:
-                return module
-        raise KeyError("Unable to find module %s" % name)
+        self._get_lenses()
+        return list(self._names)
+
+    def get(self, name, default=None):
+        """
+        Returns the lens with name *name* or ``default`` if there is no lens
+        with that name.
+
+        """
+        lens = self._lookup(name)
+        return default if lens is None else lens
 
     def __repr__(self):
         return "<%s>" % self.__class__.__name__
 
+# The libheracles handles shared by the Heracles objects of the process, by
+# load path and flags. They are never closed.
+_shared_handles = {}
+# The lens resolvers of the shared handles, by handle address.
+_shared_resolvers = {}
+_shared_lock = threading.Lock()
+# Held while modules are loaded or lenses are compiled
+_modules_lock = threading.Lock()
+# Locks of the recursive lenses, by lens address
+_recursive_locks = {}
+
+def catch_handle_error(handle):
+    """
+    Raises the exception of the error stored in ``handle`` if there is one,
+    clearing it.
+
+    """
+    error = handle.contents.error
+    exception = exception_list[int(error.contents.code)]
+    if exception is not None:
+        details = str(error.contents.details)
+        reset_error(error)
+        raise exception(details)
+
+def init_handle(loadpath, flags):
+    """
+    Returns a new libheracles handle that loads the lenses in ``loadpath``.
+
+    """
+    # The lenses are compiled with global options, see compile_lens
+    with _modules_lock:
+        handle = hera_init(loadpath, flags)
+    if not handle:
+        raise HeraclesError("Unable to create Heracles object!")
+    # If init returns an error raises exception
+    try:
+        catch_handle_error(handle)
+    except HeraclesError:
+        libheracles.hera_close(handle)
+        raise
+    return handle
+
+def get_module_names(handle):
+    """
+    Returns the lowercased names of the modules loaded in ``handle``.
+
+    """
+    names = set()
+    module = handle.contents.module
+    while module:
+        names.add(module.contents.name.lower())
+        module = module.contents.next
+    return names
+
+def get_shared_handle(loadpath, flags):
+    """
+    Returns the libheracles handle shared by the process for ``loadpath``
+    and ``flags``, it is created the first time it is requested.
+
+    """
+    key = (loadpath, flags)
+    with _shared_lock:
+        handle = _shared_handles.get(key)
+        if handle is None:
+            handle = _shared_handles[key] = init_handle(loadpath, flags)
+    return handle
+
+def preload(loadpath=None, flags=0, modules=None):
+    """
+    Loads the lenses shared by the :class:`Heracles` objects created with 
+    the same ``loadpath`` and ``flags``, and returns one of them. If 
+    ``modules`` is given only those modules are loaded, see 
+    :class:`Heracles`.
+
+    Calling it before starting worker processes makes them inherit the 
+    loaded lenses, so the :class:`Heracles` objects of the workers are 
+    created at once.
+
+    :rtype: :class:`Heracles`
+
+    """
+    return Heracles(loadpath=loadpath, flags=flags, modules=modules)
+
+class HeraclesHandle(object):
+    """
+    Owner of the libheracles handle of an :class:`Heracles` object, that is
+    closed when this object is destroyed. 
+    
+    It is apart from the :class:`Heracles` object because that one is part
+    of reference cycles with its lenses, and the garbage collector doesn't
+    free cycles of objects with a ``__del__`` method.
+
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        # Original reference counts of the lenses pinned, see compile_lens
+        self.pinned = []
+
+    def load(self):
+        """
+        Called before loading modules, whose lenses may take references to 
+        the pinned lenses that are not counted. Those lenses are no longer
+        unpinned when the handle is closed, they are leaked instead.
+
+        """
+        self.pinned = None
+
+    def close(self):
+        handle, self.handle = self.handle, None
+        if handle:
+            for lens_p, ref in self.pinned or ():
+                lens_p.contents.ref = ref
+            self.pinned = None
+            libheracles.hera_close(handle)
+
+    def __del__(self):
+        self.close()
+
 class Heracles(object):
     """
     Main heracles object. Loads lenses into memory and makes them accessible
@@ -81,10 +437,12 @@ class Heracles(object):
 
     lenses = HeraclesLensesDescriptor()
     """
-    Returns a :class:`HeraclesLensesDescriptor` to allow access to the lens database.
+    Returns the :class:`HeraclesLenses` registry to allow access to the lens
+    database.
 
     """
-    def __init__(self, loadpath=None, flags=0):
+    def __init__(self, loadpath=None, flags=0, cache=None, shared=True,
+            modules=None, lens_cache=None):
         """
         Can be instantiatd with these parameters:
 
@@ -93,8 +451,39 @@ class Heracles(object):
         :param flags: Flags to pass to de libheracles init function, 
             mostly useless.
         :type flags: int
+        :param cache: Optional disk cache of parsed files used by 
+            :meth:`parse_file_from_path` and :meth:`parse_paths`.
+        :type cache: :class:`heracles.cache.ParseCache`
+        :param shared: If true the lenses are loaded once by process and 
+            shared with the other objects created with the same 
+            ``loadpath`` and ``flags``. See :func:`preload`.
+        :type shared: bool
+        :param modules: Names of the lens modules to load, like 
+            ``['Aptsources', 'Sshd']``. Only those modules and the modules
+            they depend on are loaded at first, the rest are loaded when 
+            they are looked up in :attr:`lenses`, or all of them when 
+            :meth:`resolve_lens` doesn't find the lens of a path among the
+            loaded ones. By default all the modules are loaded.
+        :type modules: list of strings
+        :param lens_cache: Optional disk cache of the lens modules of the 
+            load path. If it is given no module is loaded by default, and 
+            :meth:`resolve_lens` loads just the module of the lens it finds
+            in the cache.
+        :type lens_cache: :class:`heracles.lenscache.LensCache`
+
+        If the object is not shared its libheracles data is freed when the
+        object is destroyed, or before calling :meth:`close` or leaving a
+        ``with`` block::
+
+            >> with Heracles(shared=False) as h:
+            ..     tree = h.lenses['Aptsources'].get(text)
 
         """
+        self.cache = cache
+        self.lens_cache = lens_cache
+        self._handle = None
+        self._owner = None
+        self._selective = False
 
         if disabled_lib:
             self._handle = "dummy"
@@ -110,18 +499,35 @@ class Heracles(object):
             raise HeraclesError("loadpath MUST be a string or None!")
         if not isinstance(flags, int):
             raise HeraclesError("flag MUST be a flag!")
+        if modules is not None:
+            if not isinstance(modules, list):
+                raise HeraclesError("modules MUST be a list or None!")
+            for name in modules:
+                if not isinstance(name, str):
+                    raise HeraclesError("modules items must be string")
+        elif lens_cache is not None:
+            modules = []
 
+        self._loadpath = loadpath
+        self._flags = flags
+        self._modules = modules
+        self._selective = modules is not None
+        self._all_loaded = not self._selective
         loadpath = self._get_load_path(loadpath)
+        self._load_dirs = loadpath.split(PATH_SEP)
 
-        hera_init = libheracles.hera_init
-        hera_init.restype = c.POINTER(struct_heracles)
-
-        self._handle = hera_init(loadpath, flags)
-        if not self._handle:
-            raise HeraclesError("Unable to create Heracles object!")
+        if self._selective:
+            flags |= HERA_NO_MODL_AUTOLOAD
+        if shared:
+            self._handle = get_shared_handle(loadpath, flags)
+        else:
+            self._handle = init_handle(loadpath, flags)
+            self._owner = HeraclesHandle(self._handle)
 
-        # If init returns an error raises exception
-        self._catch_exception()
+        if self._selective:
+            for name in modules:
+                if not self._load_module(name):
+                    raise HeraclesNoLensError("No module %s" % name)
 
     def _get_load_path(self, loadpath):
         if loadpath is None:
@@ -129,13 +535,137 @@ class Heracles(object):
         base_lens_path = [os.path.join(get_heracles_path(), LENS_PATH)]
         return PATH_SEP.join(base_lens_path + loadpath)
     
-    def _catch_exception(self):
-        error = self._handle.contents.error.contents
-        code = int(error.code)
-        exception = exception_list[code]
-        if exception is not None:
-            details = str(error.details)
-            raise exception(details)
+    def _find_module_file(self, name):
+        filename = name.lower() + LENS_EXT
+        for directory in self._load_dirs:
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _load_module(self, name):
+        """
+        Loads the module ``name`` and the modules it depends on if it is not
+        loaded. Returns false if there is no file for the module.
+
+        """
+        handle = self._get_handle()
+        with _modules_lock:
+            if name.lower() in get_module_names(handle):
+                return True
+            filename = self._find_module_file(name)
+            if filename is None:
+                return False
+            if self._owner is not None and self._owner.pinned:
+                self._owner.load()
+            if load_module_file(handle, filename) < 0:
+                catch_handle_error(handle)
+                raise HeraclesError("Unable to load module %s" % name)
+        return True
+
+    def _load_all_modules(self):
+        """
+        Loads the modules of the load path that are not loaded yet.
+
+        """
+        handle = self._get_handle()
+        with _modules_lock:
+            loaded = get_module_names(handle)
+            for directory in self._load_dirs:
+                try:
+                    filenames = sorted(os.listdir(directory))
+                except OSError:
+                    continue
+                for filename in filenames:
+                    name, ext = os.path.splitext(filename)
+                    if ext != LENS_EXT or name.lower() in loaded:
+                        continue
+                    path = os.path.join(directory, filename)
+                    if self._owner is not None and self._owner.pinned:
+                        self._owner.load()
+                    if load_module_file(handle, path) < 0:
+                        catch_handle_error(handle)
+                        raise HeraclesError("Unable to load module %s" % 
+                                name)
+                    # The dependencies may have been loaded too
+                    loaded = get_module_names(handle)
+        self._all_loaded = True
+        self.lenses._load()
+
+    def _get_lens_index(self):
+        index = self.__dict__.get('_lens_index')
+        if index is None and self.lens_cache is not None:
+            index = self.lens_cache.load(self._load_dirs)
+            if index is None:
+                # Built from a new handle so the lenses are in the order 
+                # they have when all of them are loaded at init.
+                with Heracles(loadpath=self._loadpath, flags=self._flags,
+                        shared=False) as h:
+                    index = self.lens_cache.store(self._load_dirs, h.lenses)
+            self._lens_index = index
+        return index
+
+    def _get_handle(self):
+        if not self._handle:
+            raise HeraclesError("The Heracles object is closed")
+        return self._handle
+
+    def _get_resolver(self):
+        resolver = self.__dict__.get('_resolver')
+        if resolver is None:
+            if self._owner is None and not self._selective:
+                key = c.addressof(self._get_handle().contents)
+                with _shared_lock:
+                    resolver = _shared_resolvers.get(key)
+                    if resolver is None:
+                        resolver = LensResolver(self.lenses)
+                        _shared_resolvers[key] = resolver
+            else:
+                resolver = LensResolver(self.lenses)
+            self._resolver = resolver
+        return resolver
+
+    def _resolve(self, resolve, path):
+        # The resolver may be shared, so the lens is taken from the own 
+        # registry.
+        lens = resolve(path)
+        return None if lens is None else self.lenses[lens.name]
+
+    def resolve_lens(self, path):
+        """
+        Return the propper lens to parse a file given its path or ``None`` if
+        there is no lens for it.
+
+        The lens filters are compiled the first time it is called and the 
+        results are cached by path.
+
+        :param path: Path of the file which its lens we want to edit.
+        :type path: str
+        :rtype: :class:`Lens`
+
+        """
+        if not self._all_loaded:
+            index = self._get_lens_index()
+            if index is not None:
+                indexed = index.resolve(path)
+                return None if indexed is None else self.lenses[indexed.name]
+        lens = self._resolve(self._get_resolver().resolve, path)
+        if lens is None and not self._all_loaded:
+            self._load_all_modules()
+            lens = self._resolve(self._get_resolver().resolve, path)
+        return lens
+
+    def resolve_lenses(self, paths):
+        """
+        Return the list of lenses to parse the files given their paths, with
+        ``None`` in place of the paths without lens.
+
+        :param paths: Paths of the files to get their lenses.
+        :type paths: list of str
+        :rtype: list of :class:`Lens`
+
+        """
+        return [self.resolve_lens(path) for path in paths]
 
     def get_lens_by_path(self, path):
         """
@@ -145,9 +675,7 @@ class Heracles(object):
         :type path: str
 
         """
-        for lens in self.lenses:
-            if lens.check_path(path):
-                return lens
+        return self.resolve_lens(path)
 
     def parse_file_from_path(self, path):
         """
@@ -165,18 +693,74 @@ class Heracles(object):
         # to run. But manually tested.
 
         lens = self.get_lens_by_path(path)
-        text = file(path).read()
-        tree = lens.get(text)
-        tree.path = path
-        return tree
+        if lens is None:
+            raise HeraclesNoLensError("No lens for path %s" % path)
+        return batch.parse_file(self, lens, path)
+
+    def parse_paths(self, paths, workers=1, lens=None):
+        """
+        Parses several files given their paths. It is a generator that yields
+        ``(path, result)`` tuples as the files are parsed, where ``result`` is
+        the :class:`heracles.tree.Tree` of the file or the exception raised 
+        parsing it.
+
+        If ``workers`` is greater than one the files are parsed in a pool of
+        processes, each one with its own :class:`Heracles` instance, and the
+        results are yielded in the order they finish.
+
+        :param paths: Paths of the files we want to parse.
+        :type paths: iterable of str
+        :key workers: Number of worker processes.
+        :type workers: int
+        :key lens: The lens, or its name, to parse all the files with instead
+            of looking for the lens of each path.
+        :type lens: :class:`Lens` or str
+
+        """
+        return batch.parse_paths(self, paths, workers=workers, lens=lens)
+
+    def parse_directory(self, root, pattern=None, workers=1, lens=None):
+        """
+        Parses the files under the directory ``root`` that have a lens, or 
+        all of them if ``lens`` is given, in the same way as 
+        :meth:`parse_paths`.
+
+        :param root: The directory to walk.
+        :type root: str
+        :key pattern: A ``fnmatch`` pattern that the full path of the files 
+            must match.
+        :type pattern: str
+        :key workers: Number of worker processes.
+        :type workers: int
+        :key lens: The lens, or its name, to parse all the files with.
+        :type lens: :class:`Lens` or str
+
+        """
+        paths = batch.iter_directory(root, pattern)
+        if lens is None:
+            paths = [p for p in paths if self.resolve_lens(p) is not None]
+        return batch.parse_paths(self, paths, workers=workers, lens=lens)
+
+    def close(self):
+        """
+        Frees the libheracles data of the object if it is not shared. 
+        Afterwards its lenses can't be used to parse or render trees, but the
+        trees already parsed are still valid. It can be called several times.
+
+        """
+        self._handle = None
+        if self._owner is not None:
+            self._owner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __repr__(self):
         return "<Heracles object>"
 
-    def __del__(self):
-        if not disabled_lib:
-            libheracles.hera_close(self._handle)
-
 class Lens(object):
     """
     Object that stores an augeas lens parser ready to do get and put operations
@@ -200,49 +784,334 @@ class Lens(object):
         transform = self.module.autoload
         self.lens = transform.contents.lens if transform else None
         self.filter = transform.contents.filter if transform else None
+        self._lock = None
 
-    def _catch_error(self, err):
-        if err:
-            raise HeraclesLensError(err.contents.message)
+    def _get_lock(self):
+        """
+        Returns the lock held during the libheracles calls of the lens, that
+        compiles and pins it the first time, see :func:`compile_lens`. Only
+        the recursive lenses have a real lock, as libheracles changes them
+        while they are applied.
 
-    def get(self, text):
+        """
+        lock = self._lock
+        if lock is None:
+            owner = self.heracles._owner
+            with _modules_lock:
+                pinned = owner.pinned if owner is not None else None
+                if compile_lens(self.lens, pinned):
+                    key = c.addressof(self.lens.contents)
+                    lock = _recursive_locks.setdefault(key, threading.Lock())
+                else:
+                    lock = NO_LOCK
+            self._lock = lock
+        return lock
+
+    def _catch_error(self, error, call_error=None):
+        if call_error is not None and call_error.code:
+            if error:
+                free_lns_error(error)
+            catch_call_error(call_error)
+        if error:
+            message = error.contents.message
+            free_lns_error(error)
+            raise HeraclesLensError(message)
+
+    def get(self, text, lazy=False, spans=False, columnar=False):
         """
         Returns a tree from applying the lens parser to ``text``.
 
         :param text: The text to parse.
         :type text: str
+        :key lazy: If true the nodes of each level of the tree are built the 
+            first time the level is accessed, so callers that read just a few 
+            keys of a big file don't pay for building the whole tree.
+        :type lazy: bool
+        :key spans: If true the nodes store their position in ``text``, so
+            the changes of their values can be written back with 
+            ``put(tree, text, incremental=True)``.
+        :type spans: bool
+        :key columnar: If true returns a read only 
+            :class:`heracles.columnar.ColumnarTree` that stores the nodes in
+            arrays, much smaller and faster to build and scan than the 
+            regular trees. It can't be combined with ``lazy`` or ``spans``.
+        :type columnar: bool
         :rtype: :class:`heracles.tree.Tree` 
 
         """
-        hera_get = libheracles.hera_get
-        hera_get.restype = c.POINTER(struct_tree)
-        error = c.POINTER(struct_lns_error)()
-        tree_p = hera_get(self.lens, c.c_char_p(text), error)
-        self._catch_error(error)
-        return UnmanagedRawTree(tree_p, lens=self).build_tree()
+        if columnar and (lazy or spans):
+            raise HeraclesError("columnar trees can't be lazy or have spans")
+        original_text = text
+        # Lenses generally break if the text doesn't end with a newline
+        if not text.endswith("\n"):
+            text += "\n"
+        tree = self._get(text, lazy, spans, columnar)
+        if spans:
+            tree._text = original_text
+        return tree
 
-    def put(self, tree, text=""):
+    def get_file(self, path, lazy=False, columnar=False):
+        """
+        Returns a tree from applying the lens parser to the file in ``path``,
+        like :meth:`get` but without reading the file in a Python string. 
+        The file is mapped in memory and libheracles parses the mapped 
+        pages directly, so big files don't take twice their size. The 
+        returned tree stores the path so it can be saved.
+
+        The file is read as usual when it is empty, it doesn't end with a 
+        newline, or its size is a multiple of the memory page size, as the 
+        mapped text must be followed by a NUL byte. It must not be truncated
+        while it is parsed.
+
+        :param path: The path of the file to parse.
+        :type path: str
+        :key lazy: See :meth:`get`.
+        :type lazy: bool
+        :key columnar: See :meth:`get`.
+        :type columnar: bool
+        :rtype: :class:`heracles.tree.Tree`
+
+        """
+        if columnar and lazy:
+            raise HeraclesError("columnar trees can't be lazy or have spans")
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            mapped = None
+            if size % mmap.PAGESIZE != 0:
+                try:
+                    mapped = mmap.mmap(f.fileno(), size, 
+                            access=mmap.ACCESS_COPY)
+                except (EnvironmentError, ValueError):
+                    pass
+            if mapped is None:
+                tree = self.get(f.read(), lazy=lazy, columnar=columnar)
+                tree.path = path
+                return tree
+        try:
+            if mapped[size - 1] != "\n":
+                tree = self.get(mapped[:], lazy=lazy, columnar=columnar)
+            else:
+                # The pages are private copies on write, so they are 
+                # writable as the buffer needs but never written.
+                buf = c.c_char.from_buffer(mapped)
+                try:
+                    text = c.cast(c.addressof(buf), c.c_char_p)
+                    tree = self._get(text, lazy, False, columnar)
+                finally:
+                    del buf
+        finally:
+            mapped.close()
+        tree.path = path
+        return tree
+
+    def iter_records(self, source, chunk_size=RECORDS_CHUNK_SIZE):
+        """
+        Parses the file in ``source`` by pieces of about ``chunk_size`` 
+        bytes of whole lines and yields the numbered nodes of the top level 
+        of each piece, with their children, numbered as in the tree of the 
+        whole file. The rest of nodes, like the comments, are skipped.
+
+        It is meant for lenses that parse a list of records, like 
+        ``Hosts``, ``Fstab`` or ``Aptsources``, so big files can be 
+        filtered or aggregated using only the memory of a piece, and the 
+        first records are available right away::
+
+            >>> for record in h.lenses['Hosts'].iter_records("/etc/hosts"):
+            ...     print record.children['ipaddr'].value
+
+        The records are detached from the tree of their piece, like removed
+        nodes, so the piece is released after the next one is parsed and 
+        only the records kept are referenced. When a piece can't be parsed, 
+        because a record spans the lines where it was cut, it is extended 
+        with the next one, once. If it still can't be parsed
+        :class:`heracles.exceptions.HeraclesLensError` is raised with the
+        lines of the piece, and the rest of the file is not read. The
+        records must not be split in several records when they are cut, so
+        this must not be used with lenses that parse blocks of lines, like
+        ``Sshd``.
+
+        :param source: The path of the file or a file object.
+        :type source: str or file
+        :key chunk_size: The approximate size of every piece in bytes.
+        :type chunk_size: int
+        :rtype: generator of :class:`heracles.tree.TreeNode`
+
+        """
+        if isinstance(source, basestring):
+            with open(source, "rb") as f:
+                for record in self._iter_records(f, chunk_size):
+                    yield record
+        else:
+            for record in self._iter_records(source, chunk_size):
+                yield record
+
+    def _iter_records(self, fileobj, chunk_size):
+        number = 0
+        # Number of the first line of the pending piece
+        first_line = 1
+        pending = []
+        extended = False
+        while True:
+            lines = fileobj.readlines(chunk_size)
+            pending.extend(lines)
+            if not pending:
+                return
+            try:
+                tree = self.get("".join(pending))
+            except HeraclesLensError as e:
+                if lines and not extended:
+                    extended = True
+                    continue
+                raise HeraclesLensError("%s, in lines %d to %d" % (e, 
+                    first_line, first_line + len(pending) - 1))
+            first_line += len(pending)
+            pending = []
+            extended = False
+            nodes = [node for node in tree._nodes if check_int(node._label)]
+            tree = None
+            for node in nodes:
+                number += 1
+                node._tree = None
+                node.label = str(number)
+                yield node
+            nodes = None
+
+    def _get(self, text, lazy, spans, columnar):
+        handle = self.heracles._get_handle()
+        lock = self._get_lock()
+        # Every call has its own error, instead of the one of the handle
+        handle_error = handle.contents.error.contents
+        call_error = struct_error(hera=handle_error.hera, exn=handle_error.exn)
+        info = struct_info()
+        info.error = c.pointer(call_error)
+        info.first_line = 1
+        info.ref = REF_MAX
+        if spans:
+            info.flags = HERA_ENABLE_SPAN
+        error = struct_lns_error_p()
+        timing = instrument.start()
+        with lock:
+            tree_p = lns_get(c.byref(info), self.lens, text, c.byref(error))
+        raw_tree = UnmanagedRawTree(tree_p, lens=self)
+        self._catch_error(error, call_error)
+        if timing is not None:
+            timing.lap('parse')
+        tree = raw_tree.build_tree(lazy=lazy, spans=spans, columnar=columnar)
+        if timing is not None:
+            timing.lap('build')
+            timing.measures['nodes'] = instrument.count_nodes(tree)
+            instrument.record('get', self.name, timing.measures)
+        return tree
+
+    def put(self, tree, text="", incremental=False):
         """
         Returns the dumped data from the tree after applying the inverse
         lens parser to the lens.
 
         If ``text`` is given it uses it to merge with the data of the tree.
 
+        If ``incremental`` is true and the tree was got from ``text`` with
+        spans, the changed values are written over the original ones in 
+        ``text`` without rendering the whole tree. It falls back to the full
+        rendering when nodes were added, removed or relabeled, or the 
+        original value of a changed node is empty, not stored verbatim in 
+        the text, or the new one has a newline. As the new values are not 
+        checked by the lens they must be valid for it.
+
         :param tree: The tree from to generate the text.
         :type tree: :class:`heracles.tree.Tree`
         :key text: Optional text to merge in the generation.
         :type text: str
+        :key incremental: Write only the changed values if it is possible.
+        :type incremental: bool
         :rtype: str
 
         """
-        raw_tree = ManagedRawTree.build_from_tree(tree)
-        hera_put = libheracles.hera_put
-        hera_put.restype = c.c_char_p
-        error = c.POINTER(struct_lns_error)()
-        result = hera_put(self.lens, raw_tree.first, c.c_char_p(text), error)
-        self._catch_error(error)
+        self.heracles._get_handle()
+        timing = instrument.start()
+        if incremental:
+            result = tree._splice_changes(text)
+            if result is not None:
+                if timing is not None:
+                    timing.lap('splice')
+                    timing.measures['size'] = len(result)
+                    instrument.record('put', self.name, timing.measures)
+                return result
+        return self._put(tree, text, timing, read_buffer)
+
+    def put_file(self, tree, fileobj, text=""):
+        """
+        Renders the tree like :meth:`put` and writes the result to 
+        ``fileobj`` straight from the libheracles buffer, without building
+        a Python string. Nothing is written if the tree can't be rendered.
+        Returns the number of bytes written.
+
+        :param tree: The tree from to generate the text.
+        :type tree: :class:`heracles.tree.Tree`
+        :param fileobj: The file object or descriptor to write to.
+        :type fileobj: file or int
+        :key text: Optional text to merge in the generation.
+        :type text: str
+        :rtype: int
+
+        """
+        self.heracles._get_handle()
+        if isinstance(fileobj, (int, long)):
+            fd = fileobj
+        else:
+            fileobj.flush()
+            fd = fileobj.fileno()
+        return self._put(tree, text, instrument.start(),
+                lambda buf, size: write_buffer(fd, buf, size))
+
+    def _put(self, tree, text, timing, output):
+        """
+        Renders ``tree`` and returns ``output(buf, size)`` of the buffer 
+        with the result, that is freed afterwards.
+
+        Unlike ``lns_get``, ``lns_put`` takes no info of the call, so the 
+        internal errors of the parse of ``text``, like running out of 
+        memory, are stored in the error of the handle shared by all the
+        calls. They are not reported by this call, the lens errors are.
+
+        """
+        lock = self._get_lock()
+        raw_tree = get_raw_tree_from_tree(tree)
+        if timing is not None:
+            timing.lap('build')
+        ms = struct_memstream()
+        if init_memstream(c.byref(ms)) < 0:
+            raise MemoryError("Unable to create the output stream")
+        error = struct_lns_error_p()
+        with lock:
+            lns_put(ms.stream, self.lens, raw_tree.first, text, 
+                    c.byref(error))
+        closed = close_memstream(c.byref(ms))
+        try:
+            self._catch_error(error)
+            if closed < 0:
+                raise MemoryError("Unable to write the output stream")
+            size = ms.size
+            result = output(ms.buf, size)
+        finally:
+            free(ms.buf)
+        if timing is not None:
+            timing.lap('render')
+            timing.measures['size'] = size
+            instrument.record('put', self.name, timing.measures)
         return result
 
+    def get_filters(self):
+        """
+        Returns the globs of the lens filter as ``(glob, include)`` tuples, 
+        where ``include`` is false for the globs of excluded paths.
+
+        :rtype: list of tuples
+
+        """
+        return [(f.contents.glob.contents.str, f.contents.include == 1)
+                for f in self._iter_filters()]
+
     def _iter_filters(self):
         filter = self.filter
         while True:
@@ -0,0 +1,265 @@
+"""
+This module is intended to be use only for internal pourposes of
+the Heracles library.
+
+It includes the functions used by :class:`heracles.base.Heracles` to parse
+many files at once, optionally spreading the work over a pool of worker
+processes. As the libheracles state can't be shared between processes, each
+worker holds its own :class:`heracles.base.Heracles` instance, that reuses the
+lenses loaded by the parent before forking, and sends back the serialized
+trees.
+
+It also includes :func:`save_all`, that saves many trees at once.
+"""
+
+import os
+from fnmatch import fnmatch
+from multiprocessing import Pool
+from heracles.exceptions import (HeraclesNoLensError, HeraclesTreeError,
+        HeraclesSaveError)
+from heracles.tree import get_tree_from_serialized
+from heracles.columnar import ColumnarTree
+from heracles.cache import content_digest
+from heracles.util import stage_file, commit_files, discard_files
+
+# The Heracles instance of a worker process
+_worker_heracles = None
+
+def _init_worker(loadpath, flags, modules):
+    global _worker_heracles
+    from heracles.base import Heracles
+    _worker_heracles = Heracles(loadpath=loadpath, flags=flags, 
+            modules=modules)
+
+def _parse_in_worker(job):
+    path, lens_name = job
+    try:
+        st = os.stat(path)
+        with open(path) as f:
+            text = f.read()
+        tree = _worker_heracles.lenses[lens_name].get(text)
+        result = (tree.serialize(), st, content_digest(text))
+        return path, lens_name, result, None
+    except Exception as e:
+        return path, lens_name, None, e
+
+def _put_in_worker(job):
+    from heracles.base import Heracles
+    index, (loadpath, flags, modules), lens_name, data = job
+    try:
+        h = Heracles(loadpath=loadpath, flags=flags, modules=modules)
+        tree = get_tree_from_serialized(data, lens=h.lenses[lens_name])
+        return index, tree.put(), None
+    except Exception as e:
+        return index, None, e
+
+def parse_path(lens, path):
+    """
+    Returns the tree of the file in ``path`` parsed with ``lens``.
+
+    """
+    return lens.get_file(path)
+
+def parse_file(heracles, lens, path):
+    """
+    Returns the tree of the file in ``path`` parsed with ``lens`` through the
+    cache of ``heracles`` if it has one.
+
+    """
+    if heracles.cache is not None:
+        return heracles.cache.parse_file(lens, path)
+    return parse_path(lens, path)
+
+def iter_directory(root, pattern=None):
+    """
+    Iterates over the paths of the files under ``root`` that match the
+    ``fnmatch`` pattern ``pattern`` if it is given.
+
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if pattern is None or fnmatch(path, pattern):
+                yield path
+
+def parse_paths(heracles, paths, workers=1, lens=None):
+    """
+    Parses the files in ``paths`` with the lenses of ``heracles`` yielding
+    ``(path, tree_or_error)`` tuples as they finish. See
+    :meth:`heracles.base.Heracles.parse_paths`.
+
+    """
+    if lens is not None and not isinstance(lens, basestring):
+        lens = lens.name
+    jobs = []
+    for path in paths:
+        lens_name = lens
+        if lens_name is None:
+            path_lens = heracles.resolve_lens(path)
+            if path_lens is None:
+                yield path, HeraclesNoLensError("No lens for path %s" % path)
+                continue
+            lens_name = path_lens.name
+        jobs.append((path, lens_name))
+
+    if workers is None or workers <= 1 or len(jobs) <= 1:
+        for path, lens_name in jobs:
+            try:
+                yield path, parse_file(heracles, heracles.lenses[lens_name], 
+                        path)
+            except Exception as e:
+                yield path, e
+        return
+
+    cache = heracles.cache
+    if cache is not None:
+        missed = []
+        for path, lens_name in jobs:
+            tree = cache.load_file(heracles.lenses[lens_name], path)
+            if tree is not None:
+                yield path, tree
+            else:
+                missed.append((path, lens_name))
+        jobs = missed
+        if not jobs:
+            return
+
+    chunksize = max(1, len(jobs) // (workers * 4))
+    # The workers inherit the lenses loaded before starting the pool.
+    from heracles.base import preload
+    preload(heracles._loadpath, heracles._flags, heracles._modules)
+    pool = Pool(workers, _init_worker, (heracles._loadpath, heracles._flags,
+        heracles._modules))
+    try:
+        results = pool.imap_unordered(_parse_in_worker, jobs, chunksize)
+        for path, lens_name, result, error in results:
+            if error is not None:
+                yield path, error
+                continue
+            data, st, digest = result
+            lens = heracles.lenses[lens_name]
+            if cache is not None:
+                cache.store(lens, digest, data)
+                cache.store_file(lens, path, st, digest)
+            tree = get_tree_from_serialized(data, lens=lens)
+            tree.path = path
+            yield path, tree
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _get_heracles_key(heracles):
+    modules = heracles._modules
+    return (heracles._loadpath, heracles._flags, 
+            None if modules is None else list(modules))
+
+def render_trees(trees, workers=1):
+    """
+    Returns the list of texts to save of ``trees``, with ``None`` for the
+    trees whose file doesn't need to be written. See :func:`save_all`.
+
+    """
+    if workers is None or workers <= 1:
+        return [tree._render_changes() for tree in trees]
+    dumps = [None] * len(trees)
+    jobs = []
+    instances = {}
+    for index, tree in enumerate(trees):
+        if isinstance(tree, ColumnarTree):
+            # Raises the read only error as the sequential rendering
+            tree._render_changes()
+        if tree.path is None:
+            raise HeraclesTreeError("Unable to dump to a file withot a given path")
+        if tree.lens is None:
+            raise HeraclesTreeError("Unable to put. This tree has no lens")
+        if tree.is_dirty or not os.path.exists(tree.path):
+            instances[id(tree.lens.heracles)] = tree.lens.heracles
+            jobs.append((index, _get_heracles_key(tree.lens.heracles), 
+                tree.lens.name, tree.serialize()))
+    if len(jobs) <= 1:
+        for job in jobs:
+            dumps[job[0]] = trees[job[0]]._render_changes()
+        return dumps
+    # The workers inherit the lenses loaded before starting the pool.
+    from heracles.base import preload
+    for heracles in instances.values():
+        preload(*_get_heracles_key(heracles))
+    pool = Pool(workers)
+    try:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        for index, dump, error in pool.imap_unordered(_put_in_worker, jobs, 
+                chunksize):
+            if error is not None:
+                raise error
+            dumps[index] = trees[index]._check_dump(dump)
+    finally:
+        pool.terminate()
+        pool.join()
+    return dumps
+
+def save_all(trees, workers=1, sync=True):
+    """
+    Saves the changes of several trees with a ``path``, replacing every 
+    file atomically. All the 
+    trees are rendered first, optionally spreading the work over ``workers``
+    processes, so if any of them fails no file is written. Then they are 
+    written to temporary files that are renamed over the original ones, and
+    every directory is synced once.
+
+    The renames are not atomic as a whole: if one of them fails the files 
+    renamed before stay replaced and the rest are not written. Then 
+    :class:`heracles.exceptions.HeraclesSaveError` is raised with the paths
+    of the replaced files in its ``committed`` attribute, and the changes of
+    their trees are cleared as if they were saved alone. Several trees with
+    the same ``path`` are rejected before anything is rendered.
+
+    As with :meth:`heracles.tree.Tree.save`, the trees that didn't change 
+    and the ones whose rendered text is the same as the file contents are
+    not written.
+
+    :param trees: The trees to save.
+    :type trees: iterable of :class:`heracles.tree.Tree`
+    :key workers: The number of processes used to render the trees.
+    :type workers: ``int``
+    :key sync: If ``False`` the files and directories are not synced.
+    :type sync: ``bool``
+    :rtype: list of the paths of the written files.
+
+    """
+    trees = list(trees)
+    paths = set()
+    for tree in trees:
+        if tree.path is not None:
+            path = os.path.realpath(tree.path)
+            if path in paths:
+                raise HeraclesSaveError("Several trees have the path %s" % 
+                        tree.path)
+            paths.add(path)
+    dumps = render_trees(trees, workers=workers)
+    staged = []
+    staged_trees = []
+    try:
+        for tree, dump in zip(trees, dumps):
+            if dump is not None:
+                staged.append(stage_file(tree.path, dump, sync=sync))
+                staged_trees.append(tree)
+    except:
+        discard_files(staged)
+        raise
+    committed = []
+    try:
+        commit_files(staged, sync=sync, committed=committed)
+    except EnvironmentError as e:
+        written = staged_trees[:len(committed)]
+        for tree, dump in zip(trees, dumps):
+            if dump is None:
+                tree._reset_changes()
+        for tree in written:
+            tree._reset_changes()
+        raise HeraclesSaveError("Unable to save %s: %s" % (
+            staged_trees[len(committed)].path, e), 
+            [tree.path for tree in written])
+    for tree in trees:
+        tree._reset_changes()
+    return [tree.path for tree, dump in zip(trees, dumps) if dump is not None]
@@ -0,0 +1,265 @@
+"""
+This module includes :class:`ParseCache`, an optional disk cache of parsed
+trees that allows skipping libheracles when the same files are parsed again.
+
+The trees are stored in the format of :meth:`heracles.tree.Tree.serialize`
+pickled, and are keyed by the lens name, a fingerprint of the lens sources
+and the hash of the parsed text::
+
+    >>> from heracles import Heracles
+    >>> from heracles.cache import ParseCache
+    >>> h = Heracles(cache=ParseCache("/var/cache/heracles"))
+    >>> t = h.parse_file_from_path("/etc/apt/sources.list")
+
+To avoid reading and hashing unchanged files, the size, modification time
+and inode of the files parsed through :meth:`ParseCache.parse_file` are
+also stored, so a file that didn't change is loaded straight from the cache.
+
+When the size of the cache grows over ``max_size`` the least recently used
+entries are removed.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from heracles.tree import get_tree_from_serialized
+from heracles.util import get_lens_fingerprint
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+TREE_PREFIX = "t-"
+STAT_PREFIX = "s-"
+TMP_PREFIX = ".tmp-"
+
+# Files modified less than this seconds ago are not stored by its stat
+# metadata as they could be changed again without changing their mtime.
+RACY_DELAY = 2
+
+def content_digest(text):
+    """
+    Returns the hash used to key the text of the parsed files.
+
+    """
+    return hashlib.sha1(text).hexdigest()
+
+def stat_key(st):
+    return (st.st_size, st.st_mtime, st.st_ino, st.st_dev)
+
+class ParseCache(object):
+    """
+    Disk cache of the trees returned by :meth:`heracles.base.Lens.get`.
+
+    """
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param directory: The directory where the entries are stored, it is
+            created if it doesn't exist.
+        :type directory: str
+        :param max_size: The maximum size in bytes of the stored entries.
+        :type max_size: int
+
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self._fingerprints = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # Keys
+
+    def _lens_fingerprint(self, lens):
+        """
+        Returns a hash of the lens sources that changes whenever any of the
+        modules in the load path of the lens changes.
+
+        """
+        load_dirs = tuple(lens.heracles._load_dirs)
+        fingerprint = self._fingerprints.get(load_dirs)
+        if fingerprint is None:
+            fingerprint = get_lens_fingerprint(load_dirs)
+            self._fingerprints[load_dirs] = fingerprint
+        return fingerprint
+
+    def _tree_key(self, lens, digest):
+        key = "%s\0%s\0%s" % (lens.name, self._lens_fingerprint(lens), digest)
+        return TREE_PREFIX + hashlib.sha1(key).hexdigest()
+
+    def _stat_key(self, lens, path):
+        key = "%s\0%s\0%s" % (lens.name, self._lens_fingerprint(lens),
+                os.path.abspath(path))
+        return STAT_PREFIX + hashlib.sha1(key).hexdigest()
+
+    # Storage
+
+    def _read(self, key):
+        filename = os.path.join(self.directory, key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        try:
+            return loads(data)
+        except Exception:
+            return None
+
+    def _write(self, key, value):
+        data = dumps(value, HIGHEST_PROTOCOL)
+        fd, tmp_name = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            filename = os.path.join(self.directory, key)
+            try:
+                old_size = os.path.getsize(filename)
+            except OSError:
+                old_size = 0
+            os.rename(tmp_name, filename)
+        except:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        self._add_size(len(data) - old_size)
+
+    def _entries(self):
+        result = []
+        for name in os.listdir(self.directory):
+            if name.startswith(TMP_PREFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            result.append((st.st_mtime, st.st_size, name))
+        return result
+
+    def _add_size(self, size):
+        if self._size is None:
+            self._size = sum(e[1] for e in self._entries())
+        else:
+            self._size += size
+        if self._size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        size = sum(e[1] for e in entries)
+        for mtime, entry_size, name in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        """
+        Removes all the entries of the cache.
+
+        """
+        for mtime, size, name in self._entries():
+            os.remove(os.path.join(self.directory, name))
+        self._size = 0
+
+    # Trees
+
+    def load(self, lens, digest):
+        """
+        Returns the stored tree of the text with hash ``digest`` parsed with
+        ``lens`` or ``None`` if it is not in the cache.
+
+        """
+        data = self._read(self._tree_key(lens, digest))
+        if data is None:
+            return None
+        return get_tree_from_serialized(data, lens=lens)
+
+    def store(self, lens, digest, data):
+        """
+        Stores the serialized tree ``data`` of the text with hash ``digest``
+        parsed with ``lens``.
+
+        """
+        self._write(self._tree_key(lens, digest), data)
+
+    def get(self, lens, text):
+        """
+        Returns the tree of ``text`` parsed with ``lens``, from the cache if
+        it is stored, otherwise using :meth:`heracles.base.Lens.get` and
+        storing the result.
+
+        :param lens: The lens to parse the text with.
+        :type lens: :class:`heracles.base.Lens`
+        :param text: The text to parse.
+        :type text: str
+        :rtype: :class:`heracles.tree.Tree`
+
+        """
+        digest = content_digest(text)
+        tree = self.load(lens, digest)
+        if tree is None:
+            tree = lens.get(text)
+            self.store(lens, digest, tree.serialize())
+        return tree
+
+    # Files
+
+    def load_file(self, lens, path):
+        """
+        Returns the stored tree of the file in ``path`` if it didn't change
+        since it was stored, otherwise ``None``.
+
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self._read(self._stat_key(lens, path))
+        if entry is None or entry[0] != stat_key(st):
+            return None
+        tree = self.load(lens, entry[1])
+        if tree is not None:
+            tree.path = path
+        return tree
+
+    def store_file(self, lens, path, st, digest):
+        """
+        Records that the file in ``path`` with ``os.stat`` result ``st`` has
+        the contents with hash ``digest``.
+
+        """
+        if time.time() - st.st_mtime < RACY_DELAY:
+            return
+        self._write(self._stat_key(lens, path), (stat_key(st), digest))
+
+    def parse_file(self, lens, path):
+        """
+        Returns the tree of the file in ``path`` parsed with ``lens``. If the
+        size, modification time and inode of the file didn't change since it
+        was stored, the file is not even read.
+
+        :param lens: The lens to parse the file with.
+        :type lens: :class:`heracles.base.Lens`
+        :param path: The path of the file to parse.
+        :type path: str
+        :rtype: :class:`heracles.tree.Tree`
+
+        """
+        tree = self.load_file(lens, path)
+        if tree is not None:
+            return tree
+        st = os.stat(path)
+        with open(path) as f:
+            text = f.read()
+        tree = self.get(lens, text)
+        self.store_file(lens, path, st, content_digest(text))
+        tree.path = path
+        return tree
+
+    def __repr__(self):
+        return "<%s '%s'>" % (self.__class__.__name__, self.directory)
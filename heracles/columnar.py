@@ -0,0 +1,545 @@
+"""
+This module includes :class:`ColumnarTree`, a read only tree backend that
+stores a parsed file in a few parallel arrays instead of a graph of
+:class:`heracles.tree.TreeNode` objects::
+
+    >>> from heracles import Heracles
+    >>> h = Heracles()
+    >>> t = h.lenses['Aptsources'].get(text, columnar=True)
+    >>> t[0].children['distribution'].value
+    'squeeze'
+
+The nodes are numbered in the order they appear in the text, and for each
+one the :class:`TreeColumns` store the index of its parent, first child and
+next sibling, the id of its label in a table of distinct labels, and the
+position of its value in the string table exported by libheracles.
+
+The :class:`ColumnarTree`, :class:`ColumnarListTree` and
+:class:`ColumnarNode` objects are light views over the arrays created as
+they are accessed, that have the same read methods as
+:class:`heracles.tree.Tree`, :class:`heracles.tree.ListTree` and
+:class:`heracles.tree.TreeNode`, and the labels are still accessed with
+:class:`heracles.tree.LabelNodeList`. Trees that have to be changed can be
+copied to regular trees with :meth:`ColumnarTree.to_tree`.
+"""
+
+from array import array
+from itertools import izip
+from heracles.exceptions import HeraclesTreeError
+from heracles.tree import LabelNodeList, intern_label
+from heracles.util import check_int, str_tree
+from heracles.query import get_predicate
+from heracles.pathx import compile_path
+
+# Each record of a flattened tree, see :func:`heracles.raw.export_tree`
+RECORD_FIELDS = 5
+# Index of the missing nodes in the arrays
+NONE = -1
+
+class TreeColumns(object):
+    """
+    The arrays that store the nodes of a :class:`ColumnarTree`.
+
+    """
+    __slots__ = ('parents', 'first_children', 'next_siblings', 'labels',
+            'value_offsets', 'value_lengths', 'strings', 'label_table',
+            'label_ids', 'first')
+
+    @classmethod
+    def build(cls, records, strings):
+        """
+        Builds the columns from the flattened tree ``records`` and its
+        ``strings`` table.
+
+        """
+        n = len(records) // RECORD_FIELDS
+        columns = cls()
+        parents = columns.parents = array('i', [NONE]) * n
+        first_children = columns.first_children = array('i', [NONE]) * n
+        next_siblings = columns.next_siblings = array('i', [NONE]) * n
+        labels = columns.labels = array('i', [0]) * n
+        columns.value_offsets = array('i', records[3::RECORD_FIELDS])
+        columns.value_lengths = array('i', records[4::RECORD_FIELDS])
+        columns.strings = strings
+        label_table = columns.label_table = []
+        label_ids = columns.label_ids = {}
+        # ``last`` stores the last child found of every node, shifted by
+        # one so the last node of the first level is at position 0.
+        last = array('i', [NONE]) * (n + 1)
+        ancestors = []
+        columns.first = NONE
+        it = iter(records)
+        for i, (depth, l_off, l_len, v_off, v_len) in enumerate(izip(it, it,
+                it, it, it)):
+            del ancestors[depth:]
+            parent = ancestors[-1] if ancestors else NONE
+            parents[i] = parent
+            previous = last[parent + 1]
+            if previous != NONE:
+                next_siblings[previous] = i
+            elif parent != NONE:
+                first_children[parent] = i
+            else:
+                columns.first = i
+            last[parent + 1] = i
+            ancestors.append(i)
+            label = strings[l_off:l_off + l_len] if l_len >= 0 else None
+            label_id = label_ids.get(label)
+            if label_id is None:
+                label_id = label_ids[label] = len(label_table)
+                label_table.append(intern_label(label))
+            labels[i] = label_id
+        return columns
+
+    def __len__(self):
+        return len(self.parents)
+
+    def get_label(self, index):
+        return self.label_table[self.labels[index]]
+
+    def get_value(self, index):
+        length = self.value_lengths[index]
+        if length < 0:
+            return None
+        offset = self.value_offsets[index]
+        return self.strings[offset:offset + length]
+
+    def iter_level(self, first):
+        """
+        Iterates over the indexes of ``first`` and its next siblings.
+
+        """
+        next_siblings = self.next_siblings
+        index = first
+        while index != NONE:
+            yield index
+            index = next_siblings[index]
+
+    def first_child(self, parent):
+        return self.first if parent == NONE else self.first_children[parent]
+
+    def serialize(self, first):
+        """
+        Returns the level starting at ``first`` in the format of
+        :meth:`heracles.tree.Tree.serialize`.
+
+        """
+        result = []
+        label_table = self.label_table
+        labels = self.labels
+        first_children = self.first_children
+        for index in self.iter_level(first):
+            result.append({'label': label_table[labels[index]],
+                'value': self.get_value(index),
+                'children': self.serialize(first_children[index])})
+        return result
+
+    def export(self, parent=NONE):
+        """
+        Flattens the subtree below ``parent`` into records and a string
+        table, see :func:`heracles.raw.flatten_nodes`.
+
+        """
+        label_offsets = []
+        offset = len(self.strings)
+        for label in self.label_table:
+            label_offsets.append(offset)
+            offset += len(label) if label is not None else 0
+        label_table = self.label_table
+        labels = self.labels
+        value_offsets = self.value_offsets
+        value_lengths = self.value_lengths
+        first_children = self.first_children
+        records = array('i')
+        stack = [(self.first_child(parent), 0)]
+        while stack:
+            index, depth = stack.pop()
+            if index == NONE:
+                continue
+            label = label_table[labels[index]]
+            records.extend((depth, label_offsets[labels[index]],
+                len(label) if label is not None else -1,
+                value_offsets[index], value_lengths[index]))
+            stack.append((self.next_siblings[index], depth))
+            stack.append((first_children[index], depth + 1))
+        strings = self.strings + "".join(l for l in label_table
+                if l is not None)
+        return records, strings
+
+def is_list_level(columns, first):
+    """
+    The same check of :func:`heracles.tree.check_list_nodes` over the level
+    starting at ``first``.
+
+    """
+    value = 1
+    for index in columns.iter_level(first):
+        try:
+            if int(columns.get_label(index)) == value:
+                value += 1
+            else:
+                return False
+        except:
+            pass
+    return value != 1
+
+def get_level(columns, parent_node, lens=None, path=None):
+    """
+    Returns the :class:`ColumnarTree` or :class:`ColumnarListTree` view of
+    the children of ``parent_node``, or of the first level if it is
+    ``None``.
+
+    """
+    parent = NONE if parent_node is None else parent_node._index
+    if is_list_level(columns, columns.first_child(parent)):
+        cls = ColumnarListTree
+    else:
+        cls = ColumnarTree
+    return cls(columns, parent_node, lens=lens, path=path)
+
+def _read_only(self, *args, **kwargs):
+    raise HeraclesTreeError("Columnar trees are read only, use to_tree()")
+
+class ColumnarNode(object):
+    """
+    Read only view of a node of a :class:`ColumnarTree`.
+
+    """
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def _get_label(self):
+        return self._columns.get_label(self._index)
+
+    def _get_value(self):
+        return self._columns.get_value(self._index)
+
+    label = property(_get_label, _read_only)
+    value = property(_get_value, _read_only)
+
+    @property
+    def parent(self):
+        """
+        The parent :class:`ColumnarNode` or ``None`` in the first level.
+
+        """
+        parent = self._columns.parents[self._index]
+        return None if parent == NONE else ColumnarNode(self._columns, parent)
+
+    @property
+    def children(self):
+        """
+        The :class:`ColumnarTree` or :class:`ColumnarListTree` of the
+        children nodes.
+
+        """
+        return get_level(self._columns, self)
+
+    def _get_children(self):
+        if self._columns.first_children[self._index] == NONE:
+            return None
+        return self.children
+
+    def _get_child_nodes(self):
+        columns = self._columns
+        return [ColumnarNode(columns, index) for index in
+                columns.iter_level(columns.first_children[self._index])]
+
+    def serialize(self):
+        columns = self._columns
+        return {'label': self.label, 'value': self.value,
+                'children': columns.serialize(
+                    columns.first_children[self._index])}
+
+    def __eq__(self, other):
+        return isinstance(other, ColumnarNode) and \
+                self._columns is other._columns and self._index == other._index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._columns), self._index))
+
+    def __repr__(self):
+        return "<%s label:'%s' value:'%s' children:%d>" % (
+                self.__class__.__name__, self.label, self.value,
+                len(self._get_child_nodes()))
+
+class ColumnarTree(object):
+    """
+    Read only view of a level of a tree stored in :class:`TreeColumns`,
+    with the read methods of :class:`heracles.tree.Tree`.
+
+    """
+    __slots__ = ('_columns', 'parent', 'lens', 'path', '_level', '_labels')
+
+    def __init__(self, columns, parent=None, lens=None, path=None):
+        """
+        :param columns: The arrays of the nodes.
+        :type columns: :class:`TreeColumns`
+        :param parent: If it is a children tree, the parent node.
+        :type parent: :class:`ColumnarNode`
+        :param lens: If it is a master tree, the lens it was parsed with.
+        :type lens: :class:`heracles.base.Lens`
+        :param path: If it is a master tree, the path of the parsed file.
+        :type path: ``str``
+
+        """
+        self._columns = columns
+        self.parent = parent
+        self.lens = lens
+        self.path = path
+        self._level = None
+        self._labels = None
+
+    def _get_level(self):
+        if self._level is None:
+            columns = self._columns
+            parent = NONE if self.parent is None else self.parent._index
+            self._level = array('i', columns.iter_level(
+                columns.first_child(parent)))
+        return self._level
+
+    def _get_nodes(self, indexes):
+        columns = self._columns
+        return [ColumnarNode(columns, index) for index in indexes]
+
+    def _label_nodes(self, label):
+        if self._labels is None:
+            self._labels = {}
+            labels = self._columns.labels
+            for index in self._get_level():
+                self._labels.setdefault(labels[index], []).append(index)
+        label_id = self._columns.label_ids.get(label)
+        return self._get_nodes(self._labels.get(label_id, ()))
+
+    @property
+    def _nodes(self):
+        return self._get_nodes(self._get_level())
+
+    def _get_item_by_integer(self, index):
+        level = self._get_level()
+        if index < 0:
+            index = len(level) + index
+        if not 0 <= index < len(level):
+            raise IndexError("Tree index out of range")
+        return ColumnarNode(self._columns, level[index])
+
+    def _splice_changes(self, text):
+        return None
+
+    def _export_records(self):
+        parent = NONE if self.parent is None else self.parent._index
+        return self._columns.export(parent)
+
+    @property
+    def is_dirty(self):
+        return False
+
+    def changed_nodes(self):
+        return []
+
+    def has_key(self, name):
+        """
+        Checks if the tree has any node with label ``name``.
+
+        """
+        assert(isinstance(name, str) or isinstance(name, int))
+        if isinstance(name, int):
+            name = str(name)
+        return len(self._label_nodes(name)) > 0
+
+    def index(self, node):
+        """
+        If the tree stores ``node`` returns its position in the tree.
+
+        """
+        try:
+            return self._nodes.index(node)
+        except ValueError:
+            raise ValueError('Node not in tree')
+
+    def match(self, path):
+        """
+        Returns the list of nodes selected by the path expression ``path``,
+        see :meth:`heracles.tree.Tree.match`.
+
+        """
+        return compile_path(path).match(self)
+
+    def get(self, path):
+        """
+        Returns the value of the node selected by the path expression
+        ``path``, see :meth:`heracles.tree.Tree.get`.
+
+        """
+        return compile_path(path).get(self)
+
+    def put(self, text="", incremental=False):
+        """
+        Renders back the tree to text applying the lens parser. As the tree
+        can't change ``incremental`` is ignored.
+
+        """
+        if self.lens is None:
+            raise HeraclesTreeError("Unable to put. This tree has no lens")
+        return self.lens.put(self, text)
+
+    def to_tree(self):
+        """
+        Returns a regular :class:`heracles.tree.Tree` or
+        :class:`heracles.tree.ListTree` with a copy of the nodes, that can be
+        changed and saved.
+
+        """
+        from heracles.raw import get_nodes_from_records
+        from heracles.tree import get_tree_from_nodes
+        records, strings = self._export_records()
+        tree = get_tree_from_nodes(get_nodes_from_records(records, strings),
+                lens=self.lens)
+        tree.path = self.path
+        return tree
+
+    def serialize(self):
+        parent = NONE if self.parent is None else self.parent._index
+        return self._columns.serialize(self._columns.first_child(parent))
+
+    insert = append = remove = add_new_node = insert_new_node = \
+            add_new_list_node = insert_new_list_node = save = set = \
+            _render_changes = _check_dump = __setitem__ = __delitem__ = \
+            _read_only
+
+    def __iter__(self):
+        columns = self._columns
+        for index in self._get_level():
+            yield ColumnarNode(columns, index)
+
+    def __getitem__(self, name):
+        if isinstance(name, basestring):
+            return LabelNodeList.build(self, name)
+        elif isinstance(name, int):
+            return self._get_item_by_integer(name)
+        else:
+            raise KeyError("Unsupported key type '%s'" % str(type(name)))
+
+    def __contains__(self, value):
+        if isinstance(value, ColumnarNode):
+            return value in self._nodes
+        elif isinstance(value, str):
+            return len(self._label_nodes(value)) > 0
+        else:
+            raise HeraclesTreeError('Unsupported type')
+
+    def __len__(self):
+        return len(self._get_level())
+
+    def __str__(self):
+        return str_tree(self)
+
+    def __repr__(self):
+        return "<%s nodes:%s>" % (self.__class__.__name__, ",".join(map(str,
+            self._nodes)))
+
+class ColumnarListTree(ColumnarTree):
+    """
+    Read only view of a level of numbered nodes, with the read methods of
+    :class:`heracles.tree.ListTree`. Integer indexes, iteration and length
+    refer to the numbered nodes only.
+
+    """
+    __slots__ = ('_indexed',)
+
+    def __init__(self, columns, parent=None, lens=None, path=None):
+        super(ColumnarListTree, self).__init__(columns, parent=parent,
+                lens=lens, path=path)
+        self._indexed = None
+
+    def _get_indexed(self):
+        if self._indexed is None:
+            columns = self._columns
+            self._indexed = array('i', (index for index in self._get_level()
+                if check_int(columns.get_label(index))))
+        return self._indexed
+
+    def _label_nodes(self, label):
+        if check_int(label):
+            indexed = self._get_indexed()
+            index = int(label) - 1
+            if 0 <= index < len(indexed):
+                return [ColumnarNode(self._columns, indexed[index])]
+            return []
+        return super(ColumnarListTree, self)._label_nodes(label)
+
+    def _get_item_by_integer(self, index):
+        indexed = self._get_indexed()
+        if index < 0:
+            index = len(indexed) + index
+        if not 0 <= index < len(indexed):
+            raise IndexError('Index out of range')
+        return ColumnarNode(self._columns, indexed[index])
+
+    def search(self, **key_values):
+        """
+        Returns the list of numbered nodes that have children with the given
+        labels and values, see :meth:`heracles.tree.ListTree.search`. The
+        values can be predicates of :mod:`heracles.query` too.
+
+        """
+        columns = self._columns
+        master_value = key_values.pop("__value", None)
+        if master_value is not None:
+            master_value = get_predicate(master_value)
+        keys = []
+        for key, value in key_values.iteritems():
+            label_id = columns.label_ids.get(key)
+            if label_id is None:
+                return []
+            keys.append((label_id, get_predicate(value)))
+        labels = columns.labels
+        first_children = columns.first_children
+        result = []
+        for row in self._get_indexed():
+            if master_value is not None and \
+                    not master_value.match(columns.get_value(row)):
+                continue
+            children = [(labels[i], i) for i in
+                    columns.iter_level(first_children[row])]
+            for label_id, predicate in keys:
+                for child_label, child in children:
+                    if child_label == label_id and \
+                            predicate.match(columns.get_value(child)):
+                        break
+                else:
+                    break
+            else:
+                result.append(ColumnarNode(columns, row))
+        return result
+
+    def __contains__(self, value):
+        assert(isinstance(value, str) or isinstance(value, ColumnarNode))
+        if isinstance(value, ColumnarNode):
+            return value in self._nodes
+        for n in self:
+            if n.value == value:
+                return True
+        return False
+
+    def __iter__(self):
+        columns = self._columns
+        for index in self._get_indexed():
+            yield ColumnarNode(columns, index)
+
+    def __len__(self):
+        return len(self._get_indexed())
+
+def get_columnar_tree(records, strings, lens=None):
+    """
+    Builds a :class:`ColumnarTree` or :class:`ColumnarListTree` from the
+    records and strings of a flattened tree.
+
+    """
+    return get_level(TreeColumns.build(records, strings), None, lens=lens)
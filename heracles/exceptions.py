@@ -67,3 +67,15 @@ class HeraclesListTreeError(HeraclesTreeError):
 class HeraclesTreeNodeError(HeraclesError):
     pass
 
+# Save exceptions
+
+class HeraclesSaveError(HeraclesError):
+    """
+    Raised by :func:`heracles.batch.save_all` when the files can't be 
+    written, ``committed`` is the list of the paths already replaced.
+
+    """
+    def __init__(self, message, committed=()):
+        HeraclesError.__init__(self, message)
+        self.committed = list(committed)
+
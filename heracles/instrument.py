@@ -0,0 +1,233 @@
+"""
+This module includes the optional instrumentation of heracles, that measures
+where the time of :meth:`heracles.base.Lens.get` and
+:meth:`heracles.base.Lens.put` goes. It is disabled by default and it has
+to be enabled first::
+
+    >>> import heracles
+    >>> from heracles import instrument
+    >>> instrument.enable()
+    >>> t = h.lenses['Aptsources'].get(text)
+    >>> heracles.stats()['lenses']['Aptsources']['get']['parse']['total']
+    0.0021
+
+For every lens the gets are split in the ``parse`` of the text by
+libheracles and the ``build`` of the :class:`heracles.tree.Tree` from the
+libheracles tree, and the number of ``nodes`` built. The puts are split in
+the ``build`` of the libheracles tree from the tree and its ``render`` by
+libheracles, and the ``size`` of the output, or the ``splice`` of the
+changed values in incremental puts. Every measure is kept as a
+:class:`Histogram`. Besides, the hits and misses of the cache of the lens
+resolution are counted.
+
+The measures of every get and put can be exported as they are taken with
+the callbacks added with :func:`add_hook`, that are called with the
+operation, the name of the lens and a dict of the measures. The exceptions
+of the callbacks are logged and don't reach the instrumented calls::
+
+    >>> def export(operation, lens, measures):
+    ...     for name, value in measures.iteritems():
+    ...         statsd.timing("heracles.%s.%s.%s" % (lens, operation, name),
+    ...             value)
+    >>> instrument.add_hook(export)
+
+When it is disabled every instrumented call checks a single flag.
+"""
+
+import logging
+import threading
+from bisect import bisect_left
+from timeit import default_timer
+
+# Upper bounds of the buckets of the time histograms, in seconds
+TIME_BOUNDS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+# Upper bounds of the buckets of the count and size histograms
+SIZE_BOUNDS = (10, 100, 1000, 10000, 100000, 1000000)
+# Measures that are not times
+SIZE_MEASURES = frozenset(["nodes", "size"])
+
+enabled = False
+
+_lock = threading.Lock()
+_lenses = {}
+_counters = {}
+_hooks = []
+
+log = logging.getLogger(__name__)
+
+class Histogram(object):
+    """
+    Count, total, minimum and maximum of a measure, and the number of
+    values that fall in each of the buckets limited by ``bounds``, with an
+    extra bucket for the values over the last bound.
+
+    """
+    __slots__ = ('bounds', 'buckets', 'count', 'total', 'min', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def serialize(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'bounds': list(self.bounds),
+            'buckets': list(self.buckets),
+        }
+
+    def __repr__(self):
+        return "<%s count:%d total:%r>" % (self.__class__.__name__,
+                self.count, self.total)
+
+class Timing(object):
+    """
+    Measures the phases of an operation, every call to :meth:`lap` stores
+    the time since the previous one.
+
+    """
+    __slots__ = ('measures', '_last')
+
+    def __init__(self):
+        self.measures = {}
+        self._last = default_timer()
+
+    def lap(self, name):
+        now = default_timer()
+        self.measures[name] = now - self._last
+        self._last = now
+
+def enable():
+    """
+    Enables the instrumentation.
+
+    """
+    global enabled
+    enabled = True
+
+def disable():
+    """
+    Disables the instrumentation, the measures taken are kept.
+
+    """
+    global enabled
+    enabled = False
+
+def reset():
+    """
+    Removes all the measures taken.
+
+    """
+    with _lock:
+        _lenses.clear()
+        _counters.clear()
+
+def add_hook(callback):
+    """
+    Adds a ``callback(operation, lens, measures)`` that is called after
+    every instrumented get and put, with ``"get"`` or ``"put"``, the name
+    of the lens and a dict of the measures of the operation. The exceptions
+    it raises are logged to the ``heracles.instrument`` logger and ignored.
+
+    """
+    with _lock:
+        _hooks.append(callback)
+
+def remove_hook(callback):
+    """
+    Removes a callback added with :func:`add_hook`.
+
+    """
+    with _lock:
+        _hooks.remove(callback)
+
+def start():
+    """
+    Returns a new :class:`Timing` if the instrumentation is enabled or
+    ``None`` otherwise.
+
+    """
+    return Timing() if enabled else None
+
+def count(name):
+    """
+    Adds one to the counter ``name``.
+
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + 1
+
+def record(operation, lens, measures):
+    """
+    Adds the ``measures`` of an ``operation`` of the ``lens`` to its
+    histograms and calls the hooks.
+
+    """
+    with _lock:
+        histograms = _lenses.setdefault(lens, {}).setdefault(operation, {})
+        for name, value in measures.iteritems():
+            histogram = histograms.get(name)
+            if histogram is None:
+                bounds = SIZE_BOUNDS if name in SIZE_MEASURES else TIME_BOUNDS
+                histogram = histograms[name] = Histogram(bounds)
+            histogram.add(value)
+        hooks = list(_hooks)
+    for hook in hooks:
+        try:
+            hook(operation, lens, measures)
+        except Exception:
+            log.exception("Instrumentation hook %r failed", hook)
+
+def count_nodes(tree):
+    """
+    Returns the number of nodes of ``tree`` that were built, the children
+    of the lazy nodes not loaded yet are not counted.
+
+    """
+    columns = getattr(tree, '_columns', None)
+    if columns is not None:
+        return len(columns)
+    total = 0
+    levels = [tree._nodes]
+    while levels:
+        nodes = levels.pop()
+        total += len(nodes)
+        for node in nodes:
+            if node._children is not None:
+                levels.append(node._children._nodes)
+    return total
+
+def stats():
+    """
+    Returns the measures taken as a dict with the ``lenses`` key, that maps
+    the name of every lens to the serialized histograms of the measures of
+    its operations, and the ``counters`` key::
+
+        {'lenses': {'Hosts': {'get': {'parse': {...}, 'build': {...},
+                                      'nodes': {...}},
+                              'put': {...}}},
+         'counters': {'resolve.hits': 10, 'resolve.misses': 2}}
+
+    """
+    with _lock:
+        lenses = {}
+        for lens, operations in _lenses.iteritems():
+            lenses[lens] = dict((operation, dict((name, h.serialize())
+                for name, h in histograms.iteritems()))
+                for operation, histograms in operations.iteritems())
+        return {'lenses': lenses, 'counters': dict(_counters)}
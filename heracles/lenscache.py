@@ -0,0 +1,181 @@
+"""
+This module includes :class:`LensCache`, an optional disk cache of the lens
+modules found in the load path of :class:`heracles.base.Heracles`.
+
+The compiled lenses live in libheracles memory and can't be stored, so the
+cache stores the name, the file and the filter globs of every lens module.
+An :class:`heracles.base.Heracles` object created with a lens cache loads
+no module at first, and when it has to find the lens of a path it looks it
+up in the cache and loads only that module, instead of loading all of
+them::
+
+    >>> from heracles import Heracles
+    >>> from heracles.lenscache import LensCache
+    >>> h = Heracles(lens_cache=LensCache("/var/cache/heracles"))
+    >>> t = h.parse_file_from_path("/etc/apt/sources.list")
+
+The cache file is rebuilt whenever the heracles version, the libheracles
+library or any lens module in the load path change.
+"""
+
+import os
+import hashlib
+import tempfile
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from heracles.resolver import LensResolver
+from heracles.util import get_lens_fingerprint
+
+# Version of the format of the cache files
+FORMAT_VERSION = 1
+INDEX_PREFIX = "lenses-"
+TMP_PREFIX = ".tmp-"
+
+class IndexedLens(object):
+    """
+    A lens module stored in a :class:`LensIndex`.
+
+    """
+    def __init__(self, name, filename, filters):
+        self.name = name
+        self.filename = filename
+        self.filters = filters
+
+    def get_filters(self):
+        return self.filters
+
+    def __repr__(self):
+        return "<%s '%s'>" % (self.__class__.__name__, self.name)
+
+class LensIndex(object):
+    """
+    The lens modules of a load path in the order libheracles loads them.
+
+    """
+    def __init__(self, fingerprint, lenses):
+        """
+        :param fingerprint: The hash of the lens sources of the index.
+        :type fingerprint: str
+        :param lenses: The lens modules.
+        :type lenses: list of :class:`IndexedLens`
+
+        """
+        self.fingerprint = fingerprint
+        self.lenses = lenses
+        self._resolver = None
+
+    @classmethod
+    def build(cls, fingerprint, lenses):
+        """
+        Builds the index from the loaded ``lenses``.
+
+        :type lenses: iterable of :class:`heracles.base.Lens`
+
+        """
+        indexed = []
+        for lens in lenses:
+            filename = lens.heracles._find_module_file(lens.name)
+            indexed.append(IndexedLens(lens.name, filename, 
+                lens.get_filters()))
+        return cls(fingerprint, indexed)
+
+    def serialize(self):
+        return (FORMAT_VERSION, self.fingerprint,
+                [(l.name, l.filename, l.filters) for l in self.lenses])
+
+    @classmethod
+    def from_serialized(cls, data):
+        version, fingerprint, lenses = data
+        if version != FORMAT_VERSION:
+            return None
+        return cls(fingerprint, [IndexedLens(*l) for l in lenses])
+
+    def resolve(self, path):
+        """
+        Returns the :class:`IndexedLens` that parses ``path`` or ``None``.
+
+        """
+        if self._resolver is None:
+            self._resolver = LensResolver(self.lenses)
+        return self._resolver.resolve(path)
+
+    def __len__(self):
+        return len(self.lenses)
+
+    def __repr__(self):
+        return "<%s lenses:%d>" % (self.__class__.__name__, len(self.lenses))
+
+class LensCache(object):
+    """
+    Disk cache of the :class:`LensIndex` of the load paths.
+
+    """
+    def __init__(self, directory):
+        """
+        :param directory: The directory where the index files are stored,
+            it is created if it doesn't exist.
+        :type directory: str
+
+        """
+        self.directory = directory
+        self._indexes = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, load_dirs):
+        key = hashlib.sha1("\0".join(load_dirs)).hexdigest()
+        return os.path.join(self.directory, INDEX_PREFIX + key)
+
+    def load(self, load_dirs):
+        """
+        Returns the stored index of ``load_dirs`` or ``None`` if it is not
+        stored or it is outdated.
+
+        """
+        load_dirs = tuple(load_dirs)
+        fingerprint = get_lens_fingerprint(load_dirs)
+        index = self._indexes.get(load_dirs)
+        if index is not None and index.fingerprint == fingerprint:
+            return index
+        try:
+            with open(self._filename(load_dirs), "rb") as f:
+                index = LensIndex.from_serialized(loads(f.read()))
+        except Exception:
+            return None
+        if index is None or index.fingerprint != fingerprint:
+            return None
+        self._indexes[load_dirs] = index
+        return index
+
+    def store(self, load_dirs, lenses):
+        """
+        Builds and stores the index of ``load_dirs`` from the list of all the
+        ``lenses`` in it, and returns it.
+
+        """
+        load_dirs = tuple(load_dirs)
+        index = LensIndex.build(get_lens_fingerprint(load_dirs), lenses)
+        data = dumps(index.serialize(), HIGHEST_PROTOCOL)
+        fd, tmp_name = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmp_name, self._filename(load_dirs))
+        except:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        self._indexes[load_dirs] = index
+        return index
+
+    def clear(self):
+        """
+        Removes all the stored indexes.
+
+        """
+        for name in os.listdir(self.directory):
+            if name.startswith(INDEX_PREFIX):
+                os.remove(os.path.join(self.directory, name))
+        self._indexes.clear()
+
+    def __repr__(self):
+        return "<%s '%s'>" % (self.__class__.__name__, self.directory)
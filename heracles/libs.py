@@ -6,12 +6,13 @@ from heracles.util import get_heracles_path
 from heracles.exceptions import HeraclesError
 
 LIBRARY_NAME = "libheracles"
+EXT_LIBRARY_NAME = "libheracles_ext"
 LIBRARY_DIR = "libs"
 ENV_DISABLE = 'HERACLES_DISABLE_LIBHERACLES'
 
 disabled_lib = ENV_DISABLE in os.environ and os.environ[ENV_DISABLE] == "1"
 
-def get_library_name():
+def get_library_name(name=LIBRARY_NAME):
     s = system()
     if s == "Linux":
         ext = "so"
@@ -21,16 +22,27 @@ def get_library_name():
         ext = "dll"
     else:
         raise HeraclesError("Unknown operating system")
-    return LIBRARY_NAME + "." + ext
+    return name + "." + ext
 
-def get_library_path():
+def get_library_path(name=LIBRARY_NAME):
     h_path = get_heracles_path()
-    library_name = get_library_name()
+    library_name = get_library_name(name)
     return os.path.join(h_path, LIBRARY_DIR, library_name)
 
 if not disabled_lib:
     libheracles = ctypes.cdll.LoadLibrary(get_library_path())
+    # Optional helpers to speed up the conversion of trees, if they are not
+    # built the slower pure ctypes code is used.
+    try:
+        libheracles_ext = ctypes.cdll.LoadLibrary(
+                get_library_path(EXT_LIBRARY_NAME))
+    except OSError:
+        libheracles_ext = None
+    # The C library, used to free the memory allocated by libheracles.
+    libc = ctypes.CDLL(ctypes.util.find_library("c"))
 else:
     print "Warning disabling libheracles. Heracles wont work."
     libheracles = None
+    libheracles_ext = None
+    libc = None
 
@@ -0,0 +1,621 @@
+"""
+This module includes the path expressions used by :meth:`heracles.tree.Tree.match`,
+:meth:`heracles.tree.Tree.get` and :meth:`heracles.tree.Tree.set` to find the
+nodes of a tree, a subset of the `augeas path expressions
+<http://augeas.net/page/Path_expressions>`_::
+
+    >>> t.match("/1/component[. = 'main']")
+    [<TreeNode label:'component' value:'main' children:0>]
+    >>> t.get("/*[type = 'deb-src'][1]/distribution")
+    'squeeze'
+    >>> t.set("/1/distribution", "wheezy")
+
+A path is a sequence of steps separated by ``/``, each one of them selects
+the children of the nodes selected by the previous one:
+
+*   ``label``: The children with that label. The characters
+    ``/[]=!()|,<>`` and whitespace have to be escaped with ``\\`` in labels,
+    and ``+`` and ``-`` at their start.
+*   ``*``: All the children.
+*   ``.`` and ``..``: The node itself and its parent.
+*   ``//label``: The descendants with that label, ``//*`` all of them.
+
+Every step can be followed by any number of predicates in brackets, that
+filter the selected nodes:
+
+*   ``[2]``, ``[last()]``: The node at that position among the nodes
+    selected by the step for each node.
+*   ``[path]``: The nodes where ``path`` selects any node.
+*   ``[path = 'value']``, ``[path != 'value']``: The nodes where ``path``
+    selects any node with that value, or with other value. ``.`` is the
+    node itself.
+*   ``[path =~ regexp('regex')]``: The nodes where ``path`` selects any
+    node whose whole value matches ``regex``.
+*   ``[count(path) = 2]``, ``[position() < 3]``: Numeric comparisons.
+*   ``and``, ``or`` and parentheses combine the conditions.
+
+Several paths can be joined with ``|``, like ``*/type | */uri``, to select
+the nodes selected by any of them.
+
+Paths that start with ``/`` are evaluated from the tree where they are
+used, like the relative ones. The compiled expressions are cached.
+"""
+
+import re
+from heracles.exceptions import (HeraclesPathXError, HeraclesMMatchError,
+        HeraclesNoMatchError)
+from heracles.util import check_int
+
+# Maximum number of compiled expressions kept in the cache
+CACHE_SIZE = 256
+_cache = {}
+
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s+) |
+    (?P<string>'[^']*'|"[^"]*") |
+    (?P<op>//|/|\[|\]|\(|\)|,|!=|=~|<=|>=|=|<|>|\+|-|\|) |
+    (?P<name>(?:\\.|[^/\[\]=!()|,<>\s\\'"])+)
+    """, re.VERBOSE)
+
+ESCAPE_RE = re.compile(r"\\(.)")
+
+def tokenize(expression):
+    """
+    Returns the list of ``(kind, text)`` tokens of ``expression``.
+
+    """
+    tokens = []
+    position = 0
+    while position < len(expression):
+        m = TOKEN_RE.match(expression, position)
+        if m is None:
+            raise HeraclesPathXError("Invalid path expression '%s' at %d" %
+                    (expression, position))
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'string':
+            tokens.append(('string', text[1:-1]))
+        elif kind == 'op':
+            tokens.append((text, text))
+        elif kind == 'name':
+            if text in ('.', '..', '*', 'and', 'or'):
+                tokens.append((text, text))
+            elif text.isdigit():
+                # Kept as text, as it may be a label like "01"
+                tokens.append(('number', text))
+            else:
+                tokens.append(('name', ESCAPE_RE.sub(r"\1", text)))
+        position = m.end()
+    tokens.append(('end', None))
+    return tokens
+
+# Evaluation
+#
+# Nodes are anything with ``value``, ``parent`` and ``_get_children()``:
+# :class:`heracles.tree.TreeNode` or :class:`heracles.columnar.ColumnarNode`.
+# The tree where the expression is evaluated is used as the root node, that
+# has no value and whose children are the tree itself.
+
+class Root(object):
+    """
+    The node over the first level of the tree an expression is evaluated
+    in.
+
+    """
+    __slots__ = ('tree',)
+    value = None
+    parent = None
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def _get_children(self):
+        return self.tree
+
+def get_children(node):
+    children = node._get_children()
+    return () if children is None else children._nodes
+
+def iter_descendants(node):
+    for child in get_children(node):
+        yield child
+        for descendant in iter_descendants(child):
+            yield descendant
+
+class Context(object):
+    __slots__ = ('root', 'node', 'position', 'size')
+
+    def __init__(self, root, node, position=1, size=1):
+        self.root = root
+        self.node = node
+        self.position = position
+        self.size = size
+
+class Step(object):
+    """
+    A step of a path: ``axis`` is ``child``, ``descendant``, ``self`` or
+    ``parent``, ``name`` the label or ``None`` for any label.
+
+    """
+    __slots__ = ('axis', 'name', 'predicates')
+
+    def __init__(self, axis, name=None, predicates=None):
+        self.axis = axis
+        self.name = name
+        self.predicates = predicates or []
+
+    def select(self, root, node):
+        if self.axis == 'self':
+            nodes = [node]
+        elif self.axis == 'parent':
+            parent = node.parent
+            if parent is None and node is not root:
+                parent = root
+            nodes = [parent] if parent is not None else []
+        elif self.axis == 'child':
+            children = node._get_children()
+            if children is None:
+                nodes = []
+            elif self.name is None:
+                nodes = list(children._nodes)
+            else:
+                nodes = children._label_nodes(self.name)
+        else:
+            nodes = [n for n in iter_descendants(node)
+                    if self.name is None or n.label == self.name]
+        for predicate in self.predicates:
+            size = len(nodes)
+            nodes = [n for i, n in enumerate(nodes) if
+                    predicate.test(Context(root, n, i + 1, size))]
+        return nodes
+
+    def is_simple(self):
+        return self.axis == 'child' and self.name is not None and \
+                not self.predicates
+
+class Path(object):
+    """
+    A sequence of :class:`Step`, its value is the list of nodes it selects.
+
+    """
+    __slots__ = ('steps',)
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def select(self, root, nodes):
+        for step in self.steps:
+            result = []
+            seen = set()
+            for node in nodes:
+                for n in step.select(root, node):
+                    if n not in seen:
+                        seen.add(n)
+                        result.append(n)
+            nodes = result
+        return nodes
+
+    def evaluate(self, context):
+        return self.select(context.root, [context.node])
+
+class Literal(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, context):
+        return self.value
+
+class Function(object):
+    __slots__ = ('name', 'args')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def evaluate(self, context):
+        if self.name == 'last':
+            return context.size
+        elif self.name == 'position':
+            return context.position
+        elif self.name == 'count':
+            return len(self.args[0].evaluate(context))
+        elif self.name == 'regexp':
+            return compile_regexp(self.args[0].evaluate(context))
+
+class Union(object):
+    __slots__ = ('paths',)
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def evaluate(self, context):
+        result = []
+        seen = set()
+        for path in self.paths:
+            for node in path.evaluate(context):
+                if node not in seen:
+                    seen.add(node)
+                    result.append(node)
+        return result
+
+def compile_regexp(pattern):
+    """
+    Compiles ``pattern`` to match whole values as augeas does.
+
+    """
+    return re.compile("(?:%s)\\Z" % pattern)
+
+def get_values(value):
+    if isinstance(value, list):
+        return [node.value for node in value]
+    return [value]
+
+def compare(operator, left, right):
+    if operator == '=~':
+        return right.match(left) is not None if left is not None else False
+    if operator == '=':
+        return left == right
+    if operator == '!=':
+        return left != right
+    if operator == '<':
+        return left < right
+    if operator == '<=':
+        return left <= right
+    if operator == '>':
+        return left > right
+    return left >= right
+
+class Comparison(object):
+    __slots__ = ('operator', 'left', 'right')
+
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def evaluate(self, context):
+        left = self.left.evaluate(context)
+        right = self.right.evaluate(context)
+        if self.operator == '=~' and isinstance(right, basestring):
+            right = compile_regexp(right)
+        for l in get_values(left):
+            for r in get_values(right):
+                if compare(self.operator, l, r):
+                    return True
+        return False
+
+def get_number(value):
+    """
+    Returns the number of an operand of an arithmetic expression, the value
+    of the first node of a node-set or a string must be an integer.
+
+    """
+    if isinstance(value, list):
+        value = value[0].value if value else None
+    if isinstance(value, basestring) and check_int(value):
+        return int(value)
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    raise HeraclesPathXError("Expected a number instead of %r" % (value,))
+
+class Arithmetic(object):
+    __slots__ = ('operator', 'left', 'right')
+
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def evaluate(self, context):
+        left = get_number(self.left.evaluate(context))
+        right = get_number(self.right.evaluate(context))
+        if self.operator == '+':
+            return left + right
+        return left - right
+
+class Logical(object):
+    __slots__ = ('operator', 'operands')
+
+    def __init__(self, operator, operands):
+        self.operator = operator
+        self.operands = operands
+
+    def evaluate(self, context):
+        if self.operator == 'and':
+            return all(truth(o.evaluate(context), context, False)
+                    for o in self.operands)
+        return any(truth(o.evaluate(context), context, False)
+                for o in self.operands)
+
+def truth(value, context, positional=True):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, long)) and positional:
+        return context.position == value
+    return bool(value)
+
+class Predicate(object):
+    __slots__ = ('expression',)
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def test(self, context):
+        return truth(self.expression.evaluate(context), context)
+
+# Parser
+
+class Parser(object):
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+        # Number of predicates being parsed
+        self.depth = 0
+
+    def error(self, message):
+        raise HeraclesPathXError("%s in path expression '%s'" % (message,
+            self.expression))
+
+    def peek(self):
+        return self.tokens[self.position][0]
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def expect(self, kind):
+        if self.peek() != kind:
+            self.error("Expected '%s'" % kind)
+        return self.next()
+
+    def parse(self):
+        if self.peek() == 'end':
+            self.error("Empty path")
+        path = self.parse_or()
+        self.expect('end')
+        if not is_node_set(path):
+            self.error("Expected a path")
+        return path
+
+    def parse_path(self):
+        steps = []
+        kind = self.peek()
+        if kind == '/':
+            self.next()
+        elif kind == '//':
+            self.next()
+            steps.append(self.parse_step('descendant'))
+        else:
+            steps.append(self.parse_step('child'))
+        if not steps or self.peek() in ('/', '//'):
+            if steps:
+                kind = self.next()[0]
+            else:
+                kind = '/'
+            while True:
+                axis = 'descendant' if kind == '//' else 'child'
+                steps.append(self.parse_step(axis))
+                if self.peek() not in ('/', '//'):
+                    break
+                kind = self.next()[0]
+        return Path(steps)
+
+    def parse_step(self, axis):
+        kind, text = self.next()
+        if kind == '.':
+            step = Step('self' if axis == 'child' else axis)
+        elif kind == '..':
+            if axis != 'child':
+                self.error("Unexpected '..'")
+            step = Step('parent')
+        elif kind == '*':
+            step = Step(axis)
+        elif kind in ('name', 'number'):
+            step = Step(axis, text)
+        else:
+            self.error("Expected a label")
+        while self.peek() == '[':
+            self.next()
+            self.depth += 1
+            step.predicates.append(Predicate(self.parse_or()))
+            self.depth -= 1
+            self.expect(']')
+        return step
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == 'or':
+            self.next()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Logical('or', operands)
+
+    def parse_and(self):
+        operands = [self.parse_comparison()]
+        while self.peek() == 'and':
+            self.next()
+            operands.append(self.parse_comparison())
+        return operands[0] if len(operands) == 1 else Logical('and', operands)
+
+    def parse_comparison(self):
+        left = self.parse_arithmetic()
+        if self.peek() in ('=', '!=', '=~', '<', '<=', '>', '>='):
+            operator = self.next()[0]
+            right = self.parse_arithmetic()
+            if operator == '=~' and isinstance(right, Literal) and \
+                    isinstance(right.value, basestring):
+                right = Literal(compile_regexp(right.value))
+            return Comparison(operator, left, right)
+        return left
+
+    def parse_arithmetic(self):
+        left = self.parse_union()
+        while self.peek() in ('+', '-'):
+            operator = self.next()[0]
+            left = Arithmetic(operator, left, self.parse_union())
+        return left
+
+    def parse_union(self):
+        paths = [self.parse_primary()]
+        while self.peek() == '|':
+            self.next()
+            paths.append(self.parse_primary())
+        return paths[0] if len(paths) == 1 else Union(paths)
+
+    def parse_primary(self):
+        kind, text = self.tokens[self.position]
+        if kind == 'string':
+            self.next()
+            return Literal(text)
+        # Out of the predicates the numbers are labels
+        if kind == 'number' and self.depth:
+            if self.tokens[self.position + 1][0] not in ('/', '//', '['):
+                self.next()
+                return Literal(int(text))
+        if kind == '(':
+            self.next()
+            expression = self.parse_or()
+            self.expect(')')
+            return expression
+        if kind == 'name' and self.tokens[self.position + 1][0] == '(':
+            return self.parse_function()
+        return self.parse_path()
+
+    def parse_function(self):
+        name = self.next()[1]
+        self.expect('(')
+        args = []
+        if self.peek() != ')':
+            args.append(self.parse_or())
+            while self.peek() == ',':
+                self.next()
+                args.append(self.parse_or())
+        self.expect(')')
+        arity = {'last': 0, 'position': 0, 'count': 1, 'regexp': 1}
+        if arity.get(name) != len(args):
+            self.error("Unknown function %s/%d" % (name, len(args)))
+        if name == 'regexp' and isinstance(args[0], Literal):
+            return Literal(compile_regexp(args[0].value))
+        return Function(name, args)
+
+def is_node_set(expression):
+    """
+    Returns true if ``expression`` evaluates to a list of nodes.
+
+    """
+    if isinstance(expression, Union):
+        return all(is_node_set(path) for path in expression.paths)
+    return isinstance(expression, Path)
+
+class PathExpression(object):
+    """
+    A compiled path expression, see :func:`compile_path`.
+
+    """
+    __slots__ = ('expression', 'path')
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.path = Parser(expression).parse()
+
+    def match(self, tree):
+        """
+        Returns the list of the nodes of ``tree`` selected by the expression
+        in tree order.
+
+        """
+        root = Root(tree)
+        if isinstance(self.path, Path):
+            nodes = self.path.select(root, [root])
+            return [n for n in nodes if n is not root]
+        # The columnar nodes are built again on every access, they are 
+        # compared by position instead of by identity
+        selected = set(self.path.evaluate(Context(root, root)))
+        return [n for n in iter_descendants(root) if n in selected]
+
+    def get(self, tree):
+        """
+        Returns the value of the node of ``tree`` selected by the expression,
+        or ``None`` if there is none. It raises
+        :class:`heracles.exceptions.HeraclesMMatchError` if there are many.
+
+        """
+        nodes = self.match(tree)
+        if len(nodes) > 1:
+            raise HeraclesMMatchError("Path '%s' matches %d nodes" %
+                    (self.expression, len(nodes)))
+        return nodes[0].value if nodes else None
+
+    def set(self, tree, value):
+        """
+        Sets the value of the node of ``tree`` selected by the expression and
+        returns the node. If there is no such node and the expression is a
+        path of labels whose last steps don't match, the missing nodes are
+        created.
+
+        """
+        nodes = self.match(tree)
+        if len(nodes) > 1:
+            raise HeraclesMMatchError("Path '%s' matches %d nodes" %
+                    (self.expression, len(nodes)))
+        if nodes:
+            nodes[0].value = value
+            return nodes[0]
+        if not isinstance(self.path, Path):
+            raise HeraclesNoMatchError("Unable to create the nodes of '%s'"
+                    % self.expression)
+        root = Root(tree)
+        steps = self.path.steps
+        for i in range(len(steps) - 1, -1, -1):
+            parents = Path(steps[:i]).select(root, [root])
+            if len(parents) > 1:
+                raise HeraclesMMatchError("Path '%s' matches %d nodes" %
+                        (self.expression, len(parents)))
+            if parents:
+                break
+        missing = steps[i:]
+        if not all(step.is_simple() for step in missing):
+            raise HeraclesNoMatchError("Unable to create the nodes of '%s'"
+                    % self.expression)
+        node = parents[0]
+        for j, step in enumerate(missing):
+            children = tree if node is root else node.children
+            node_value = value if j == len(missing) - 1 else None
+            node = add_node(children, step.name, node_value)
+        return node
+
+    def __repr__(self):
+        return "<%s '%s'>" % (self.__class__.__name__, self.expression)
+
+def add_node(tree, label, value):
+    """
+    Appends a new node with ``label`` and ``value`` to ``tree``.
+
+    """
+    from heracles.tree import ListTree
+    node = tree.default_node_class(label=label, value=value)
+    if isinstance(tree, ListTree) and check_int(label):
+        if int(label) != len(tree) + 1:
+            raise HeraclesNoMatchError("Unable to create node '%s' in a list"
+                    " of %d nodes" % (label, len(tree)))
+        tree.append(node)
+    else:
+        tree[label] = node
+    return node
+
+def compile_path(expression):
+    """
+    Returns the :class:`PathExpression` of ``expression``, compiling it only
+    the first time.
+
+    """
+    path = _cache.get(expression)
+    if path is None:
+        path = PathExpression(expression)
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[expression] = path
+    return path
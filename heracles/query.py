@@ -0,0 +1,212 @@
+"""
+This module includes the query engine of :meth:`heracles.tree.ListTree.search`.
+
+List trees are most of the time like database tables, a list of rows with
+key-value children. The first time a list tree is searched an index of the
+rows is built, that maps the label of every child to its values and the
+rows that have them, so the later searches don't scan the rows. The index
+is built again after any change of the tree.
+
+Besides plain values, that are compared for equality, the searched values
+can be predicates::
+
+    >>> from heracles.query import In, Prefix, Regex
+    >>> t.search(type=In(["deb", "deb-src"]), uri=Prefix("http://ftp."))
+    >>> t.search(distribution=Regex("^(squeeze|wheezy)"))
+
+Any other test of the values can be searched wrapping a callable in a 
+:class:`Predicate`::
+
+    >>> from heracles.query import Predicate
+    >>> t.search(uri=Predicate(lambda value: "debian" in value))
+"""
+
+import re
+from itertools import chain
+
+class Predicate(object):
+    """
+    Matches the values for which the callable ``test`` returns true. It is
+    also the base class of the predicates of the searched values, that
+    override :meth:`match` instead.
+
+    """
+    __slots__ = ('test',)
+
+    def __init__(self, test):
+        if not callable(test):
+            raise TypeError("The test of a predicate must be callable")
+        self.test = test
+
+    def match(self, value):
+        """
+        Returns ``True`` if ``value`` satisfies the predicate.
+
+        """
+        return bool(self.test(value))
+
+    def select(self, values):
+        """
+        Returns the lists of rows of the values of ``values``, a dict that
+        maps every value to its rows, that satisfy the predicate.
+
+        """
+        return [rows for value, rows in values.iteritems()
+                if self.match(value)]
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.test)
+
+class Equal(Predicate):
+    """
+    Matches the values equal to ``value``. The plain searched values are
+    compared this way.
+
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def match(self, value):
+        return value == self.value
+
+    def select(self, values):
+        rows = values.get(self.value)
+        return [rows] if rows is not None else []
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.value)
+
+class In(Predicate):
+    """
+    Matches the values that are any of ``values``.
+
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = frozenset(values)
+
+    def match(self, value):
+        return value in self.values
+
+    def select(self, values):
+        return [values[value] for value in self.values if value in values]
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, sorted(self.values))
+
+class Prefix(Predicate):
+    """
+    Matches the values that start with ``prefix``.
+
+    """
+    __slots__ = ('prefix',)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def match(self, value):
+        return value is not None and value.startswith(self.prefix)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.prefix)
+
+class Regex(Predicate):
+    """
+    Matches the values where the regular expression ``pattern`` is found,
+    as ``re.search`` does.
+
+    """
+    __slots__ = ('pattern', '_regex')
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self._regex = re.compile(pattern, flags)
+
+    def match(self, value):
+        return value is not None and self._regex.search(value) is not None
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.pattern)
+
+def get_predicate(value):
+    """
+    Returns ``value`` if it is a :class:`Predicate` or an :class:`Equal`
+    predicate of it otherwise.
+
+    """
+    if isinstance(value, Predicate):
+        return value
+    return Equal(value)
+
+# Key of the values of the rows themselves in the index
+ROW_VALUE = object()
+
+class SearchIndex(object):
+    """
+    Index of the rows of a :class:`heracles.tree.ListTree`: ``labels`` maps
+    every label of the children of the rows to a dict of their values and
+    the positions of the rows that have them, in row order. The values of
+    the rows themselves are under the ``ROW_VALUE`` key.
+
+    """
+    __slots__ = ('version', 'rows', 'labels')
+
+    def __init__(self, rows, version):
+        """
+        :param rows: The indexed nodes of the tree.
+        :type rows: list of :class:`heracles.tree.TreeNode`
+        :param version: The changes version of the tree, see
+            :meth:`heracles.tree.ListTree.search`.
+        :type version: int
+
+        """
+        self.version = version
+        self.rows = rows
+        labels = self.labels = {ROW_VALUE: {}}
+        row_values = labels[ROW_VALUE]
+        for position, row in enumerate(rows):
+            row_values.setdefault(row.value, []).append(position)
+            for child in row._get_child_nodes():
+                values = labels.get(child.label)
+                if values is None:
+                    values = labels[child.label] = {}
+                positions = values.get(child.value)
+                if positions is None:
+                    values[child.value] = [position]
+                elif positions[-1] != position:
+                    positions.append(position)
+
+    def search(self, key_values):
+        """
+        Returns the rows that match all the ``key_values``, see
+        :meth:`heracles.tree.ListTree.search`.
+
+        """
+        key_values = dict(key_values)
+        master_value = key_values.pop("__value", None)
+        if master_value is not None:
+            key_values[ROW_VALUE] = master_value
+        if not key_values:
+            return list(self.rows)
+        candidates = []
+        for key, value in key_values.iteritems():
+            values = self.labels.get(key)
+            if values is None:
+                return []
+            selected = get_predicate(value).select(values)
+            if len(selected) == 1:
+                positions = selected[0]
+            else:
+                positions = sorted(set(chain.from_iterable(selected)))
+            if not positions:
+                return []
+            candidates.append(positions)
+        candidates.sort(key=len)
+        result = candidates[0]
+        for positions in candidates[1:]:
+            positions = set(positions)
+            result = [p for p in result if p in positions]
+        return [self.rows[p] for p in result]
@@ -5,14 +5,191 @@ the Heracles library.
 It includes the classes required to interact with libheracles structures.
 """
 
-from ctypes import pointer
-from heracles.structs import struct_tree_p, struct_tree
-from heracles.tree import get_tree_from_nodes, get_node
-from heracles.libs import libheracles
+import gc
+import threading
+from array import array
+from itertools import izip
+from ctypes import (pointer, byref, string_at, c_int, c_void_p, c_size_t, 
+        c_char_p, POINTER)
+from heracles.structs import struct_tree_p, struct_tree, UINT_MAX
+from heracles.tree import get_tree_from_nodes, get_node, TreeNode
+from heracles.columnar import ColumnarTree, get_columnar_tree
+from heracles.libs import libheracles, libheracles_ext
+
+# Each record of a flattened tree has the depth of the node and the offset
+# and length of its label and value in the strings table.
+RECORD_FIELDS = 5
+# Each span record has the start and end of the label, the value and the 
+# whole node, or -1 if the node has no span.
+SPAN_FIELDS = 6
+
+if libheracles_ext is not None:
+    hera_ext_export = libheracles_ext.hera_ext_export
+    hera_ext_export.restype = c_int
+    hera_ext_export.argtypes = [struct_tree_p, POINTER(c_void_p), 
+            POINTER(c_size_t), POINTER(c_void_p), POINTER(c_size_t)]
+    hera_ext_free = libheracles_ext.hera_ext_free
+    hera_ext_free.argtypes = [c_void_p]
+    hera_ext_import = libheracles_ext.hera_ext_import
+    hera_ext_import.restype = c_int
+    hera_ext_import.argtypes = [c_char_p, c_size_t, c_char_p, 
+            POINTER(struct_tree_p)]
+    hera_ext_free_tree = libheracles_ext.hera_ext_free_tree
+    hera_ext_free_tree.argtypes = [struct_tree_p]
+    hera_ext_export_spans = libheracles_ext.hera_ext_export_spans
+    hera_ext_export_spans.restype = c_int
+    hera_ext_export_spans.argtypes = [struct_tree_p, POINTER(c_void_p),
+            POINTER(c_size_t)]
+
+# The collector is stopped while trees are built, see BaseRawTree.build_tree.
+# The builds of several threads may overlap, so they are counted and the 
+# collector is restarted when the last one finishes.
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+_gc_enabled = False
+
+def pause_gc():
+    global _gc_pauses, _gc_enabled
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+
+def resume_gc():
+    global _gc_pauses
+    with _gc_lock:
+        _gc_pauses -= 1
+        if _gc_pauses == 0 and _gc_enabled:
+            gc.enable()
+
+def export_tree(first_p):
+    """
+    Flattens the libheracles tree at ``first_p`` with a single native call.
+    Returns an ``array`` of records and the string table they refer to.
+
+    """
+    records_p = c_void_p()
+    nrecords = c_size_t()
+    strings_p = c_void_p()
+    strings_len = c_size_t()
+    r = hera_ext_export(first_p, byref(records_p), byref(nrecords), 
+            byref(strings_p), byref(strings_len))
+    if r < 0:
+        raise MemoryError("Unable to export tree")
+    try:
+        records = array('i')
+        if nrecords.value:
+            records.fromstring(string_at(records_p, 
+                nrecords.value * RECORD_FIELDS * records.itemsize))
+        strings = string_at(strings_p, strings_len.value) if strings_len.value else ""
+    finally:
+        hera_ext_free(records_p)
+        hera_ext_free(strings_p)
+    return records, strings
+
+def export_spans(first_p):
+    """
+    Returns an ``array`` with the span records of the libheracles tree at
+    ``first_p``, in the same order as the records of :func:`export_tree`.
+
+    """
+    spans_p = c_void_p()
+    nspans = c_size_t()
+    if hera_ext_export_spans(first_p, byref(spans_p), byref(nspans)) < 0:
+        raise MemoryError("Unable to export spans")
+    try:
+        spans = array('i')
+        if nspans.value:
+            spans.fromstring(string_at(spans_p, 
+                nspans.value * SPAN_FIELDS * spans.itemsize))
+    finally:
+        hera_ext_free(spans_p)
+    return spans
+
+def get_span(raw_node):
+    span_p = raw_node.span
+    if not span_p:
+        return None
+    span = span_p.contents
+    if span.span_start == UINT_MAX:
+        return None
+    return (span.label_start, span.label_end, span.value_start, 
+            span.value_end, span.span_start, span.span_end)
+
+def get_nodes_from_records(records, strings, spans=None):
+    """
+    Builds the list of :class:`heracles.tree.TreeNode` from a flattened tree,
+    with the spans of :func:`export_spans` if ``spans`` is given.
+
+    """
+    result = []
+    # Stack of (label, value, children, record) of the nodes being built,
+    # the node at position i of the stack has depth i - 1.
+    stack = [(None, None, result, None)]
+    it = iter(records)
+    record = 0
+    for depth, l_off, l_len, v_off, v_len in izip(it, it, it, it, it):
+        while len(stack) > depth + 1:
+            _build_record_node(stack, spans)
+        stack.append((strings[l_off:l_off + l_len], 
+            strings[v_off:v_off + v_len], [], record))
+        record += 1
+    while len(stack) > 1:
+        _build_record_node(stack, spans)
+    return result
+
+def _build_record_node(stack, spans):
+    label, value, children, record = stack.pop()
+    node = get_node(children, label=label, value=value)
+    if spans is not None:
+        start = record * SPAN_FIELDS
+        if spans[start] >= 0:
+            node._span = tuple(spans[start:start + SPAN_FIELDS])
+    stack[-1][2].append(node)
 
 def get_raw_tree_from_tree(tree):
+    if libheracles_ext is not None:
+        return NativeRawTree.build_from_tree(tree)
     return ManagedRawTree.build_from_tree(tree)
 
+def flatten_nodes(nodes):
+    """
+    Flattens a list of :class:`heracles.tree.TreeNode` and their children 
+    into an ``array`` of records and a string table, the reverse of 
+    :func:`get_nodes_from_records`. ``None`` labels and values are stored
+    with length -1.
+
+    """
+    records = array('i')
+    strings = []
+    _flatten_nodes(nodes, 0, records, strings, 0)
+    return records, "".join(strings)
+
+def _flatten_nodes(nodes, depth, records, strings, offset):
+    for node in nodes:
+        label = node.label
+        value = node.value
+        if label is None:
+            label_offset, label_len = 0, -1
+        else:
+            label_offset, label_len = offset, len(label)
+            strings.append(label)
+            offset += label_len
+        if value is None:
+            value_offset, value_len = 0, -1
+        else:
+            value_offset, value_len = offset, len(value)
+            strings.append(value)
+            offset += value_len
+        records.extend((depth, label_offset, label_len, value_offset, 
+            value_len))
+        children = node._get_child_nodes()
+        if children:
+            offset = _flatten_nodes(children, depth + 1, records, strings,
+                    offset)
+    return offset
+
 class BaseRawTree(object):
     """
     Base class to store augeas tree structure.
@@ -31,16 +208,68 @@ class BaseRawTree(object):
         assert(isinstance(first, struct_tree_p))
         self.first = first
         self.lens = lens
+        self.spans = False
 
-    def build_tree(self):
+    def build_tree(self, lazy=False, spans=False, columnar=False):
         """
         Builds the heracles `Tree` object from the libheracles tree.
 
+        If `columnar` is true a read only 
+        :class:`heracles.columnar.ColumnarTree` is built instead.
+
+        If `lazy` is true only the first level of the tree is built, the 
+        children of each node are built when they are first accessed. The 
+        raw tree is kept alive until all of them are built.
+
+        If `spans` is true the spans of the libheracles nodes are stored in
+        the `TreeNode` objects.
+
         """
 
-        nodes = self._get_nodes(self.first)
+        self.spans = spans
+        if columnar:
+            if libheracles_ext is not None:
+                records, strings = export_tree(self.first)
+            else:
+                records, strings = flatten_nodes(self._get_nodes(self.first))
+            return get_columnar_tree(records, strings, lens=self.lens)
+        if lazy:
+            nodes = self._get_level(self.first)
+        else:
+            # Building the nodes creates lots of objects but no garbage, so
+            # the collector is stopped meanwhile.
+            pause_gc()
+            try:
+                if libheracles_ext is not None:
+                    records, strings = export_tree(self.first)
+                    node_spans = export_spans(self.first) if spans else None
+                    nodes = get_nodes_from_records(records, strings, 
+                            node_spans)
+                else:
+                    nodes = self._get_nodes(self.first)
+            finally:
+                resume_gc()
         return get_tree_from_nodes(nodes, lens=self.lens)
 
+    def _get_level(self, first_p):
+        assert(isinstance(first_p, struct_tree_p))
+        result = []
+        raw_node_p = first_p
+        while raw_node_p:
+            raw_node = raw_node_p.contents
+            label = raw_node.label if raw_node.label is not None else ""
+            value = raw_node.value if raw_node.value is not None else ""
+            if raw_node.children:
+                loader = RawLevelLoader(self, raw_node.children)
+                node = TreeNode.build_lazy(loader, label=label, value=value)
+            else:
+                node = get_node([], label=label, value=value)
+            if self.spans:
+                node._span = get_span(raw_node)
+            result.append(node)
+            raw_node_p = raw_node.next
+        return result
+
     def _get_nodes(self, first_p, parent=None):
         assert(isinstance(first_p, struct_tree_p))
         result = []
@@ -54,10 +283,54 @@ class BaseRawTree(object):
             label = raw_node.label if raw_node.label is not None else ""
             value = raw_node.value if raw_node.value is not None else ""
             node = get_node(children, label=label, value=value, parent=parent) 
+            if self.spans:
+                node._span = get_span(raw_node)
             result.append(node)
             raw_node_p = raw_node.next
         return result
 
+class RawLevelLoader(object):
+    """
+    Loader of the children of a lazy `TreeNode`. It keeps a reference to the
+    raw tree so the libheracles memory is not freed until it is used.
+
+    """
+    def __init__(self, raw_tree, first_p):
+        self.raw_tree = raw_tree
+        self.first_p = first_p
+
+    def load(self):
+        return self.raw_tree._get_level(self.first_p)
+
+class NativeRawTree(BaseRawTree):
+    """
+    BaseRawTree subclass that stores a tree built from an heracles Tree 
+    object with a single call to libheracles_ext, that is freed when this
+    object is destroyed.
+
+    """
+    @classmethod
+    def build_from_tree(cls, tree):
+        """
+        Class builder that takes an heracles Tree ``tree`` and returns an
+        instance of this class with its contents.
+
+        """
+        if isinstance(tree, ColumnarTree):
+            records, strings = tree._export_records()
+        else:
+            records, strings = flatten_nodes(tree._nodes)
+        first = struct_tree_p()
+        r = hera_ext_import(records.tostring(), len(records) // RECORD_FIELDS,
+                strings, byref(first))
+        if r < 0:
+            raise MemoryError("Unable to import tree")
+        return cls(first)
+
+    def __del__(self):
+        if self.first:
+            hera_ext_free_tree(self.first)
+
 class UnmanagedRawTree(BaseRawTree):
     """
     BaseRawTree subclass intended to store a tree object generated by
@@ -67,7 +340,7 @@ class UnmanagedRawTree(BaseRawTree):
 
     def __del__(self):
         if self.first:
-            libheracles.free_tree_node(self.first)
+            libheracles.free_tree(self.first)
 
 class ManagedRawTree(BaseRawTree):
     """
@@ -109,7 +382,7 @@ class ManagedRawTree(BaseRawTree):
         raw_node.label = node.label
         raw_node.value = node.value
         raw_node.next = None
-        raw_node.children = cls._build_raw_nodes(node.children._nodes)
+        raw_node.children = cls._build_raw_nodes(node._get_child_nodes())
         return raw_node
 
 
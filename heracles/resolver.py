@@ -0,0 +1,181 @@
+"""
+This module is intended to be use only for internal pourposes of
+the Heracles library.
+
+It includes the :class:`LensResolver` used by :class:`heracles.base.Heracles`
+to find the lens that parses a given file path.
+"""
+
+import re
+from fnmatch import translate
+from heracles import instrument
+
+MAGIC_CHARS = "*?["
+# Maximum number of resolved paths kept in the cache of every resolver
+CACHE_SIZE = 4096
+
+def has_magic(glob):
+    for char in MAGIC_CHARS:
+        if char in glob:
+            return True
+    return False
+
+def compile_glob(glob):
+    """
+    Returns the ``match`` method of the regular expression equivalent to the
+    ``fnmatch`` pattern ``glob``.
+
+    """
+    return re.compile(translate(glob)).match
+
+def literal_prefix(glob):
+    """
+    Returns the directory part of the literal start of ``glob``, all the paths
+    that match ``glob`` start with it.
+
+    """
+    index = len(glob)
+    for char in MAGIC_CHARS:
+        i = glob.find(char)
+        if i != -1 and i < index:
+            index = i
+    return glob[:glob[:index].rfind("/") + 1]
+
+def dir_prefixes(path):
+    """
+    Returns all the directory prefixes of ``path``, ended with a slash.
+
+    """
+    result = []
+    i = path.find("/")
+    while i != -1:
+        result.append(path[:i + 1])
+        i = path.find("/", i + 1)
+    return result
+
+class LensResolver(object):
+    """
+    Finds the lens that handles a file path.
+
+    The include globs of every lens filter are indexed by the full path if
+    they have no wildcards, by the file name if it is literal, or by their
+    literal directory prefix, so only the lenses that can match a path are
+    tested. The globs of a lens are compiled into regular expressions the
+    first time it is tested, and the results are memoized by path, up to
+    :data:`CACHE_SIZE` paths.
+
+    It returns the same results as testing :meth:`heracles.base.Lens.check_path`
+    of the lenses in order.
+
+    """
+    def __init__(self, lenses):
+        """
+        :param lenses: The lenses to resolve in order of preference, any 
+            object with a ``get_filters`` method like 
+            :meth:`heracles.base.Lens.get_filters` can be used.
+        :type lenses: iterable of :class:`heracles.base.Lens`
+
+        """
+        self.lenses = []
+        self._filters = []
+        self._includes = []
+        self._excludes = []
+        self._exact = {}
+        self._basenames = {}
+        self._prefixes = {}
+        self._anywhere = set()
+        self._cache = {}
+        for lens in lenses:
+            self._add_lens(lens)
+
+    def _add_lens(self, lens):
+        position = len(self.lenses)
+        filters = lens.get_filters()
+        for glob, include in filters:
+            if include:
+                self._index_glob(glob, position)
+        self.lenses.append(lens)
+        self._filters.append(filters)
+        self._includes.append(None)
+        self._excludes.append(None)
+
+    def _compile(self, position):
+        includes = []
+        excludes = []
+        for glob, include in self._filters[position]:
+            if include:
+                includes.append(compile_glob(glob))
+            else:
+                excludes.append(compile_glob(glob))
+        self._includes[position] = includes
+        self._excludes[position] = excludes
+
+    def _index_glob(self, glob, position):
+        if not has_magic(glob):
+            self._exact.setdefault(glob, set()).add(position)
+            return
+        slash = glob.rfind("/")
+        basename = glob[slash + 1:]
+        if slash != -1 and not has_magic(basename) and "]" not in basename:
+            self._basenames.setdefault(basename, set()).add(position)
+            return
+        prefix = literal_prefix(glob)
+        if prefix:
+            self._prefixes.setdefault(prefix, set()).add(position)
+        else:
+            self._anywhere.add(position)
+
+    def _candidates(self, path):
+        candidates = set(self._anywhere)
+        candidates.update(self._exact.get(path, ()))
+        candidates.update(self._basenames.get(path[path.rfind("/") + 1:], ()))
+        for prefix in dir_prefixes(path):
+            candidates.update(self._prefixes.get(prefix, ()))
+        return sorted(candidates)
+
+    def _check(self, position, path):
+        if self._includes[position] is None:
+            self._compile(position)
+        positive = False
+        for match in self._includes[position]:
+            if match(path):
+                positive = True
+                break
+        if not positive:
+            return False
+        for match in self._excludes[position]:
+            if match(path):
+                return False
+        return True
+
+    def resolve(self, path):
+        """
+        Returns the lens that parses ``path`` or ``None`` if there is none.
+
+        :param path: The path of the file.
+        :type path: str
+        :rtype: :class:`heracles.base.Lens`
+
+        """
+        try:
+            result = self._cache[path]
+        except KeyError:
+            pass
+        else:
+            if instrument.enabled:
+                instrument.count('resolve.hits')
+            return result
+        if instrument.enabled:
+            instrument.count('resolve.misses')
+        result = None
+        for position in self._candidates(path):
+            if self._check(position, path):
+                result = self.lenses[position]
+                break
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[path] = result
+        return result
+
+    def __repr__(self):
+        return "<%s lenses:%d>" % (self.__class__.__name__, len(self.lenses))
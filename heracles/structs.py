@@ -1,5 +1,9 @@
 import ctypes as c
 
+UINT_MAX = 0xffffffff
+# Value of the ``ref`` field of the structs that are never freed by unref
+REF_MAX = UINT_MAX
+
 # c.Structure predefinition
 
 class struct_heracles(c.Structure):
@@ -28,12 +32,18 @@ class struct_module(c.Structure):
 class struct_lens(c.Structure):
     pass
 
+class struct_regexp(c.Structure):
+    pass
+
 class struct_filter(c.Structure):
     pass
 
 class struct_lns_error(c.Structure):
     pass
 
+class struct_memstream(c.Structure):
+    pass
+
 # Not defined fields
 
 class struct_pathx_symtab(c.Structure):
@@ -45,6 +55,44 @@ class struct_transform(c.Structure):
 class struct_binding(c.Structure):
     pass
 
+# Tags of struct_lens
+
+L_DEL = 42
+L_STORE = 43
+L_VALUE = 44
+L_KEY = 45
+L_LABEL = 46
+L_SEQ = 47
+L_COUNTER = 48
+L_CONCAT = 49
+L_UNION = 50
+L_SUBTREE = 51
+L_STAR = 52
+L_MAYBE = 53
+L_REC = 54
+L_SQUARE = 55
+
+# Members of the anonymous union of struct_lens
+
+class struct_lens_primitive(c.Structure):
+    _fields_ = [('regexp', c.POINTER(struct_regexp)),
+                ('string', c.POINTER(struct_string))]
+
+class struct_lens_combinator(c.Structure):
+    _fields_ = [('nchildren', c.c_uint),
+                ('children', c.POINTER(c.POINTER(struct_lens)))]
+
+class struct_lens_recursive(c.Structure):
+    _fields_ = [('body', c.POINTER(struct_lens)),
+                ('alias', c.POINTER(struct_lens))]
+
+class union_lens(c.Union):
+    _anonymous_ = ('primitive', 'combinator', 'recursive_lens')
+    _fields_ = [('primitive', struct_lens_primitive),
+                ('child', c.POINTER(struct_lens)),
+                ('combinator', struct_lens_combinator),
+                ('recursive_lens', struct_lens_recursive)]
+
 # Load fields
 
 struct_string._fields_ = [('ref', c.c_uint),
@@ -62,8 +110,10 @@ struct_info._fields_ = [('error', c.POINTER(struct_error)),
 struct_error._fields_ = [('code', c.c_int),
                 ('minor', c.c_int),
                 ('details', c.c_char_p),
+                ('minor_details', c.c_char_p),
                 ('info', c.POINTER(struct_info)),
-                ('hera', c.POINTER(struct_heracles))]
+                ('hera', c.POINTER(struct_heracles)),
+                ('exn', c.c_void_p)]
 
 struct_heracles._fields_ = [('origin', struct_tree_p),
                 ('root', c.c_char_p),
@@ -76,6 +126,14 @@ struct_heracles._fields_ = [('origin', struct_tree_p),
                 ('api_entries', c.c_uint),
                 ]
 
+struct_span._fields_ = [('filename', c.POINTER(struct_string)),
+                ('label_start', c.c_uint),
+                ('label_end', c.c_uint),
+                ('value_start', c.c_uint),
+                ('value_end', c.c_uint),
+                ('span_start', c.c_uint),
+                ('span_end', c.c_uint)]
+
 struct_tree._fields_ = [('next', struct_tree_p),
                 ('parent', struct_tree_p),
                 ('label', c.c_char_p),
@@ -99,6 +157,33 @@ struct_lns_error._fields_ = [('lens', c.POINTER(struct_lens)),
                 ('path', c.c_char_p),
                 ('message', c.c_char_p)]
 
+struct_memstream._fields_ = [('stream', c.c_void_p),
+                ('buf', c.c_void_p),
+                ('size', c.c_size_t)]
+
+struct_regexp._fields_ = [('ref', c.c_uint),
+                ('info', c.POINTER(struct_info)),
+                ('pattern', c.POINTER(struct_string)),
+                ('re', c.c_void_p),
+                ('nocase', c.c_uint, 1)]
+
+struct_lens._anonymous_ = ('u',)
+struct_lens._fields_ = [('ref', c.c_uint),
+                ('tag', c.c_int),
+                ('info', c.POINTER(struct_info)),
+                ('ctype', c.POINTER(struct_regexp)),
+                ('atype', c.POINTER(struct_regexp)),
+                ('ktype', c.POINTER(struct_regexp)),
+                ('vtype', c.POINTER(struct_regexp)),
+                ('jmt', c.c_void_p),
+                ('value', c.c_uint, 1),
+                ('key', c.c_uint, 1),
+                ('recursive', c.c_uint, 1),
+                ('consumes_value', c.c_uint, 1),
+                ('rec_internal', c.c_uint, 1),
+                ('ctype_nullable', c.c_uint, 1),
+                ('u', union_lens)]
+
 struct_filter._fields_ = [('ref', c.c_uint),
                 ('next', c.POINTER(struct_filter)),
                 ('glob', c.POINTER(struct_string)),
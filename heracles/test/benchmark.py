@@ -0,0 +1,333 @@
+"""
+Benchmarks of heracles. They take a while so they are not part of the main
+test suite, run them with::
+
+    python -m heracles.test.benchmark --output results.json
+
+The results are written as JSON, so the ones of two commits can be compared
+with::
+
+    python -m heracles.test.benchmark --compare old.json --output new.json
+
+that prints the ratio of every timing to the old one and exits with status
+1 if any of them is slower than the ``--threshold`` ratio. The runs of a
+timing vary, so the relative spread of its runs is added to the threshold,
+and the timings that are slower by less than ``--floor`` seconds are not
+reported.
+
+The benchmarks measure the creation of :class:`heracles.Heracles` objects,
+the resolution of the lens of a path, the get and put of synthetic files of
+the ``Aptsources``, ``Hosts``, ``Fstab`` and ``Sshd`` lenses from 1 to
+100000 lines, and the most common operations of big trees. Every timing is
+the best of ``--repeat`` runs, at least 3, in seconds per call. The
+``init/shared-cached`` and ``resolve/cached`` timings are the cache hits of
+the shared lenses and the resolved paths, and ``init/private`` and
+``resolve/cold`` the loading of the lenses and the first resolution.
+"""
+import os
+import re
+import sys
+import json
+import time
+import platform
+import subprocess
+from timeit import default_timer
+from optparse import OptionParser
+import heracles
+from heracles import Heracles
+from heracles.query import Prefix
+
+LINES = [1, 10, 100, 1000, 10000, 100000]
+REPEAT = 5
+# Least runs of every timing, needed to know its spread
+MIN_REPEAT = 3
+# Slowdown ratio over the compared results reported as a regression
+THRESHOLD = 1.25
+# Least slowdown in seconds reported as a regression, the smaller ones are
+# mostly noise of the machine
+FLOOR = 0.005
+# Least time measured by every run of a timing, fast calls are repeated
+MIN_RUN_TIME = 0.1
+# Least lines of the files of the tree operations
+TREE_MIN_LINES = 100
+
+RESOLVED_PATHS = ["/etc/apt/sources.list", "/etc/hosts", "/etc/fstab",
+        "/etc/ssh/sshd_config", "/etc/apt/sources.list.d/extra.list",
+        "/etc/not/parsed"]
+
+SSHD_LINES = ["Port 22", "ListenAddress 0.0.0.0", "PermitRootLogin no",
+        "AcceptEnv LANG LC_*", "Subsystem sftp /usr/lib/openssh/sftp-server",
+        "AllowUsers alice bob", "X11Forwarding yes", "# sshd option"]
+
+def generate_aptsources(lines):
+    result = []
+    for i in xrange(lines):
+        if i % 10 == 0:
+            result.append("# source %d\n" % i)
+        else:
+            result.append("%s http://mirror%d.example.com/debian "
+                    "squeeze main contrib\n" % (("deb", "deb-src")[i % 2], i))
+    return "".join(result)
+
+def generate_hosts(lines):
+    result = []
+    for i in xrange(lines):
+        if i % 10 == 0:
+            result.append("# host %d\n" % i)
+        else:
+            result.append("10.%d.%d.%d host%d.example.com host%d\n" % (
+                i >> 16 & 255, i >> 8 & 255, i & 255, i, i))
+    return "".join(result)
+
+def generate_fstab(lines):
+    result = []
+    for i in xrange(lines):
+        if i % 10 == 0:
+            result.append("# mount %d\n" % i)
+        else:
+            result.append("/dev/sd%d /mnt/disk%d ext4 defaults,noatime "
+                    "0 2\n" % (i, i))
+    return "".join(result)
+
+def generate_sshd(lines):
+    return "".join(SSHD_LINES[i % len(SSHD_LINES)] + "\n"
+            for i in xrange(lines))
+
+GENERATORS = [
+    ("Aptsources", generate_aptsources),
+    ("Hosts", generate_hosts),
+    ("Fstab", generate_fstab),
+    ("Sshd", generate_sshd),
+]
+
+def measure(function, repeat=REPEAT):
+    """
+    Returns the best time in seconds of ``repeat`` runs of ``function``, 
+    and the relative spread of the median run over the best one. Calls 
+    faster than :data:`MIN_RUN_TIME` are run several times in every run and
+    the time is divided among them.
+
+    """
+    start = default_timer()
+    function()
+    elapsed = default_timer() - start
+    number = 1
+    if elapsed < MIN_RUN_TIME:
+        number = int(MIN_RUN_TIME / max(elapsed, 1e-6)) + 1
+    times = []
+    for i in xrange(max(repeat, MIN_REPEAT)):
+        start = default_timer()
+        for j in xrange(number):
+            function()
+        times.append((default_timer() - start) / number)
+    times.sort()
+    best = times[0]
+    spread = (times[len(times) // 2] - best) / best if best else 0.0
+    return best, spread
+
+class Benchmark(object):
+    """
+    Runs the benchmarks and collects their results, a dict of the name of
+    every timing to its seconds, and their ``spreads``, see :func:`measure`.
+
+    """
+    def __init__(self, lines=LINES, repeat=REPEAT, out=None):
+        self.lines = lines
+        self.repeat = repeat
+        self.out = out
+        self.results = {}
+        self.spreads = {}
+
+    def record(self, name, function, repeat=None):
+        seconds, spread = measure(function, repeat or self.repeat)
+        self.results[name] = seconds
+        self.spreads[name] = spread
+        if self.out is not None:
+            self.out.write("%-40s %12.6f s\n" % (name, seconds))
+            self.out.flush()
+        return seconds
+
+    def run(self):
+        self.bench_init()
+        self.bench_resolve()
+        self.bench_lenses()
+        self.bench_trees()
+        return self.results
+
+    def bench_init(self):
+        def init_private():
+            Heracles(shared=False).close()
+        self.record("init/shared-cached", Heracles)
+        self.record("init/private", init_private)
+        self.record("init/modules", lambda: Heracles(modules=['Hosts']))
+
+    def bench_resolve(self):
+        # A private object builds its own resolver instead of reusing the
+        # one of the shared lenses.
+        h = Heracles(shared=False)
+        def resolve():
+            for path in RESOLVED_PATHS:
+                h.get_lens_by_path(path)
+        def resolve_cold():
+            # The globs are compiled again, not taken from the re cache
+            re.purge()
+            h._resolver = None
+            resolve()
+        self.record("resolve/cold", resolve_cold)
+        self.record("resolve/cached", resolve)
+        h.close()
+
+    def bench_lenses(self):
+        h = Heracles()
+        for name, generate in GENERATORS:
+            lens = h.lenses[name]
+            for lines in self.lines:
+                text = generate(lines)
+                tree = lens.get(text)
+                self.record("get/%s/%d" % (name, lines),
+                        lambda: lens.get(text))
+                self.record("put/%s/%d" % (name, lines),
+                        lambda: lens.put(tree))
+                self.record("put-text/%s/%d" % (name, lines),
+                        lambda: lens.put(tree, text))
+
+    def bench_trees(self):
+        h = Heracles()
+        # Smaller files may have no records
+        lines = max(max(self.lines), TREE_MIN_LINES)
+        rows = h.lenses['Aptsources'].get(generate_aptsources(lines))
+        middle = len(rows) // 2
+        def search():
+            rows.search(type="deb-src",
+                    uri="http://mirror1.example.com/debian")
+        def search_prefix():
+            rows.search(uri=Prefix("http://mirror9"))
+        def insert_remove():
+            node = rows.insert_new_node(middle, "#comment")
+            rows.remove(node)
+        def set_value():
+            node = rows[middle]
+            node.value = node.value
+        self.record("listtree/index/%d" % lines, lambda: rows[middle])
+        self.record("listtree/label/%d" % lines, lambda: rows["#comment"])
+        self.record("listtree/search/%d" % lines, search)
+        self.record("listtree/search-prefix/%d" % lines, search_prefix)
+        self.record("listtree/insert-remove/%d" % lines, insert_remove)
+        self.record("listtree/set-value/%d" % lines, set_value)
+        self.record("listtree/serialize/%d" % lines, rows.serialize)
+
+        tree = h.lenses['Sshd'].get(generate_sshd(lines))
+        def label_nodes():
+            nodes = tree["AcceptEnv"]
+            nodes[len(nodes) // 2]
+        def append_remove():
+            node = tree.add_new_node("Banner", "/etc/issue")
+            tree.remove(node)
+        def match():
+            tree.match("Port[last()]")
+        self.record("tree/label/%d" % lines, lambda: tree["Port"])
+        self.record("tree/labelnodelist/%d" % lines, label_nodes)
+        self.record("tree/append-remove/%d" % lines, append_remove)
+        self.record("tree/match/%d" % lines, match)
+        self.record("tree/serialize/%d" % lines, tree.serialize)
+
+def get_commit():
+    """
+    Returns the git commit of the heracles sources or ``None``.
+
+    """
+    directory = os.path.dirname(os.path.dirname(
+            os.path.abspath(heracles.__file__)))
+    try:
+        process = subprocess.Popen(["git", "rev-parse", "HEAD"],
+                cwd=directory, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return output.strip()
+
+def build_report(benchmark, options):
+    return {
+        "version": heracles.__version__,
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": int(time.time()),
+        "lines": options.lines,
+        "repeat": options.repeat,
+        "results": benchmark.results,
+        "spreads": benchmark.spreads,
+    }
+
+def compare(old_results, new_results, threshold=THRESHOLD, out=sys.stdout,
+        floor=FLOOR, old_spreads=None, new_spreads=None):
+    """
+    Prints the ratio of the ``new_results`` to the ``old_results`` and
+    returns the names of the timings slower than ``threshold`` plus the
+    largest of their spreads, and by more than ``floor`` seconds.
+
+    """
+    old_spreads = old_spreads or {}
+    new_spreads = new_spreads or {}
+    regressions = []
+    for name in sorted(new_results):
+        old = old_results.get(name)
+        new = new_results[name]
+        if not old:
+            out.write("%-40s %12.6f s          new\n" % (name, new))
+            continue
+        ratio = new / old
+        limit = threshold + max(old_spreads.get(name, 0.0), 
+                new_spreads.get(name, 0.0))
+        mark = ""
+        if ratio > limit and new - old > floor:
+            regressions.append(name)
+            mark = " slower"
+        out.write("%-40s %12.6f s %8.2fx%s\n" % (name, new, ratio, mark))
+    return regressions
+
+def parse_lines(option, opt_str, value, parser):
+    setattr(parser.values, option.dest, [int(v) for v in value.split(",")])
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--output", help="write the results to FILE",
+            metavar="FILE")
+    parser.add_option("-c", "--compare", metavar="FILE",
+            help="compare the results with the ones of FILE")
+    parser.add_option("-l", "--lines", type="string", default=LINES,
+            action="callback", callback=parse_lines,
+            help="comma separated line counts of the files [%default]")
+    parser.add_option("-r", "--repeat", type="int", default=REPEAT,
+            help="runs of every timing [%default]")
+    parser.add_option("-t", "--threshold", type="float", default=THRESHOLD,
+            help="slowdown ratio reported as regression [%default]")
+    parser.add_option("-f", "--floor", type="float", default=FLOOR,
+            help="least slowdown in seconds reported as regression "
+            "[%default]")
+    options, args = parser.parse_args(args)
+
+    old_report = None
+    if options.compare:
+        with open(options.compare) as f:
+            old_report = json.load(f)
+    out = sys.stdout if old_report is None else None
+    benchmark = Benchmark(options.lines, options.repeat, out)
+    benchmark.run()
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(build_report(benchmark, options), f, indent=2,
+                    sort_keys=True)
+    if old_report is not None:
+        if compare(old_report["results"], benchmark.results, 
+                options.threshold, floor=options.floor,
+                old_spreads=old_report.get("spreads"), 
+                new_spreads=benchmark.spreads):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,115 @@
+"""
+Leak regression tests of the memory allocated by libheracles. They take a
+while so they are not part of the main test suite, run them with::
+
+    python -m unittest heracles.test.memory
+
+The number of get/put cycles can be changed with the
+``HERACLES_MEMORY_CYCLES`` environment variable.
+
+:class:`NodeMemoryTest` measures the resident memory used by every node of a
+big parsed tree.
+"""
+import os
+import gc
+import sys
+import resource
+from os.path import dirname, realpath, join
+from unittest import TestCase
 from heracles import Heracles
+from heracles.exceptions import HeraclesLensError
+
+CURRENT_DIR = dirname(realpath(__file__))
+DATA_FILE = join(CURRENT_DIR, "data/sources.list")
+
+CYCLES = int(os.environ.get("HERACLES_MEMORY_CYCLES", 100000))
+HANDLE_CYCLES = 100
+# Cycles run before measuring, so the allocator pools are already grown
+WARMUP = 2000
+# Allowed growth of the resident memory after the warm up
+MAX_GROWTH = 4 * 1024 * 1024
+# Lines of the file parsed to measure the memory of the nodes
+NODE_LINES = 50000
+# Allowed resident memory per node of a parsed tree
+MAX_NODE_SIZE = 500
+
+def get_rss():
+    """
+    Returns the resident memory of the process in bytes. Where /proc is not
+    available the peak resident memory is used instead.
+
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+class MemoryTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.heracles = Heracles(shared=False)
+        self.lens = self.heracles.lenses['Aptsources']
+
+    def tearDown(self):
+        self.heracles.close()
+
+    def assertFlat(self, function, cycles):
+        for i in xrange(WARMUP):
+            function()
+        rss = get_rss()
+        for i in xrange(cycles):
+            function()
+        growth = get_rss() - rss
+        self.assertTrue(growth < MAX_GROWTH, "RSS grew %d bytes in %d cycles"
+                % (growth, cycles))
+
+    def test_get_put(self):
+        def cycle():
+            tree = self.lens.get(self.text)
+            self.lens.put(tree, self.text)
+        self.assertFlat(cycle, CYCLES)
+
+    def test_lazy_get(self):
+        def cycle():
+            tree = self.lens.get(self.text, lazy=True)
+            tree[0].children
+        self.assertFlat(cycle, CYCLES // 10)
+
+    def test_errors(self):
+        tree = self.lens.get(self.text)
+        tree[0].children['x'] = "y"
+        def cycle():
+            self.assertRaises(HeraclesLensError, self.lens.get, "deb\n")
+            self.assertRaises(HeraclesLensError, self.lens.put, tree,
+                    self.text)
+        self.assertFlat(cycle, CYCLES // 10)
+
+    def test_handles(self):
+        rss = None
+        for i in xrange(HANDLE_CYCLES):
+            with Heracles(shared=False) as h:
+                h.lenses['Aptsources'].get(self.text)
+            if i == HANDLE_CYCLES // 4:
+                rss = get_rss()
+        growth = get_rss() - rss
+        self.assertTrue(growth < MAX_GROWTH, "RSS grew %d bytes" % growth)
 
-for i in range(0,50):
-    h = Heracles()
-    del h
+def count_nodes(tree):
+    return sum(1 + count_nodes(node._get_child_nodes()) for node in tree)
 
+class NodeMemoryTest(TestCase):
+    def test_node_size(self):
+        lens = Heracles().lenses['Aptsources']
+        line = "deb http://ftp.es.debian.org/debian/ squeeze main contrib\n"
+        text = "".join("# comment %d\n" % i if i % 5 == 0 else line 
+                for i in xrange(NODE_LINES))
+        # The first get grows the heap of libheracles
+        lens.get(text)
+        gc.collect()
+        rss = get_rss()
+        tree = lens.get(text)
+        gc.collect()
+        size = (get_rss() - rss) / float(count_nodes(tree))
+        self.assertTrue(size < MAX_NODE_SIZE, "%d bytes per node" % size)
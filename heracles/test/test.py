@@ -1,9 +1,34 @@
+import os
+import gc
+import shutil
+import weakref
+import mmap
+import logging
+import threading
+import tempfile
+from StringIO import StringIO
 from os.path import dirname, realpath, join
 import ctypes as c
-from unittest import TestCase
-from heracles import Heracles, Tree, ListTree, TreeNode, ListTreeNode
-from heracles.raw import ManagedRawTree 
+from unittest import TestCase, skipIf
+from heracles import (Heracles, preload, save_all, stats, Tree, ListTree, 
+        TreeNode, ListTreeNode)
+from heracles import instrument
+from heracles.raw import (ManagedRawTree, NativeRawTree, 
+        get_nodes_from_records, export_tree)
+from heracles.libs import libheracles_ext
+from heracles.base import iter_lenses
+from heracles.structs import REF_MAX, struct_error
 from heracles.tree import check_list_nodes
+from heracles.exceptions import (HeraclesError, HeraclesLensError,
+        HeraclesNoLensError, HeraclesTreeError, HeraclesPathXError, 
+        HeraclesMMatchError, HeraclesNoMatchError, HeraclesSaveError)
+from heracles.cache import ParseCache
+from heracles.lenscache import LensCache
+from heracles.resolver import LensResolver, CACHE_SIZE
+from heracles.batch import parse_path
+from heracles.columnar import ColumnarListTree
+from heracles.query import Predicate, In, Prefix, Regex
+from heracles.test import benchmark
 
 CURRENT_DIR = dirname(realpath(__file__))
 DATA_FILE = join(CURRENT_DIR, "data/sources.list")
@@ -24,6 +49,15 @@ def check_serialized_equal(test, data, tree):
         test.assertEqual(s['value'], o.value)
         check_serialized_equal(test, s['children'], o.children)
 
+def get_filter_paths():
+    paths = ["/etc/xudoers", "/etc/apt/sources.list~", "/etc/hosts"]
+    for lens in heracles.lenses:
+        for f in lens._iter_filters():
+            glob = f.contents.glob.contents.str
+            paths.append(glob.replace("*", "x").replace("?", "y"))
+            paths.append(glob.replace("*", "a/b.bak"))
+    return paths
+
 class HeraclesTest(TestCase):
     def setUp(self):
         self.text = file(DATA_FILE).read()
@@ -47,6 +81,460 @@ class HeraclesTest(TestCase):
     def test_list_tree(self):
         self.assertEqual(self.tree[0].value, "")
 
+class LazyGetTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.lens = heracles.lenses['Aptsources']
+
+    def test_lazy(self):
+        tree = self.lens.get(self.text, lazy=True)
+        self.assertTrue(isinstance(tree, ListTree))
+        self.assertTrue(tree[0]._loader is not None)
+        self.assertEqual(tree[0].children['type'].value, "deb")
+        self.assertTrue(tree[0]._loader is None)
+        self.assertTrue(tree[1]._loader is not None)
+        check_equal_tree(self, self.lens.get(self.text), tree)
+        self.assertEqual(self.lens.put(tree, self.text), self.text)
+
+    def test_raw_tree_release(self):
+        tree = self.lens.get(self.text, lazy=True)
+        raw_tree = weakref.ref(tree[0]._loader.raw_tree)
+        tree[0].children
+        gc.collect()
+        self.assertTrue(raw_tree() is not None)
+        tree[1].children
+        gc.collect()
+        self.assertTrue(raw_tree() is None)
+
+    def test_close(self):
+        tree = self.lens.get(self.text, lazy=True)
+        raw_tree = weakref.ref(tree[0]._loader.raw_tree)
+        tree.close()
+        gc.collect()
+        self.assertTrue(raw_tree() is None)
+        check_equal_tree(self, self.lens.get(self.text), tree)
+
+class IncrementalPutTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.lens = heracles.lenses['Aptsources']
+        self.tree = self.lens.get(self.text, spans=True)
+
+    def test_spans(self):
+        for node in self.tree[0].children:
+            span = node._span
+            self.assertEqual(self.text[span[2]:span[3]], node.value)
+        lazy_tree = self.lens.get(self.text, lazy=True, spans=True)
+        self.assertEqual([n._span for n in lazy_tree[1].children],
+                [n._span for n in self.tree[1].children])
+
+    def test_value_change(self):
+        self.tree[0].children['uri'].value = "http://example.com/debian/"
+        self.tree[1].children['distribution'].value = "wheezy"
+        self.assertEqual(len(self.tree._changed_values), 2)
+        text = self.lens.put(self.tree, self.text, incremental=True)
+        self.assertEqual(text, self.lens.put(self.tree, self.text))
+        self.assertTrue("http://example.com/debian/ squeeze" in text)
+
+    def test_structure_change(self):
+        self.tree[0].children['uri'].value = "http://example.com/debian/"
+        self.tree.remove(self.tree[1])
+        self.assertTrue(self.tree._changed_structure)
+        self.assertTrue(self.tree._splice_changes(self.text) is None)
+        self.assertEqual(self.lens.put(self.tree, self.text, 
+            incremental=True), self.lens.put(self.tree, self.text))
+
+    def test_no_spans(self):
+        tree = self.lens.get(self.text)
+        tree[0].children['uri'].value = "http://example.com/debian/"
+        self.assertTrue(tree._splice_changes(self.text) is None)
+        self.assertEqual(tree.put(self.text, incremental=True), 
+                self.lens.put(tree, self.text))
+
+class FileGetPutTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = join(self.directory, "sources.list")
+        self.lens = heracles.lenses['Aptsources']
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_get_file(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+        tree = self.lens.get_file(self.path)
+        self.assertEqual(tree.path, self.path)
+        check_equal_tree(self, tree, self.lens.get(text))
+        self.assertEqual(len(tree), len(self.lens.get(text)))
+
+    def test_get_file(self):
+        text = file(DATA_FILE).read()
+        self.check_get_file(text)
+        self.check_get_file(text.rstrip("\n"))
+        self.check_get_file("")
+        line = "deb http://ftp.debian.org/debian squeeze main\n"
+        self.check_get_file(line + "#" * (mmap.PAGESIZE - len(line) - 1) + 
+                "\n")
+
+    def test_get_file_columnar(self):
+        shutil.copy(DATA_FILE, self.path)
+        tree = self.lens.get_file(self.path, columnar=True)
+        self.assertTrue(isinstance(tree, ColumnarListTree))
+        self.assertRaises(HeraclesError, self.lens.get_file, self.path, 
+                lazy=True, columnar=True)
+
+    def test_put_file(self):
+        text = file(DATA_FILE).read()
+        tree = self.lens.get(text)
+        tree[0].children['distribution'].value = "wheezy"
+        expected = self.lens.put(tree, text)
+        with open(self.path, "w") as f:
+            f.write("#\n")
+            self.assertEqual(self.lens.put_file(tree, f, text), 
+                    len(expected))
+        self.assertEqual(file(self.path).read(), "#\n" + expected)
+        fd = os.open(self.path, os.O_WRONLY | os.O_TRUNC)
+        try:
+            self.lens.put_file(tree, fd)
+        finally:
+            os.close(fd)
+        self.assertEqual(file(self.path).read(), self.lens.put(tree))
+
+    def test_put_file_error(self):
+        tree = self.lens.get(file(DATA_FILE).read())
+        tree[0].children['bad'] = "value"
+        with open(self.path, "w") as f:
+            self.assertRaises(HeraclesLensError, self.lens.put_file, tree, f)
+        self.assertEqual(file(self.path).read(), "")
+
+class RecordsTest(TestCase):
+    def setUp(self):
+        self.lens = heracles.lenses['Aptsources']
+        self.text = benchmark.generate_aptsources(500)
+
+    def check_records(self, records):
+        tree = self.lens.get(self.text)
+        self.assertEqual(len(records), len(tree))
+        check_equal_tree(self, records, tree)
+        self.assertEqual([r.label for r in records], 
+                [n.label for n in tree])
+
+    def test_fileobj(self):
+        records = self.lens.iter_records(StringIO(self.text), 
+                chunk_size=1000)
+        self.assertEqual(records.next().label, "1")
+        self.check_records([self.lens.get(self.text)[0]] + list(records))
+
+    def test_detached(self):
+        records = self.lens.iter_records(StringIO(self.text), 
+                chunk_size=1000)
+        record = records.next()
+        self.assertTrue(record._tree is None and record.parent is None)
+        for other in records:
+            self.assertTrue(other._tree is None)
+        self.assertEqual(record.label, "1")
+        # No list of the nodes of its piece references it
+        self.assertEqual([r for r in gc.get_referrers(record) 
+            if isinstance(r, list)], [])
+        record.children['type'].value = "deb-src"
+
+    def test_path(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = join(directory, "sources.list")
+            with open(path, "w") as f:
+                f.write(self.text)
+            self.check_records(list(self.lens.iter_records(path)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_error(self):
+        records = self.lens.iter_records(StringIO(self.text + "deb\n"), 
+                chunk_size=1000)
+        self.assertRaises(HeraclesLensError, list, records)
+        self.assertEqual(list(self.lens.iter_records(StringIO(""))), [])
+
+    def test_error_line(self):
+        lines = self.text.splitlines(True)
+        fileobj = StringIO("".join(lines[:100] + ["deb\n"] + lines[100:]))
+        records = self.lens.iter_records(fileobj, chunk_size=1000)
+        try:
+            list(records)
+        except HeraclesLensError as e:
+            first, last = [int(n) for n in str(e).split()[-3::2]]
+        else:
+            self.fail("HeraclesLensError not raised")
+        self.assertTrue(first <= 101 <= last)
+        # The piece was extended once, the rest of the file was not read
+        self.assertTrue(last - first < 3 * 1000 // 50)
+        self.assertTrue(fileobj.tell() < len(fileobj.getvalue()) // 2)
+
+class SaveTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = join(self.directory, "sources.list")
+        shutil.copy(DATA_FILE, self.path)
+        self.text = file(DATA_FILE).read()
+        self.tree = parse_path(heracles.lenses['Aptsources'], self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_dirty(self):
+        self.assertFalse(self.tree.is_dirty)
+        node = self.tree[0].children['uri'][0]
+        node.value = "http://example.com/debian/"
+        self.assertTrue(self.tree[0].children.is_dirty)
+        self.assertEqual(self.tree.changed_nodes(), [node])
+        node.value = "http://ftp.es.debian.org/debian/"
+        self.assertFalse(self.tree.is_dirty)
+        self.assertEqual(self.tree.changed_nodes(), [])
+        new_node = self.tree.add_new_node("")
+        self.tree[0].children['uri'][0].label = "url"
+        self.assertTrue(self.tree.is_dirty)
+        self.assertEqual(self.tree.changed_nodes(), [node, new_node])
+        self.tree.remove(new_node)
+        self.assertEqual(self.tree.changed_nodes(), [node])
+
+    def test_remove(self):
+        self.tree.remove(self.tree[0])
+        self.assertTrue(self.tree.is_dirty)
+        self.assertEqual(self.tree.changed_nodes(), [])
+
+    def test_remove_forgets_changes(self):
+        node = self.tree[0]
+        node.children['distribution'].value = "wheezy"
+        node.children.add_new_node("x", "y")
+        self.tree[1].children['distribution'].value = "wheezy"
+        self.tree.remove(node)
+        self.tree[0] = TreeNode(value="deb")
+        self.assertTrue(self.tree.is_dirty)
+        self.assertEqual(self.tree.changed_nodes(), [self.tree[0]])
+        self.assertEqual(len(self.tree._changed_nodes), 1)
+        self.assertEqual(self.tree._changed_values, {})
+        self.assertEqual(self.tree._changed_count, 0)
+
+    def test_clean_save(self):
+        mtime = int(os.stat(self.path).st_mtime) - 10
+        os.utime(self.path, (mtime, mtime))
+        self.assertFalse(self.tree.save())
+        self.assertEqual(os.stat(self.path).st_mtime, mtime)
+        os.remove(self.path)
+        self.assertTrue(self.tree.save())
+        self.assertEqual(file(self.path).read(), self.tree.put())
+
+    def test_save(self):
+        self.tree[0].children['distribution'].value = "wheezy"
+        mtime = int(os.stat(self.path).st_mtime) - 10
+        os.utime(self.path, (mtime, mtime))
+        self.assertTrue(self.tree.save(self.text))
+        self.assertFalse(self.tree.is_dirty)
+        self.assertTrue("deb http://ftp.es.debian.org/debian/ wheezy" in 
+                file(self.path).read())
+        self.tree[0].children['distribution'].value = "squeeze"
+        self.tree[0].children['distribution'].value = "wheezy"
+        text = file(self.path).read()
+        mtime = int(os.stat(self.path).st_mtime) - 10
+        os.utime(self.path, (mtime, mtime))
+        self.assertFalse(self.tree.save(text))
+        self.assertEqual(os.stat(self.path).st_mtime, mtime)
+
+    def test_atomic_save(self):
+        os.chmod(self.path, 0640)
+        link = join(self.directory, "link.list")
+        os.symlink(self.path, link)
+        self.tree.path = link
+        self.tree[0].children['distribution'].value = "wheezy"
+        self.assertTrue(self.tree.save(atomic=True))
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0640)
+        self.assertEqual(file(self.path).read(), self.tree.put())
+        self.assertEqual(sorted(os.listdir(self.directory)), 
+                ["link.list", "sources.list"])
+
+    def get_trees(self):
+        paths = [join(self.directory, "%d.list" % i) for i in range(3)]
+        for path in paths:
+            shutil.copy(DATA_FILE, path)
+        return [parse_path(heracles.lenses['Aptsources'], path) 
+                for path in paths]
+
+    def test_save_all(self):
+        trees = self.get_trees()
+        for tree in trees[:2]:
+            tree[0].children['distribution'].value = "wheezy"
+        self.assertEqual(save_all(trees), [trees[0].path, trees[1].path])
+        self.assertFalse(trees[0].is_dirty)
+        for tree in trees:
+            self.assertEqual(file(tree.path).read(), tree.put())
+        self.assertEqual(save_all(trees), [])
+
+    def test_save_all_workers(self):
+        trees = self.get_trees()
+        for tree in trees:
+            tree[0].children['distribution'].value = "wheezy"
+        self.assertEqual(save_all(trees, workers=2), 
+                [tree.path for tree in trees])
+        for tree in trees:
+            self.assertEqual(file(tree.path).read(), tree.put())
+
+    def test_save_all_error(self):
+        trees = self.get_trees()
+        trees[0][0].children['distribution'].value = "wheezy"
+        trees[1][0].children['x'] = "y"
+        self.assertRaises(HeraclesLensError, save_all, trees)
+        self.assertEqual(file(trees[0].path).read(), self.text)
+        self.assertTrue(trees[0].is_dirty)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def test_save_all_rename_error(self):
+        trees = self.get_trees()
+        for tree in trees:
+            tree[0].children['distribution'].value = "wheezy"
+        # A file can't be renamed over a directory that is not empty
+        os.remove(trees[1].path)
+        os.mkdir(trees[1].path)
+        file(join(trees[1].path, "x"), "w").close()
+        try:
+            save_all(trees)
+        except HeraclesSaveError as e:
+            self.assertEqual(e.committed, [trees[0].path])
+        else:
+            self.fail("HeraclesSaveError not raised")
+        self.assertEqual(file(trees[0].path).read(), trees[0].put())
+        self.assertFalse(trees[0].is_dirty)
+        self.assertTrue(trees[1].is_dirty and trees[2].is_dirty)
+        self.assertEqual(file(trees[2].path).read(), self.text)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def test_save_all_same_path(self):
+        trees = self.get_trees()
+        trees.append(parse_path(heracles.lenses['Aptsources'], 
+            trees[0].path))
+        for tree in trees:
+            tree[0].children['distribution'].value = "wheezy"
+        self.assertRaises(HeraclesSaveError, save_all, trees)
+        self.assertEqual(file(trees[0].path).read(), self.text)
+
+class OwnershipTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.lens = heracles.lenses['Aptsources']
+
+    def test_get_error(self):
+        self.assertRaises(HeraclesLensError, self.lens.get, "deb\n")
+
+    def test_put_error(self):
+        tree = self.lens.get(self.text)
+        tree[0].children['x'] = "y"
+        self.assertRaises(HeraclesLensError, self.lens.put, tree, self.text)
+
+    def test_missing_newline(self):
+        text = self.text.rstrip("\n")
+        check_equal_tree(self, self.lens.get(self.text), self.lens.get(text))
+        self.assertEqual(text, self.text.rstrip("\n"))
+
+    def test_context_manager(self):
+        with Heracles(shared=False) as h:
+            lens = h.lenses['Aptsources']
+            tree = lens.get(self.text)
+        self.assertTrue(h._handle is None)
+        self.assertRaises(HeraclesError, lens.get, self.text)
+        self.assertRaises(HeraclesError, lens.put, tree, self.text)
+        check_equal_tree(self, self.lens.get(self.text), tree)
+        h.close()
+
+    def test_collectable(self):
+        h = Heracles()
+        h.lenses['Aptsources'].get(self.text)
+        ref = weakref.ref(h)
+        del h
+        gc.collect()
+        self.assertTrue(ref() is None)
+
+class SharedTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+
+    def test_shared(self):
+        h1 = Heracles()
+        h2 = Heracles()
+        h3 = Heracles(shared=False)
+        address = c.addressof(h1._handle.contents)
+        self.assertEqual(address, c.addressof(h2._handle.contents))
+        self.assertNotEqual(address, c.addressof(h3._handle.contents))
+        self.assertFalse(h1.lenses is h2.lenses)
+        h1.close()
+        h3.close()
+        check_equal_tree(self, heracles.lenses['Aptsources'].get(self.text),
+                h2.lenses['Aptsources'].get(self.text))
+
+    @skipIf(not hasattr(os, "fork"), "fork is not available")
+    def test_fork(self):
+        address = c.addressof(preload()._handle.contents)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                h = Heracles()
+                if c.addressof(h._handle.contents) == address:
+                    h.lenses['Aptsources'].get(self.text)
+                    status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+class SelectiveLoadTest(TestCase):
+    def setUp(self):
+        self.h = Heracles(modules=['Aptsources'], shared=False)
+
+    def tearDown(self):
+        self.h.close()
+
+    def test_modules(self):
+        self.assertEqual(self.h.lenses.keys(), ['Aptsources'])
+        text = file(DATA_FILE).read()
+        check_equal_tree(self, heracles.lenses['Aptsources'].get(text),
+                self.h.lenses['Aptsources'].get(text))
+
+    def test_lazy_lookup(self):
+        lens = self.h.lenses['Aptsources']
+        self.assertTrue('Hosts' in self.h.lenses)
+        self.assertTrue(self.h.lenses['Aptsources'] is lens)
+        self.assertFalse('Xudoers' in self.h.lenses)
+        self.assertRaises(KeyError, self.h.lenses.__getitem__, 'Xudoers')
+        self.assertEqual(self.h.lenses.keys(), ['Aptsources', 'Hosts'])
+
+    def test_resolve(self):
+        self.assertEqual(self.h.resolve_lens("/etc/apt/sources.list").name,
+                "Aptsources")
+        self.assertEqual(len(self.h.lenses), 1)
+        self.assertEqual(self.h.resolve_lens("/etc/fstab").name, "Fstab")
+        self.assertEqual(len(self.h.lenses), len(heracles.lenses))
+
+    def test_missing_module(self):
+        self.assertRaises(HeraclesNoLensError, Heracles, 
+                modules=['Xudoers'], shared=False)
+
+class LensRegistryTest(TestCase):
+    def test_same_instance(self):
+        self.assertTrue(heracles.lenses['Aptsources'] is 
+                heracles.lenses['Aptsources'])
+
+    def test_mapping(self):
+        lenses = heracles.lenses
+        self.assertTrue('Aptsources' in lenses)
+        self.assertFalse('Xudoers' in lenses)
+        self.assertEqual(len(lenses), len(lenses.keys()))
+        self.assertEqual([l.name for l in lenses], lenses.keys())
+        self.assertRaises(KeyError, lenses.__getitem__, 'Xudoers')
+
+    def test_per_instance(self):
+        h = Heracles()
+        self.assertFalse(h.lenses is heracles.lenses)
+        self.assertTrue(h.lenses['Aptsources'].heracles is h)
+
 class FilterTest(TestCase):
     def setUp(self):
         self.text = file(DATA_FILE).read()
@@ -64,6 +552,306 @@ class FilterTest(TestCase):
         l = heracles.get_lens_by_path("/etc/xudoers")
         self.assertTrue(l is None)
 
+class ResolverTest(TestCase):
+    def get_paths(self):
+        return get_filter_paths()
+
+    def test_same_as_check_path(self):
+        for path in self.get_paths()[::20]:
+            expected = None
+            for lens in heracles.lenses:
+                if lens.check_path(path):
+                    expected = lens
+                    break
+            self.assertTrue(heracles.resolve_lens(path) is expected, path)
+
+    def test_resolve_lenses(self):
+        lenses = heracles.resolve_lenses(["/etc/sudoers", "/etc/xudoers"])
+        self.assertEqual(lenses[0].name, "Sudoers")
+        self.assertTrue(lenses[1] is None)
+
+    def test_cache_size(self):
+        resolver = LensResolver(heracles.lenses)
+        for i in xrange(CACHE_SIZE + 10):
+            resolver.resolve("/srv/file%d" % i)
+        self.assertTrue(0 < len(resolver._cache) <= CACHE_SIZE)
+        self.assertEqual(resolver.resolve("/etc/hosts").name, "Hosts")
+
+class InstrumentTest(TestCase):
+    def setUp(self):
+        instrument.reset()
+        instrument.enable()
+        self.events = []
+        self.hook = lambda *args: self.events.append(args)
+        instrument.add_hook(self.hook)
+
+    def tearDown(self):
+        instrument.disable()
+        instrument.remove_hook(self.hook)
+        instrument.reset()
+
+    def test_get_put(self):
+        lens = heracles.lenses['Aptsources']
+        text = file(DATA_FILE).read()
+        tree = lens.get(text)
+        output = lens.put(tree, text)
+        lens_stats = stats()['lenses']['Aptsources']
+        get_stats = lens_stats['get']
+        self.assertEqual(get_stats['parse']['count'], 1)
+        self.assertEqual(get_stats['build']['count'], 1)
+        self.assertEqual(get_stats['nodes']['total'], 
+                len(list(tree.match("//*"))))
+        put_stats = lens_stats['put']
+        self.assertEqual(sorted(put_stats), ['build', 'render', 'size'])
+        self.assertEqual(put_stats['size']['max'], len(output))
+        self.assertEqual([e[:2] for e in self.events], 
+                [('get', 'Aptsources'), ('put', 'Aptsources')])
+        self.assertEqual(sum(put_stats['size']['buckets']), 1)
+
+    def test_failing_hook(self):
+        def fail(*args):
+            raise ValueError("exporter down")
+        lens = heracles.lenses['Aptsources']
+        text = file(DATA_FILE).read()
+        instrument.add_hook(fail)
+        logger = logging.getLogger("heracles.instrument")
+        logger.disabled = True
+        try:
+            tree = lens.get(text)
+            output = lens.put(tree, text)
+        finally:
+            logger.disabled = False
+            instrument.remove_hook(fail)
+        self.assertEqual(output, text)
+        self.assertEqual([e[0] for e in self.events], ['get', 'put'])
+
+    def test_spliced_put(self):
+        lens = heracles.lenses['Aptsources']
+        text = file(DATA_FILE).read()
+        tree = lens.get(text, spans=True)
+        tree[1].children['distribution'].value = "wheezy"
+        lens.put(tree, text, incremental=True)
+        self.assertEqual(sorted(self.events[-1][2]), ['size', 'splice'])
+
+    def test_columnar_nodes(self):
+        lens = heracles.lenses['Aptsources']
+        text = file(DATA_FILE).read()
+        lens.get(text)
+        lens.get(text, columnar=True)
+        nodes = stats()['lenses']['Aptsources']['get']['nodes']
+        self.assertEqual(nodes['min'], nodes['max'])
+
+    def test_resolve(self):
+        h = Heracles(shared=False)
+        h.resolve_lens("/etc/hosts")
+        h.resolve_lens("/etc/hosts")
+        h.resolve_lens("/etc/fstab")
+        self.assertEqual(stats()['counters'], 
+                {'resolve.hits': 1, 'resolve.misses': 2})
+        h.close()
+
+    def test_disabled(self):
+        instrument.disable()
+        heracles.lenses['Hosts'].get("127.0.0.1 localhost\n")
+        heracles.resolve_lens("/etc/hosts")
+        self.assertEqual(stats(), {'lenses': {}, 'counters': {}})
+        self.assertEqual(self.events, [])
+
+class ThreadTest(TestCase):
+    THREADS = 4
+
+    def run_threads(self, function):
+        errors = []
+        def run(i):
+            try:
+                function(i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(i,)) 
+                for i in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_get_put(self):
+        texts = {
+            'Aptsources': benchmark.generate_aptsources(200),
+            'Hosts': benchmark.generate_hosts(200),
+            'Shellvars': "".join('V%d="%d"\n' % (i, i) for i in range(200)),
+        }
+        h = Heracles(shared=False)
+        expected = dict((name, heracles.lenses[name].put(
+            heracles.lenses[name].get(text)))
+            for name, text in texts.iteritems())
+        def parse(i):
+            for j in range(3):
+                for name, text in sorted(texts.iteritems()):
+                    lens = h.lenses[name]
+                    self.assertEqual(lens.put(lens.get(text)), expected[name])
+        self.run_threads(parse)
+        h.close()
+
+    def test_errors(self):
+        lens = heracles.lenses['Aptsources']
+        text = file(DATA_FILE).read()
+        def parse(i):
+            for j in range(10):
+                if i % 2:
+                    self.assertRaises(HeraclesLensError, lens.get, "deb\n")
+                else:
+                    self.assertEqual(len(lens.get(text)), 2)
+        self.run_threads(parse)
+        handle = heracles._get_handle()
+        self.assertEqual(handle.contents.error.contents.code, 0)
+
+    def test_error_refs(self):
+        h = Heracles(shared=False)
+        lens = h.lenses['Aptsources']
+        lenses = list(iter_lenses(lens.lens))
+        refs = sorted((c.addressof(l.contents), l.contents.ref) 
+                for l in lenses)
+        text = file(DATA_FILE).read()
+        tree = lens.get(text)
+        tree[0].children['x'] = "y"
+        def fail(i):
+            for j in range(20):
+                self.assertRaises(HeraclesLensError, lens.get, "deb\n")
+                self.assertRaises(HeraclesLensError, lens.put, tree, text)
+        self.run_threads(fail)
+        self.assertEqual([l.contents.ref for l in lenses], 
+                [REF_MAX] * len(lenses))
+        self.assertEqual(sorted((c.addressof(l.contents), ref)
+            for l, ref in h._owner.pinned), refs)
+        h.close()
+
+    def test_error_struct(self):
+        # struct error of errcode.h, ending with the preallocated exception
+        self.assertEqual(c.sizeof(struct_error), 
+                2 * c.sizeof(c.c_int) + 5 * c.sizeof(c.c_void_p))
+        handle = heracles._get_handle()
+        self.assertTrue(handle.contents.error.contents.exn)
+
+    def test_registry(self):
+        h = Heracles(shared=False)
+        found = []
+        self.run_threads(lambda i: found.append(h.lenses['Hosts']))
+        self.assertEqual(len(set(map(id, found))), 1)
+        self.assertEqual(len(list(h.lenses)), len(h.lenses.keys()))
+        h.close()
+
+    def test_locks(self):
+        lens = heracles.lenses['Hosts']
+        self.assertFalse(isinstance(lens._get_lock(), type(threading.Lock())))
+        self.assertTrue(lens.lens.contents.ctype.contents.re)
+        lock = heracles.lenses['Shellvars']._get_lock()
+        self.assertTrue(isinstance(lock, type(threading.Lock())))
+
+class BatchParseTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.tree = heracles.lenses['Aptsources'].get(self.text)
+
+    def check_results(self, results):
+        self.assertEqual(len(results), 3)
+        for path, tree in results:
+            if path == DATA_FILE:
+                self.assertTrue(isinstance(tree, ListTree))
+                self.assertEqual(tree.path, DATA_FILE)
+                self.assertEqual(tree.lens.name, 'Aptsources')
+                check_equal_tree(self, self.tree, tree)
+                self.assertEqual(tree.put(self.text), self.text)
+            else:
+                self.assertTrue(isinstance(tree, EnvironmentError))
+
+    def test_serial(self):
+        paths = [DATA_FILE, DATA_FILE, join(CURRENT_DIR, "data/none")]
+        results = list(heracles.parse_paths(paths, lens='Aptsources'))
+        self.check_results(results)
+
+    def test_workers(self):
+        paths = [DATA_FILE, join(CURRENT_DIR, "data/none"), DATA_FILE]
+        results = list(heracles.parse_paths(paths, workers=2, 
+            lens=heracles.lenses['Aptsources']))
+        self.check_results(results)
+
+    def test_no_lens(self):
+        results = list(heracles.parse_paths(["/etc/xudoers"]))
+        self.assertTrue(isinstance(results[0][1], HeraclesNoLensError))
+
+    def test_directory(self):
+        results = list(heracles.parse_directory(CURRENT_DIR, 
+            pattern="*.list", lens='Aptsources'))
+        self.assertEqual([path for path, tree in results], [DATA_FILE])
+        self.assertEqual(list(heracles.parse_directory(CURRENT_DIR)), [])
+
+class LensCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = LensCache(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resolve(self):
+        h = Heracles(lens_cache=self.cache, shared=False)
+        self.assertEqual(len(h.lenses), 0)
+        self.assertEqual(h.resolve_lens("/etc/fstab").name, "Fstab")
+        self.assertTrue(h.resolve_lens("/etc/xudoers") is None)
+        self.assertEqual(h.lenses.keys(), ["Fstab"])
+        h.close()
+        index = LensCache(self.dir).load(h._load_dirs)
+        self.assertEqual(len(index), len(heracles.lenses))
+        for path in get_filter_paths()[::20]:
+            lens = heracles.resolve_lens(path)
+            indexed = index.resolve(path)
+            self.assertEqual(lens and lens.name, indexed and indexed.name)
+
+    def test_outdated(self):
+        load_dirs = heracles._load_dirs + [self.dir]
+        self.cache.store(load_dirs, heracles.lenses)
+        self.assertTrue(LensCache(self.dir).load(load_dirs) is not None)
+        file(join(self.dir, "new.aug"), "w").close()
+        self.assertTrue(self.cache.load(load_dirs) is None)
+
+class ParseCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = join(self.dir, "sources.list")
+        shutil.copy(DATA_FILE, self.path)
+        os.utime(self.path, (1000000000, 1000000000))
+        self.cache = ParseCache(join(self.dir, "cache"))
+        self.lens = heracles.lenses['Aptsources']
+        self.text = file(DATA_FILE).read()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get(self):
+        tree = self.cache.get(self.lens, self.text)
+        ctree = self.cache.get(self.lens, self.text)
+        self.assertTrue(ctree is not tree)
+        check_equal_tree(self, tree, ctree)
+        self.assertEqual(ctree.put(self.text), self.text)
+
+    def test_parse_file(self):
+        tree = self.cache.parse_file(self.lens, self.path)
+        ctree = self.cache.load_file(self.lens, self.path)
+        self.assertEqual(ctree.path, self.path)
+        check_equal_tree(self, tree, ctree)
+        with open(self.path, "a") as f:
+            f.write("deb http://example.com/debian/ squeeze main\n")
+        os.utime(self.path, (1000000001, 1000000001))
+        self.assertTrue(self.cache.load_file(self.lens, self.path) is None)
+        tree = self.cache.parse_file(self.lens, self.path)
+        self.assertEqual(len(tree), 3)
+
+    def test_evict(self):
+        cache = ParseCache(join(self.dir, "small"), max_size=1)
+        cache.get(self.lens, self.text)
+        self.assertEqual(os.listdir(cache.directory), [])
+        
 class TreeBuildTest(TestCase):
     def test_build_list_tree(self):
         t = Tree()
@@ -96,6 +884,224 @@ class TreeBuildTest(TestCase):
         nt = rt.build_tree()
         self.assertFalse(isinstance(nt, ListTree))
 
+class NodeLayoutTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.tree = heracles.lenses['Aptsources'].get(self.text)
+
+    def test_slots(self):
+        for obj in (self.tree, self.tree[0], self.tree[0].children, 
+                self.tree[0].children['type']):
+            self.assertFalse(hasattr(obj, "__dict__"))
+
+    def test_leaf_children(self):
+        leaf = self.tree[0].children['type'][0]
+        self.assertTrue(leaf._children is None)
+        self.assertEqual(leaf.serialize()['children'], [])
+        leaf.children['x'] = "y"
+        self.assertEqual(leaf.children['x'].value, "y")
+        self.assertTrue(self.tree.is_dirty)
+
+    def test_interned_labels(self):
+        labels = [n.children['type'][0].label for n in self.tree]
+        self.assertTrue(labels[0] is labels[-1])
+        self.assertTrue(TreeNode(label="a" + "b").label is intern("ab"))
+
+class ColumnarTreeTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.lens = heracles.lenses['Aptsources']
+        self.tree = self.lens.get(self.text)
+        self.columnar = self.lens.get(self.text, columnar=True)
+
+    def test_read(self):
+        self.assertTrue(isinstance(self.columnar, ColumnarListTree))
+        check_equal_tree(self, self.tree, self.columnar)
+        self.assertEqual(self.columnar.serialize(), self.tree.serialize())
+        children = self.columnar[0].children
+        self.assertEqual(children['component'][1].value, 'contrib')
+        self.assertEqual(children['type'].value, 'deb')
+        self.assertTrue('uri' in children)
+        self.assertFalse('x' in children)
+        self.assertEqual(children[-1].label, 'component')
+        self.assertEqual(children[0].parent, self.columnar[0])
+        self.assertEqual(len(self.columnar), len(self.tree))
+
+    def test_search(self):
+        for key_values in ({'type': 'deb-src'}, {'component': 'contrib'},
+                {'type': 'deb', 'distribution': 'x'}, {'x': 'deb'},
+                {'uri': Prefix('http://'), 'component': In(['main'])}):
+            self.assertEqual([n.serialize() for n in 
+                self.columnar.search(**key_values)], [n.serialize() for n in
+                    self.tree.search(**key_values)])
+
+    def test_put(self):
+        self.assertEqual(self.lens.put(self.columnar, self.text), self.text)
+        self.assertEqual(self.columnar.put(), self.tree.put())
+
+    def test_read_only(self):
+        children = self.columnar[0].children
+        self.assertRaises(HeraclesTreeError, children.add_new_node, "x")
+        self.assertRaises(HeraclesTreeError, setattr, children[0], 'value',
+                "x")
+        self.assertRaises(HeraclesError, self.lens.get, self.text, 
+                lazy=True, columnar=True)
+        tree = self.columnar.to_tree()
+        self.assertTrue(isinstance(tree, ListTree))
+        tree[0].children['distribution'].value = "wheezy"
+        self.assertTrue("wheezy" in tree.put(self.text))
+        subtree = self.columnar[1].children.to_tree()
+        self.assertEqual(subtree.serialize(), self.tree[1].children.serialize())
+
+    def test_save_all(self):
+        self.columnar.path = DATA_FILE
+        for workers in (1, 2):
+            self.assertRaises(HeraclesTreeError, save_all, [self.columnar],
+                    workers=workers)
+
+class PathExpressionTest(TestCase):
+    def setUp(self):
+        self.text = file(DATA_FILE).read()
+        self.lens = heracles.lenses['Aptsources']
+        self.tree = self.lens.get(self.text)
+
+    def values(self, path, tree=None):
+        return [n.value for n in (tree or self.tree).match(path)]
+
+    def test_steps(self):
+        self.assertEqual(self.values("/1/component"), 
+                ["main", "contrib", "non-free"])
+        self.assertEqual(self.values("1/component[2]"), ["contrib"])
+        self.assertEqual(self.values("/*/type"), ["deb", "deb-src"])
+        self.assertEqual(self.values("//#comment"), 
+                [self.tree['#comment'].value])
+        self.assertEqual(self.values("/1/uri/../type"), ["deb"])
+        self.assertEqual(self.values("/1/x"), [])
+        self.assertEqual(self.tree[0].children.match("type")[0].value, 
+                "deb")
+
+    def test_predicates(self):
+        self.assertEqual(self.values("/1/component[. = 'main']"), ["main"])
+        self.assertEqual(self.values("/*[type = 'deb-src']/type"), 
+                ["deb-src"])
+        self.assertEqual(self.values("/*[type != 'deb']/type"), ["deb-src"])
+        self.assertEqual(self.values("/1/component[last()]"), ["non-free"])
+        self.assertEqual(self.values("/1/component[last() - 1]"), 
+                ["contrib"])
+        self.assertEqual(self.values("/1/component[position() > 1]"), 
+                ["contrib", "non-free"])
+        self.assertEqual(self.values("//component[. =~ regexp('n.*')]"), 
+                ["non-free", "non-free"])
+        self.assertEqual(self.values("/*[uri and count(component) = 3 and "
+            "(type = 'x' or type = 'deb-src')]/type"), ["deb-src"])
+
+    def test_columnar(self):
+        tree = self.lens.get(self.text, columnar=True)
+        for path in ("/1/component", "//component[. = 'main']", 
+                "/*[type = 'deb-src']/uri", "/1/uri/../type"):
+            self.assertEqual(self.values(path, tree), self.values(path))
+        self.assertRaises(HeraclesTreeError, tree.set, "/1/type", "x")
+
+    def test_get_set(self):
+        self.assertEqual(self.tree.get("/2/distribution"), "squeeze")
+        self.assertEqual(self.tree.get("/2/x"), None)
+        self.assertRaises(HeraclesMMatchError, self.tree.get, "/*/type")
+        self.tree.set("/2/distribution", "wheezy")
+        self.assertEqual(self.tree[1].children['distribution'].value, 
+                "wheezy")
+        node = self.tree.set("/3/type", "deb")
+        self.assertEqual(self.tree[2], node.parent)
+        self.tree.set("/3/uri", "http://example.com")
+        self.tree.set("/3/distribution", "sid")
+        self.assertTrue("deb http://example.com sid" in self.tree.put())
+        self.assertRaises(HeraclesNoMatchError, self.tree.set, 
+                "/5/type", "deb")
+        self.assertRaises(HeraclesMMatchError, self.tree.set, 
+                "/*/x", "deb")
+
+    def test_union(self):
+        expected = ["deb", "http://ftp.es.debian.org/debian/", "deb-src", 
+                "http://ftp.es.debian.org/debian/"]
+        self.assertEqual(self.values("*/type | */uri"), expected)
+        self.assertEqual(self.values("(*/type | */uri)"), expected)
+        # In tree order, without duplicates
+        self.assertEqual(self.values("/1/type | /1/type | //#comment"), 
+                [self.tree['#comment'].value, "deb"])
+        self.assertEqual(self.values("1/type | 2/type"), ["deb", "deb-src"])
+        tree = self.lens.get(self.text, columnar=True)
+        self.assertEqual(self.values("*/uri | */type", tree), expected)
+        self.assertRaises(HeraclesNoMatchError, self.tree.set, 
+                "/1/x | /1/y", "z")
+
+    def test_syntax(self):
+        for path in ("", "/1[", "/1/component[. = ]", "/a[foo()]", "/'a'",
+                "/1 | 'a'", "count(/1)", "/1 = 'a'"):
+            self.assertRaises(HeraclesPathXError, self.tree.match, path)
+        self.assertEqual(self.values(r"/1/com\ ponent"), [])
+
+    def test_numeric_labels(self):
+        t = Tree()
+        n = t.add_new_node("01", "5")
+        t.add_new_node("2", "7")
+        self.assertEqual(t.match("01"), [n])
+        self.assertEqual(t.match("/*[. - 1 = 4]"), [n])
+        self.assertEqual(t.match("*[1]"), [n])
+        t.add_new_node("x", "a")
+        self.assertRaises(HeraclesPathXError, t.match, "/*[. - 1]")
+
+class NativeExportTest(TestCase):
+    @skipIf(libheracles_ext is None, "libheracles_ext is not built")
+    def test_export(self):
+        text = file(DATA_FILE).read()
+        tree = heracles.lenses['Aptsources'].get(text)
+        tree['#comment'] = ""
+        tree[0].children['x'] = "y"
+        raw_tree = ManagedRawTree.build_from_tree(tree)
+        nodes = raw_tree._get_nodes(raw_tree.first)
+        native_nodes = get_nodes_from_records(*export_tree(raw_tree.first))
+        self.assertEqual(len(nodes), len(native_nodes))
+        self.assertEqual(native_nodes[-1].label, "#comment")
+        self.assertEqual(native_nodes[-1].value, "")
+        check_equal_tree(self, nodes, native_nodes)
+
+    @skipIf(libheracles_ext is None, "libheracles_ext is not built")
+    def test_import(self):
+        text = file(DATA_FILE).read()
+        tree = heracles.lenses['Aptsources'].get(text)
+        tree[1].children['component'] = "extra"
+        row = tree.add_new_node("")
+        for label in ("type", "uri", "distribution"):
+            row.children[label] = tree[1].children[label].value
+        raw_tree = NativeRawTree.build_from_tree(tree)
+        native_tree = raw_tree.build_tree()
+        self.assertEqual(len(tree._nodes), len(native_tree._nodes))
+        check_equal_tree(self, tree._nodes, native_tree._nodes)
+        self.assertEqual(native_tree[1].children['component'][-1].value, 
+                "extra")
+        lens = heracles.lenses['Aptsources']
+        self.assertEqual(lens.put(tree, text), lens.put(native_tree, text))
+
+class BenchmarkTest(TestCase):
+    def test_generators(self):
+        for name, generate in benchmark.GENERATORS:
+            lens = heracles.lenses[name]
+            text = generate(100)
+            self.assertEqual(text.count("\n"), 100)
+            tree = lens.get(text)
+            self.assertTrue(len(tree) >= 90)
+            self.assertEqual(lens.put(tree, text), text)
+
+    def test_compare(self):
+        old = {"get": 1.0, "put": 1.0}
+        new = {"get": 1.1, "put": 2.0, "init": 0.5}
+        out = StringIO()
+        self.assertEqual(benchmark.compare(old, new, 1.25, out), ["put"])
+        self.assertTrue("new" in out.getvalue())
+        self.assertEqual(benchmark.compare(old, new, 1.25, out, 
+            new_spreads={"put": 1.0}), [])
+        self.assertEqual(benchmark.compare({"get": 0.0001}, 
+            {"get": 0.0005}, 1.25, out), [])
+
 class TreeTest(TestCase):
     def setUp(self):
         self.t = Tree()
@@ -256,6 +1262,54 @@ class LabelNodeListTest(TestCase):
         self.assertTrue("3" in self.t['a'])
         self.assertTrue("4" in self.t['a'])
 
+class LabelIndexTest(TestCase):
+    def setUp(self):
+        self.t = Tree()
+        self.t['a'] = "1"
+        self.t['b'] = "x"
+        self.t['a'] = "2"
+
+    def test_insert_keeps_order(self):
+        self.t.insert(0, TreeNode(label="a", value="0"))
+        self.t.insert(2, TreeNode(label="a", value="1.5"))
+        self.assertEqual([n.value for n in self.t['a']], ["0", "1", "1.5", "2"])
+
+    def test_unsorted_inserts(self):
+        for i in range(20):
+            self.t.insert((i * 7) % (len(self.t) + 1), 
+                    TreeNode(label="a", value=str(i)))
+        self.t[5].label = "a"
+        self.t[0].label = "b"
+        self.assertTrue(self.t._unsorted_labels)
+        for label in ("a", "b"):
+            self.assertEqual(list(self.t[label]), 
+                    [n for n in self.t._nodes if n.label == label])
+        self.assertEqual(self.t._unsorted_labels, None)
+
+    def test_rename(self):
+        node = self.t['a'][1]
+        node.label = "b"
+        self.assertEqual(len(self.t['a']), 1)
+        self.assertEqual([n.value for n in self.t['b']], ["x", "2"])
+        self.t['a'][0].label = "c"
+        self.assertFalse('a' in self.t)
+        self.assertFalse(self.t.has_key('a'))
+        self.assertEqual(self.t['c'].value, "1")
+
+    def test_replace_by_integer(self):
+        self.t[1] = TreeNode(label="c", value="y")
+        self.assertFalse('b' in self.t)
+        self.assertEqual(self.t['c'].value, "y")
+        self.assertEqual(self.t.index(self.t['c'][0]), 1)
+
+    def test_remove(self):
+        self.t.remove(self.t['b'][0])
+        self.assertRaises(KeyError, self.t.__getitem__, 'b')
+        node = self.t['a'][0]
+        self.t.remove(node)
+        node.label = "b"
+        self.assertFalse('b' in self.t)
+
 class ListTreeTest(TestCase):
     def setUp(self):
         self.t = ListTree()
@@ -396,6 +1450,48 @@ class ListTreeTest(TestCase):
         self.assertEqual(self.t[2].value, "x")
         self.assertTrue(isinstance(self.t[2], ListTreeNode))
 
+class ListTreeIndexTest(TestCase):
+    def setUp(self):
+        self.t = ListTree()
+        for i in range(0, 10):
+            self.t.add_new_node(str(i))
+            self.t['#comment'] = 'comment %d' % i
+
+    def test_insert_front(self):
+        for i in range(0, 5):
+            self.t.insert_new_node(0, "x%d" % i)
+        self.assertEqual(len(self.t), 15)
+        self.assertEqual(self.t[0].value, "x4")
+        self.assertEqual(self.t[5].value, "0")
+        self.assertEqual(self.t['6'].value, "0")
+        self.assertEqual([n.label for n in self.t], 
+                [str(i) for i in range(1, 16)])
+        self.assertEqual(len(self.t['#comment']), 10)
+
+    def test_remove_middle(self):
+        self.t.remove(self.t[3])
+        self.assertEqual(len(self.t), 9)
+        self.assertEqual(self.t['4'].value, "4")
+        self.assertEqual(self.t.index(self.t[8]), 8)
+        self.assertEqual(self.t[8].label, "9")
+
+    def test_set_node(self):
+        n = TreeNode(label="foo", value="x")
+        self.t[2] = n
+        self.assertEqual(n.label, "3")
+        self.assertEqual(self.t.index(n), 2)
+        self.assertTrue(self.t['3'] is not None)
+        self.assertEqual(self.t['3'].value, "x")
+
+    def test_rename_indexed(self):
+        n = self.t[0]
+        n.label = "#comment"
+        self.assertEqual(len(self.t), 9)
+        self.assertEqual(self.t[0].label, "1")
+        self.assertEqual(self.t[0].value, "1")
+        self.assertEqual(len(self.t['#comment']), 11)
+        self.assertEqual(self.t['#comment'][0].value, "0")
+
 class ListTreeTextAsTable(TestCase):
     def setUp(self):
         t = ListTree()
@@ -441,6 +1537,42 @@ class ListTreeTextAsTable(TestCase):
         l = self.t.search(name="Pepe", surname="Diaz", __value="luser")
         self.assertEqual(len(l), 0)
 
+    def test_search_predicates(self):
+        def names(**key_values):
+            return [n.children['name'].value for n in 
+                    self.t.search(**key_values)]
+        self.assertEqual(names(surname=In(["Diaz", "Rodriguez"])),
+                ["Pepe", "Ramon", "Maria"])
+        self.assertEqual(names(tel=Prefix("555-000"), name=Regex("^[PR]")),
+                ["Pepe", "Ramon"])
+        self.assertEqual(names(surname=Regex("^Diaz$"), __value="user"),
+                ["Pepe", "Ramon"])
+        self.assertEqual(names(surname=In([])), [])
+        self.assertEqual(names(), ["Pepe", "Juan", "Ramon", "Maria"])
+
+    def test_search_custom_predicate(self):
+        tels = []
+        def even_tel(value):
+            tels.append(value)
+            return int(value[-1]) % 2 == 0
+        result = self.t.search(tel=Predicate(even_tel), surname="Diaz")
+        self.assertEqual([n.children['name'].value for n in result],
+                ["Pepe", "Ramon"])
+        self.assertEqual(len(tels), len(set(tels)))
+        self.assertRaises(TypeError, Predicate, "555-0000")
+
+    def test_search_changes(self):
+        self.assertEqual(len(self.t.search(surname="Diaz")), 2)
+        self.t[1].children['surname'].value = "Diaz"
+        self.assertEqual(len(self.t.search(surname="Diaz")), 3)
+        self.t.remove(self.t[0])
+        self.assertEqual(len(self.t.search(surname="Diaz")), 2)
+        n = self.t.insert_new_node(0, "user")
+        n.children.add_new_node(label="surname", value="Diaz")
+        result = self.t.search(surname="Diaz")
+        self.assertEqual(len(result), 3)
+        self.assertTrue(result[0] is n)
+
 if __name__ == "__main__":
     import unittest
     unittest.main()
@@ -32,8 +32,10 @@ As you can see there are two string fields:
 *   ``value``: the content stored in the node.
 
 
-In *heracles* threre is no use of the last two definitions ``dirty`` and 
-``span``.
+In *heracles* threre is no use of the ``dirty`` field. The ``span`` of the
+nodes, their position in the parsed text, is stored only when the tree is got
+with ``spans=True`` and allows :meth:`Tree.put` to splice the changed values in
+the original text instead of rebuilding it.
 
 This structure is implemented in the form of the class :class:`TreeNode` and its
 sibling :class:`ListTreeNode`, both contains a `label` and a `value` attribute 
@@ -55,9 +57,25 @@ same tree level [#f1]_.
 
 """
 
+import os
 from heracles.exceptions import (HeraclesTreeLabelError, HeraclesListTreeError,
         HeraclesTreeError)
-from heracles.util import check_int, str_tree
+from heracles.util import check_int, str_tree, write_file_atomic
+from heracles.query import SearchIndex
+from heracles.pathx import compile_path
+
+# Shared list of child nodes of the nodes without children
+EMPTY_NODES = ()
+
+def intern_label(label):
+    """
+    Returns ``label`` interned, labels like ``#comment`` or the list indexes
+    repeat all over the trees so they are stored only once.
+
+    """
+    if type(label) is str:
+        return intern(label)
+    return label
 
 def check_list_nodes(nodes):
     """
@@ -98,6 +116,37 @@ def get_tree_from_nodes(nodes, lens=None):
     else:
         return Tree(parent=None, nodes=nodes, lens=lens)
 
+def get_nodes_from_serialized(data):
+    """
+    Builds back the list of nodes from the output of :meth:`Tree.serialize`.
+
+    :param data: A list of dicts with ``label``, ``value`` and ``children``
+        keys.
+
+    :rtype: list of :class:`TreeNode`.
+
+    """
+    nodes = []
+    for item in data:
+        children = get_nodes_from_serialized(item['children'])
+        nodes.append(get_node(children, label=item['label'], 
+            value=item['value']))
+    return nodes
+
+def get_tree_from_serialized(data, lens=None):
+    """
+    Builds back a root tree from the output of :meth:`Tree.serialize`.
+
+    :param data: A list of dicts with ``label``, ``value`` and ``children``
+        keys.
+    :param lens: The lens where the tree is generated from.
+    :type lens: :class:`heracles.base.Lens`
+
+    :rtype: :class:`Tree` or :class:`ListTree`.
+
+    """
+    return get_tree_from_nodes(get_nodes_from_serialized(data), lens=lens)
+
 def get_node(children, label="", value="", parent=None):
     """
     Given a sequence of children nodes returns the right parent instance
@@ -116,7 +165,10 @@ def get_node(children, label="", value="", parent=None):
     
     """
     assert(isinstance(children, list))
-    node_class = ListTreeNode if check_list_nodes(children) else TreeNode
+    if children and check_list_nodes(children):
+        node_class = ListTreeNode
+    else:
+        node_class = TreeNode
     return node_class(label=label, value=value, parent=parent, children=children)
 
 class Tree(object):
@@ -137,6 +189,13 @@ class Tree(object):
 
     """
 
+    # ``_text`` is the text the tree was parsed from if it was got with 
+    # spans, see :meth:`heracles.base.Lens.get`.
+    __slots__ = ('parent', 'lens', 'path', 'default_node_class', '_nodes', 
+            '_labels', '_unsorted_labels', '_stale_labels', '_text', 
+            '_changed_values', '_changed_count', '_changed_nodes', 
+            '_changed_structure', '_version')
+
     @classmethod
     def build_from_parent(cls, parent, nodes, default_node_class):
         """
@@ -197,6 +256,273 @@ class Tree(object):
         self.path = path
         self._nodes = nodes if nodes is not None else []
         self.default_node_class = TreeNode if default_node_class is None else default_node_class
+        self._stale_labels = False
+        self._text = None
+        self._changed_values = None
+        self._changed_count = 0
+        self._changed_nodes = None
+        self._changed_structure = False
+        self._version = 0
+        self._build_label_index()
+
+    # Label index
+    #
+    # ``self._labels`` maps every label to the list of nodes that have it, 
+    # in the same order they have in ``self._nodes``, so label lookups don't
+    # need to scan the whole level. The nodes placed anywhere but at the end
+    # are appended to their list, that is added to ``self._unsorted_labels``
+    # and sorted the next time it is read, so a batch of inserts or relabels
+    # costs a single pass over the level.
+
+    def _build_label_index(self):
+        self._labels = {}
+        self._unsorted_labels = None
+        for node in self._nodes:
+            node._tree = self
+            node.parent = self.parent
+            self._labels.setdefault(node._label, []).append(node)
+
+    def _label_nodes(self, label):
+        """
+        Returns the list of nodes with ``label`` in tree order. The returned
+        list is the index itself so it must not be modified.
+
+        """
+        if self._unsorted_labels is not None and \
+                label in self._unsorted_labels:
+            self._sort_labels()
+        return self._labels.get(label, [])
+
+    def _sort_labels(self):
+        positions = dict((id(node), i) for i, node in enumerate(self._nodes))
+        for label in self._unsorted_labels:
+            same_label = self._labels.get(label)
+            if same_label is not None:
+                same_label.sort(key=lambda node: positions[id(node)])
+        self._unsorted_labels = None
+
+    def _index_node(self, node, raw_index):
+        """
+        Adds ``node`` to the label index given that it is going to be placed
+        at ``raw_index`` of ``self._nodes``, if it is ``None`` at the end.
+
+        """
+        if raw_index is not None and raw_index >= len(self._nodes):
+            raw_index = None
+        self._index_unsorted(node, raw_index is not None)
+
+    def _index_unsorted(self, node, unsorted=True):
+        same_label = self._labels.setdefault(node._label, [])
+        same_label.append(node)
+        if unsorted and len(same_label) > 1:
+            if self._unsorted_labels is None:
+                self._unsorted_labels = set()
+            self._unsorted_labels.add(node._label)
+
+    def _unindex_node(self, node, label):
+        same_label = self._labels[label]
+        same_label.remove(node)
+        if not same_label:
+            del self._labels[label]
+
+    def _add_node(self, node, raw_index=None):
+        """
+        Adds ``node`` to ``self._nodes`` at ``raw_index`` or at the end if 
+        not given keeping the label index updated.
+
+        """
+        self._structure_changed(node)
+        node.parent = self.parent
+        node._tree = self
+        if raw_index is None:
+            self._index_node(node, None)
+            self._nodes.append(node)
+        else:
+            l = len(self._nodes)
+            if raw_index < 0:
+                raw_index = max(0, l + raw_index)
+            raw_index = min(raw_index, l)
+            self._index_node(node, raw_index)
+            self._nodes.insert(raw_index, node)
+
+    def _remove_node(self, node):
+        self._structure_changed()
+        self._forget_changes([node])
+        self._unindex_node(node, node._label)
+        self._nodes.remove(node)
+        node._tree = None
+
+    def _replace_node(self, raw_index, node):
+        self._structure_changed(node)
+        old_node = self._nodes[raw_index]
+        self._forget_changes([old_node])
+        self._unindex_node(old_node, old_node._label)
+        old_node._tree = None
+        node.parent = self.parent
+        node._tree = self
+        self._nodes[raw_index] = node
+        self._index_node(node, raw_index)
+
+    def _relabel(self, node, old_label):
+        """
+        Called by the nodes of the tree when their label changes.
+
+        """
+        self._structure_changed(node)
+        self._unindex_node(node, old_label)
+        self._index_unsorted(node)
+
+    # Changes
+    #
+    # The changes of the nodes are recorded in the root tree of the 
+    # hierarchy: ``_changed_values`` maps the nodes whose value changed to 
+    # their original value and ``_changed_count`` is the number of them 
+    # whose value is not the original one, ``_changed_structure`` is set 
+    # when nodes are added, removed or relabeled and ``_changed_nodes`` maps
+    # every changed node to the order it was first changed in and whether 
+    # it was added, replaced or relabeled. The changes of the removed nodes
+    # and their descendants are forgotten, so only the attached nodes are 
+    # kept. ``_version`` is increased with every change and it is never 
+    # reset, so the indexes of the trees can be checked.
+
+    def _get_root(self):
+        tree = self
+        while tree.parent is not None and tree.parent._tree is not None:
+            tree = tree.parent._tree
+        return tree
+
+    def _value_changed(self, node, old_value):
+        """
+        Called by the nodes of the tree when their value changes.
+
+        """
+        root = self._get_root()
+        root._version += 1
+        if root._changed_values is None:
+            root._changed_values = {}
+        original = root._changed_values.setdefault(node, old_value)
+        root._changed_count += (node._value != original) - \
+                (old_value != original)
+        root._record_change(node, False)
+
+    def _record_change(self, node, structural):
+        if self._changed_nodes is None:
+            self._changed_nodes = {}
+        change = self._changed_nodes.get(node)
+        if change is None:
+            self._changed_nodes[node] = [self._version, structural]
+        elif structural:
+            change[1] = True
+
+    def _forget_changes(self, nodes):
+        """
+        Forgets the recorded changes of ``nodes``, that are being removed 
+        from the tree, and of their descendants.
+
+        """
+        root = self._get_root()
+        changes = root._changed_nodes
+        if not changes:
+            return
+        values = root._changed_values or {}
+        nodes = list(nodes)
+        while nodes:
+            node = nodes.pop()
+            if changes.pop(node, None) is not None and node in values:
+                if node._value != values.pop(node):
+                    root._changed_count -= 1
+            if node._children is not None:
+                nodes.extend(node._children._nodes)
+
+    def _structure_changed(self, node=None):
+        root = self._get_root()
+        root._version += 1
+        root._changed_structure = True
+        if node is not None:
+            root._record_change(node, True)
+
+    def _reset_changes(self):
+        """
+        Forgets the changes recorded so far. If there were any, the spans of
+        the nodes don't match the saved text anymore, so incremental puts 
+        are disabled too.
+
+        """
+        root = self._get_root()
+        if root.is_dirty:
+            root._text = None
+        root._changed_values = None
+        root._changed_count = 0
+        root._changed_nodes = None
+        root._changed_structure = False
+
+    def _is_attached(self, node):
+        tree = node._tree
+        return tree is not None and tree._get_root() is self
+
+    @property
+    def is_dirty(self):
+        """
+        ``True`` if any node of the tree hierarchy was added, removed, 
+        relabeled or changed its value since it was parsed or last saved.
+
+        """
+        root = self._get_root()
+        return root._changed_structure or root._changed_count > 0
+
+    def changed_nodes(self):
+        """
+        Returns the list of nodes of the tree hierarchy that were added, 
+        replaced, relabeled or changed its value since the tree was parsed
+        or last saved, in the order they were first changed. The removed 
+        nodes are not returned although they make :attr:`is_dirty` 
+        ``True``.
+
+        :rtype: list of :class:`TreeNode`
+
+        """
+        root = self._get_root()
+        changes = root._changed_nodes or {}
+        values = root._changed_values or {}
+        nodes = []
+        for node in sorted(changes, key=lambda node: changes[node][0]):
+            if not root._is_attached(node):
+                continue
+            if changes[node][1] or node._value != values[node]:
+                nodes.append(node)
+        return nodes
+
+    def _splice_changes(self, text):
+        """
+        Returns ``text`` with the values changed since the tree was parsed 
+        from it written over the original ones, or ``None`` if it can't be
+        done because the tree was not parsed from ``text`` with spans, its 
+        structure changed or any of the changed values is not stored 
+        verbatim in the text.
+
+        """
+        if self._text is None or self._changed_structure or text != self._text:
+            return None
+        edits = []
+        for node, old_value in (self._changed_values or {}).iteritems():
+            span = node._span
+            value = node._value
+            if span is None or not old_value or value is None or "\n" in value:
+                return None
+            start, end = span[2], span[3]
+            if not span[4] <= start <= end <= span[5] or \
+                    text[start:end] != old_value:
+                return None
+            edits.append((start, end, value))
+        edits.sort()
+        result = []
+        position = 0
+        for start, end, value in edits:
+            result.append(text[position:start])
+            result.append(value)
+            position = end
+        result.append(text[position:])
+        return "".join(result)
 
     def insert(self, index, node):
         """
@@ -209,8 +535,7 @@ class Tree(object):
 
         """
         assert(isinstance(node, TreeNode))
-        node.parent = self.parent
-        self._nodes.insert(index, node)
+        self._add_node(node, index)
 
     def append(self, node):
         """
@@ -221,8 +546,7 @@ class Tree(object):
 
         """
         assert(isinstance(node, TreeNode))
-        node.parent = self.parent
-        self._nodes.append(node)
+        self._add_node(node)
 
     def has_key(self, name):
         """
@@ -236,10 +560,7 @@ class Tree(object):
         assert(isinstance(name, str) or isinstance(name, int))
         if isinstance(name, int):
             name = str(name)
-        for item in self._nodes:
-            if item.label == name:
-                return True
-        return False
+        return len(self._label_nodes(name)) > 0
 
     def index(self, node):
         """
@@ -266,7 +587,7 @@ class Tree(object):
         assert(isinstance(node, TreeNode))
         if not node in self._nodes:
             raise ValueError("%s not in %s" % (str(node), str(self)))
-        self._nodes.remove(node)
+        self._remove_node(node)
 
     def add_new_node(self, label="", value="", node_class=None):
         """
@@ -345,33 +666,133 @@ class Tree(object):
 
     # Lens methods
 
-    def put(self, text=""):
+    def put(self, text="", incremental=False):
         """
         If it is a master node it renders back to text applying the lens parser.
 
         :param text: If given it uses it to merge with the data of the tree.
         :type text: ``str``
+        :key incremental: See :meth:`heracles.base.Lens.put`.
+        :type incremental: ``bool``
         :rtype: ``str``
 
         """
         if self.lens is None:
             raise HeraclesTreeError("Unable to put. This tree has no lens")
-        return self.lens.put(self, text)
+        return self.lens.put(self, text, incremental=incremental)
+
+    def _render_changes(self, text=""):
+        """
+        Returns the text to save to ``path`` or ``None`` if the file 
+        doesn't need to be written, see :meth:`save`.
 
-    def save(self, text=""):
+        """
+        if self.path is None:
+            raise HeraclesTreeError("Unable to dump to a file withot a given path")
+        if not text and not self.is_dirty and os.path.exists(self.path):
+            return None
+        return self._check_dump(self.put(text))
+
+    def _check_dump(self, dump):
+        """
+        Returns ``dump`` or ``None`` if it is the same as the contents of the
+        file in ``path``.
+
+        """
+        try:
+            if os.path.getsize(self.path) == len(dump):
+                with open(self.path, "rb") as f:
+                    if f.read() == dump:
+                        return None
+        except (IOError, OSError):
+            pass
+        return dump
+
+    def save(self, text="", atomic=False):
         """
         If it is a master node it renders back to text applying the lens parser
         and saves the result to the file in ``path``.
 
+        Nothing is rendered nor written if the tree didn't change since it 
+        was parsed or last saved and the file exists, and the file is not 
+        written either if its contents are the same as the rendered text.
+        After saving, the recorded changes are cleared.
+
         :param text: If given it uses it to merge with the data of the tree.
         :type text: ``str``
+        :key atomic: If ``True`` the text is written and synced to a 
+            temporary file in the same directory, with the mode and owner of
+            the original file, that is then renamed over it. This way a crash
+            never leaves the file truncated. See also 
+            :func:`heracles.batch.save_all`.
+        :type atomic: ``bool``
+        :rtype: ``bool``, ``True`` if the file was written.
+
+        """
+        dump = self._render_changes(text)
+        if dump is not None:
+            if atomic:
+                write_file_atomic(self.path, dump)
+            else:
+                with open(self.path, "w") as f:
+                    f.write(dump)
+        self._reset_changes()
+        return dump is not None
+
+    # Path expressions
 
+    def match(self, path):
         """
-        if self.path is None:
-            raise HeraclesTreeError("Unable to dump to a file withot a given path")
-        dump = self.put(text)
-        with open(self.path, "w") as f:
-            f.write(dump)
+        Returns the list of nodes selected by the path expression ``path``, 
+        see :mod:`heracles.pathx`.
+
+        :param path: The path expression, like ``"/1/component[. = 'main']"``.
+        :type path: ``str``
+        :rtype: list of :class:`TreeNode`
+
+        """
+        return compile_path(path).match(self)
+
+    def get(self, path):
+        """
+        Returns the value of the node selected by the path expression 
+        ``path`` or ``None`` if there is none. If there are many it raises
+        :class:`heracles.exceptions.HeraclesMMatchError`.
+
+        :param path: The path expression.
+        :type path: ``str``
+        :rtype: ``str``
+
+        """
+        return compile_path(path).get(self)
+
+    def set(self, path, value):
+        """
+        Sets the ``value`` of the node selected by the path expression 
+        ``path`` and returns the node. If it doesn't exist and ``path`` ends
+        with plain labels, the missing nodes are created as augeas does.
+
+        :param path: The path expression.
+        :type path: ``str``
+        :param value: The new value.
+        :type value: ``str``
+        :rtype: :class:`TreeNode`
+
+        """
+        return compile_path(path).set(self, value)
+
+    def close(self):
+        """
+        Builds the nodes not loaded yet of a tree got with
+        ``Lens.get(text, lazy=True)``, so the libheracles tree it was parsed
+        from is freed now instead of when the last lazy node is loaded. The
+        tree can still be used afterwards.
+
+        """
+        for node in self._nodes:
+            children = node._get_children()
+            if children is not None:
+                children.close()
 
     # Special methods
 
@@ -429,8 +850,7 @@ class Tree(object):
                         parent=self.parent)
             elif isinstance(value, TreeNode):
                 value.label = name
-                value.parent = self.parent
-            self._nodes.append(value)
+            self._add_node(value)
         elif isinstance(name, int):
             self._set_item_by_integer(name, value)
 
@@ -451,8 +871,9 @@ class Tree(object):
         if isinstance(value, str):
             self[index].value = value
         elif isinstance(value, TreeNode):
-            value.parent = self.parent
-            self._nodes[index] = value
+            if index < 0:
+                index = len(self) + index
+            self._replace_node(index, value)
 
     def __str__(self):
         return str_tree(self)
@@ -471,10 +892,7 @@ class Tree(object):
         if isinstance(value, TreeNode):
             return value in self._nodes
         elif isinstance(value, str):
-            for n in self._nodes:
-                if n.label == value:
-                    return True
-            return False
+            return len(self._label_nodes(value)) > 0
         else:
             raise HeraclesTreeError('Unsupported type')
 
@@ -487,7 +905,7 @@ class Tree(object):
 
     def serialize(self):
         res = []
-        for item in self:
+        for item in self._nodes:
             res.append(item.serialize())
         return res
 
@@ -502,7 +920,14 @@ class ListTree(Tree):
     # index : As it works in getitem set item.
     # raw_index : The self._nodes node intex
     # label_index : The index as it is stored in node.label
+    #
+    # Indexed nodes are kept in order in ``self._indexed`` apart from the 
+    # label index of the rest of nodes. Their labels are not rewritten every 
+    # time the list changes, instead the tree is marked with 
+    # ``self._stale_labels`` and they are renumbered the next time any label
+    # of the tree is read, for example when the tree is rendered by ``put``.
 
+    __slots__ = ('_indexed', '_search_index')
 
     def __init__(self, parent=None, nodes=None, lens=None, path=None,
             default_node_class=None):
@@ -552,6 +977,79 @@ class ListTree(Tree):
         super(ListTree, self).__init__(parent=parent, nodes=nodes, lens=lens, path=path,
             default_node_class=default_node_class)
 
+    def _build_label_index(self):
+        self._labels = {}
+        self._unsorted_labels = None
+        self._indexed = []
+        self._search_index = None
+        self._stale_labels = False
+        for node in self._nodes:
+            node._tree = self
+            node.parent = self.parent
+            if check_int(node._label):
+                self._indexed.append(node)
+                if node._label != str(len(self._indexed)):
+                    self._stale_labels = True
+            else:
+                self._labels.setdefault(node._label, []).append(node)
+
+    def _label_nodes(self, label):
+        if check_int(label):
+            index = int(label) - 1
+            if 0 <= index < len(self._indexed):
+                return [self._indexed[index]]
+            return []
+        return super(ListTree, self)._label_nodes(label)
+
+    def _index_node(self, node, raw_index):
+        if not check_int(node._label):
+            return super(ListTree, self)._index_node(node, raw_index)
+        if raw_index is None:
+            self._indexed.append(node)
+            if node._label != str(len(self._indexed)):
+                self._stale_labels = True
+        else:
+            self._indexed.insert(self._indexed_before(raw_index), node)
+            self._stale_labels = True
+
+    def _indexed_before(self, raw_index):
+        # Number of indexed nodes before raw_index, found from the closest
+        # one, as the indexed nodes are usually most of the level.
+        for i in xrange(min(raw_index, len(self._nodes)) - 1, -1, -1):
+            node = self._nodes[i]
+            if check_int(node._label):
+                return self._indexed.index(node) + 1
+        return 0
+
+    def _relabel(self, node, old_label):
+        if check_int(node._label) and check_int(old_label):
+            # It keeps its place, the labels are rewritten by _renumber
+            self._structure_changed(node)
+            self._stale_labels = True
+        elif check_int(node._label):
+            self._structure_changed(node)
+            self._unindex_node(node, old_label)
+            self._index_node(node, self._nodes.index(node))
+        else:
+            super(ListTree, self)._relabel(node, old_label)
+
+    def _unindex_node(self, node, label):
+        if not check_int(label):
+            return super(ListTree, self)._unindex_node(node, label)
+        index = self._indexed.index(node)
+        del self._indexed[index]
+        if index < len(self._indexed):
+            self._stale_labels = True
+
+    def _renumber(self):
+        """
+        Rewrites the labels of the indexed nodes to keep sequentiality.
+
+        """
+        self._stale_labels = False
+        for i, node in enumerate(self._indexed):
+            node._label = str(i + 1)
+
     def insert(self, index, tree_node):
         """
         Insert ``node`` into ``index`` place.
@@ -562,11 +1060,16 @@ class ListTree(Tree):
         """
         assert(isinstance(tree_node, TreeNode)) 
         assert(isinstance(index, int))
-        label_index = index + 1
-        tree_node.label = str(label_index)
+        tree_node.label = str(index + 1)
         raw_index = self._get_raw_index(index)
-        super(ListTree, self).insert(raw_index, tree_node)
-        self._update_index(label_index + 1, +1)
+        if index < 0:
+            index = len(self) + index
+        self._structure_changed(tree_node)
+        tree_node.parent = self.parent
+        tree_node._tree = self
+        self._indexed.insert(index, tree_node)
+        self._nodes.insert(raw_index, tree_node)
+        self._stale_labels = True
 
     def append(self, tree_node):
         """
@@ -579,7 +1082,7 @@ class ListTree(Tree):
         assert(isinstance(tree_node, TreeNode))
         last_index = len(self)
         tree_node.label = str(last_index + 1)
-        super(ListTree, self).append(tree_node)
+        self._add_node(tree_node)
 
     def index(self, tree_node):
         """
@@ -592,11 +1095,9 @@ class ListTree(Tree):
         """
         assert(isinstance(tree_node, TreeNode))
         if tree_node in self:
-            try:
-                label_index = int(tree_node.label)
-                return label_index - 1
-            except ValueError:
+            if not check_int(tree_node._label):
                 raise HeraclesListTreeError('TreeNode is not an indexed node')
+            return self._indexed.index(tree_node)
         else:
             raise ValueError('Node not in tree')
 
@@ -610,12 +1111,6 @@ class ListTree(Tree):
         """
         assert(isinstance(tree_node, TreeNode))
         super(ListTree, self).remove(tree_node)
-        try:
-            label_index = int(tree_node.label)
-            index = label_index - 1
-            self._update_index(index, -1)
-        except ValueError:
-            pass
 
     def add_new_node(self, value, node_class=None):
         """
@@ -669,75 +1164,53 @@ class ListTree(Tree):
         """
         As list trees behaves most of the time like database table: a list of
         key-values, this method allows you to query the table that have 
-        certain key-value pairs expressed as the keywords.
+        certain key-value pairs expressed as the keywords. The nodes with 
+        any children with each label and value are returned in list order.
 
         A keyword named ``__value`` referes to the value of the ListTree node
         itself.
 
-        """
+        The values can also be predicates of :mod:`heracles.query`, like 
+        ``search(type=In(["deb", "deb-src"]))``. The search uses an index of
+        the children of the nodes that is built the first time and after 
+        any change of the tree.
 
-        result = []
-        if "__value" in key_values:
-            master_value = key_values.pop("__value")
-        else:
-            master_value = None
-        for node in self:
-            if master_value is not None and node.value != master_value:
-                continue
-            ok = True
-            for key, value in key_values.iteritems():
-                has_pair = False
-                if key in node.children:
-                    sub_nodes = node.children[key]
-                    for sub_node in sub_nodes:
-                        if sub_node.value == value:
-                            has_pair = True
-                            break
-                    if not has_pair:
-                        ok = False
-                        break
-                else:
-                    ok = False
-                    break
-            if ok:
-                result.append(node)
-        return result
+        """
+        root = self._get_root()
+        index = self._search_index
+        if index is None or index.version != root._version:
+            index = SearchIndex(list(self._indexed), root._version)
+            self._search_index = index
+        return index.search(key_values)
 
-    def _get_raw_index(self, index):
-        l = len(self)
+    def _normalize_index(self, index):
+        l = len(self._indexed)
         if index < 0:
             index = l + index
         if not 0 <= index < l:
             raise IndexError('Index out of range')
-        for i, node in enumerate(self._nodes):
-            try:
-                label_index = int(node.label)
-                if label_index - 1 == index:
-                    return i
-            except ValueError:
-                pass
-
-    def _update_index(self, from_index, value):
-        """
-        Updates labels of the next items to keep sequentiality
+        return index
 
-        """
-        from_label_index = from_index + 1
-        for item in self:
-            label = int(item.label)
-            if label >= from_label_index:
-                item.label = str(label + value)
+    def _get_raw_index(self, index):
+        index = self._normalize_index(index)
+        return self._nodes.index(self._indexed[index])
 
     def _get_item_by_integer(self, index):
-        raw_index = self._get_raw_index(index)
-        return self._nodes[raw_index]
+        return self._indexed[self._normalize_index(index)]
 
     def _set_item_by_integer(self, index, value):
-        raw_index = self._get_raw_index(index)
+        index = self._normalize_index(index)
         if isinstance(value, str):
-            self._nodes[raw_index].value = value
+            self._indexed[index].value = value
         elif isinstance(value, TreeNode):
+            self._structure_changed(value)
+            raw_index = self._nodes.index(self._indexed[index])
+            self._forget_changes([self._indexed[index]])
+            self._indexed[index]._tree = None
+            value.label = str(index + 1)
             value.parent = self.parent
+            value._tree = self
+            self._indexed[index] = value
             self._nodes[raw_index] = value
 
     def __getitem__(self, name):
@@ -779,8 +1252,7 @@ class ListTree(Tree):
                         parent=self.parent)
             elif isinstance(value, TreeNode):
                 value.label = name
-                value.parent = self.parent
-            self._nodes.append(value)
+            self._add_node(value)
         elif isinstance(name, int):
             self._set_item_by_integer(name, value)
 
@@ -805,19 +1277,15 @@ class ListTree(Tree):
         Iterates over **indexed** nodes.
 
         """
-        for child in self._nodes:
-            if check_int(child.label): 
-                yield child
+        for child in self._indexed:
+            yield child
 
     def __len__(self):
         """
         Returns the number of **indexed** nodes in the tree.
 
         """
-        i = 0
-        for node in self:
-            i += 1
-        return i
+        return len(self._indexed)
 
 class TreeNode(object):
     """
@@ -829,6 +1297,13 @@ class TreeNode(object):
 
     """
     children_class = Tree
+    # Nodes without children don't create their children tree until the
+    # ``children`` attribute is used, ``_children`` is ``None`` meanwhile.
+    # ``_span`` stores the positions of the node in the text it was parsed 
+    # from if it was got with spans: (label_start, label_end, value_start, 
+    # value_end, span_start, span_end)
+    __slots__ = ('parent', '_tree', '_label', '_value', '_loader', 
+            '_children', '_span')
 
     def __init__(self, label="", value="", parent=None, children=None, 
             default_children_class=None):
@@ -850,22 +1325,140 @@ class TreeNode(object):
         assert(isinstance(value, str) or value is None)
         assert(isinstance(parent, TreeNode) or parent is None)
         self.parent = parent
-        self.label = label
-        self.value = value
-        children = [] if children is None else children
-        self.children = self.children_class.build_from_parent(self, children,
-                default_children_class)
+        self._tree = None
+        self._label = intern_label(label)
+        self._value = value
+        self._loader = None
+        self._span = None
+        if not children and default_children_class is None:
+            self._children = None
+        else:
+            children = [] if children is None else children
+            self._children = self.children_class.build_from_parent(self, 
+                    children, default_children_class)
+
+    @classmethod
+    def build_lazy(cls, loader, label="", value=""):
+        """
+        Builds a node whose children are not created until the
+        :attr:`children` attribute is first accessed. Then the ``load`` 
+        method of ``loader`` is called to get the list of children nodes.
+
+        As the kind of node depends on its children, a lazy node is a 
+        :class:`TreeNode` until its children are loaded, when it turns into a
+        :class:`ListTreeNode` if they are a list.
+
+        :param loader: An object with a ``load`` method that returns the list
+            of children nodes.
+        :keyword label: The label of the node.
+        :type label: str
+        :keyword value: The value of the node.
+        :type value: str
+
+        :rtype: :class:`TreeNode`
+
+        """
+        node = cls.__new__(cls)
+        node.parent = None
+        node._tree = None
+        node._label = intern_label(label)
+        node._value = value
+        node._loader = loader
+        node._children = None
+        node._span = None
+        return node
+
+    def _load_children(self):
+        loader, self._loader = self._loader, None
+        nodes = loader.load()
+        if self.__class__ is TreeNode and check_list_nodes(nodes):
+            self.__class__ = ListTreeNode
+        if nodes:
+            self._children = self.children_class.build_from_parent(self, 
+                    nodes, None)
+
+    def _get_children(self):
+        """
+        Returns the children tree or ``None`` if the node has no children and
+        its children tree was not created yet.
+
+        """
+        if self._loader is not None:
+            self._load_children()
+        return self._children
+
+    def _get_child_nodes(self):
+        children = self._get_children()
+        return EMPTY_NODES if children is None else children._nodes
+
+    @property
+    def children(self):
+        """
+        The :class:`Tree` or :class:`ListTree` of the children nodes.
+
+        """
+        if self._loader is not None:
+            self._load_children()
+        if self._children is None:
+            self._children = self.children_class.build_from_parent(self, [],
+                    None)
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        if self._tree is not None:
+            self._tree._structure_changed(self)
+            if self._children is not None:
+                self._tree._forget_changes(self._children._nodes)
+        self._loader = None
+        self._children = children
+
+    @property
+    def value(self):
+        """
+        The value of the node. Changes are recorded in the tree that 
+        contains the node.
+
+        """
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        old_value = self._value
+        self._value = value
+        if self._tree is not None and old_value != value:
+            self._tree._value_changed(self, old_value)
+
+    @property
+    def label(self):
+        """
+        The label of the node. Changing it keeps the label index of the tree
+        that contains the node updated.
+
+        """
+        tree = self._tree
+        if tree is not None and tree._stale_labels:
+            tree._renumber()
+        return self._label
+
+    @label.setter
+    def label(self, label):
+        old_label = self._label
+        self._label = intern_label(label)
+        if self._tree is not None and old_label != label:
+            self._tree._relabel(self, old_label)
 
     def serialize(self):
         res = {}
         res['label'] = self.label
         res['value'] = self.value
-        res['children'] = self.children.serialize()
+        children = self._get_children()
+        res['children'] = [] if children is None else children.serialize()
         return res
 
     def __repr__(self):
         return "<%s label:'%s' value:'%s' children:%d>" % (self.__class__.__name__,
-                self.label, self.value, len(self.children))
+                self.label, self.value, len(self._get_child_nodes()))
 
 class ListTreeNode(TreeNode):
     """
@@ -874,6 +1467,7 @@ class ListTreeNode(TreeNode):
 
     """
     children_class = ListTree
+    __slots__ = ()
 
     def __init__(self, label="", value="", parent=None, children=None, 
             default_children_class=None):
@@ -909,6 +1503,8 @@ class LabelNodeList(object):
     ``children`` of the ``LabelNodeList`` instance to access its contents.
 
     """
+    __slots__ = ('tree', 'label')
+
     @classmethod
     def build(cls, tree, label):
         """
@@ -923,11 +1519,7 @@ class LabelNodeList(object):
         :rtype: :class:`LabelNodeList`
 
         """
-        i = 0
-        for item in tree._nodes:
-            if item.label == label:
-                i += 1
-        if i == 0:
+        if not tree._label_nodes(label):
             raise KeyError("Unable to find item '%s'" % label)
         else:
             return cls(tree, label)
@@ -1036,21 +1628,19 @@ class LabelNodeList(object):
         self.tree.append(item)
 
     def __iter__(self):
-        for item in self.tree._nodes:
-            if item.label == self.label:
-                yield item
+        for item in self.tree._label_nodes(self.label):
+            yield item
 
     def __getitem__(self, index):
         assert(isinstance(index, int) or isinstance(index, str))
         if isinstance(index, int):
-            l = len(self)
+            nodes = self.tree._label_nodes(self.label)
+            l = len(nodes)
             if index < 0:
                 index = l + index
             if not 0 <= index < l:
                 raise IndexError("Index out of range")
-            for i, item in enumerate(self):
-                if i == index:
-                    return item
+            return nodes[index]
         elif isinstance(index, str):
             for node in self:
                 if node.value == index:
@@ -1080,9 +1670,7 @@ class LabelNodeList(object):
         return False
 
     def __len__(self):
-        for i, item in enumerate(self):
-            pass
-        return i + 1
+        return len(self.tree._label_nodes(self.label))
 
     def __repr__(self):
         return "<%s label:'%s' values:%s>" % (self.__class__.__name__,
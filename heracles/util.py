@@ -1,9 +1,135 @@
 import os
+import errno
+import hashlib
+import tempfile
 
 def get_heracles_path():
     h_path = os.path.abspath(__file__)
     return os.path.dirname(h_path)
 
+def get_lens_fingerprint(load_dirs):
+    """
+    Returns a hash that changes whenever the heracles version, the 
+    libheracles library or any of the lens modules in ``load_dirs`` change.
+
+    """
+    from heracles import __version__
+    from heracles.libs import get_library_path
+    h = hashlib.sha1(__version__)
+    paths = [get_library_path()]
+    for directory in load_dirs:
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        paths.extend(os.path.join(directory, name) for name in names 
+                if name.endswith(".aug"))
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        h.update("%s:%d:%r" % (path, st.st_size, st.st_mtime))
+    return h.hexdigest()
+
+# Atomic writes
+#
+# The files are written to a temporary file in the same directory that is
+# renamed over the original one, so a crash leaves either the old or the new
+# contents but never a truncated file. Several files can be staged first and
+# committed together so the directories are synced once.
+
+SAVE_PREFIX = ".heracles-"
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def stage_file(path, data, sync=True):
+    """
+    Writes ``data`` to a temporary file next to the file in ``path``, with 
+    its mode and owner, and returns a ``(temporary_path, target_path)`` 
+    tuple to be passed to :func:`commit_files`. Symbolic links are 
+    followed, so the file they point to is replaced and not the link.
+
+    """
+    target = os.path.realpath(path)
+    directory = os.path.dirname(target)
+    fd, tmp_name = tempfile.mkstemp(prefix=SAVE_PREFIX, dir=directory)
+    try:
+        try:
+            st = os.stat(target)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            umask = os.umask(0)
+            os.umask(umask)
+            os.fchmod(fd, 0666 & ~umask)
+        else:
+            os.fchmod(fd, st.st_mode & 07777)
+            if hasattr(os, "fchown") and (st.st_uid != os.geteuid() or 
+                    st.st_gid != os.getegid()):
+                try:
+                    os.fchown(fd, st.st_uid, st.st_gid)
+                except OSError as e:
+                    if e.errno != errno.EPERM:
+                        raise
+        with os.fdopen(fd, "wb") as f:
+            fd = None
+            f.write(data)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+    except:
+        if fd is not None:
+            os.close(fd)
+        os.remove(tmp_name)
+        raise
+    return tmp_name, target
+
+def discard_files(staged):
+    """
+    Removes the temporary files of ``staged`` that still exist.
+
+    """
+    for tmp_name, target in staged:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+
+def commit_files(staged, sync=True, committed=None):
+    """
+    Renames the files staged with :func:`stage_file` over their targets and
+    syncs each of their directories once. The targets are appended to the
+    ``committed`` list, if it is given, as they are replaced, so the caller
+    knows which ones were when a rename fails.
+
+    """
+    directories = set()
+    try:
+        for i, (tmp_name, target) in enumerate(staged):
+            os.rename(tmp_name, target)
+            directories.add(os.path.dirname(target))
+            if committed is not None:
+                committed.append(target)
+    except:
+        discard_files(staged[i:])
+        raise
+    if sync:
+        for directory in sorted(directories):
+            fsync_directory(directory)
+
+def write_file_atomic(path, data, sync=True):
+    """
+    Replaces the contents of the file in ``path`` with ``data`` atomically.
+
+    """
+    commit_files([stage_file(path, data, sync=sync)], sync=sync)
+
 SPACER = "    "
 
 def str_tree(tree, indent=0):